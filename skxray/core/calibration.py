@@ -181,8 +181,10 @@ def refine_center(image, calibrated_center, pixel_size, phi_steps, max_peaks,
     if nx is None:
         nx = int(np.mean(image.shape) * 2)
 
-    phi = angle_grid(calibrated_center, image.shape, pixel_size).ravel()
-    r = radial_grid(calibrated_center, image.shape, pixel_size).ravel()
+    phi = angle_grid(calibrated_center, image.shape, pixel_size,
+                     copy=False).ravel()
+    r = radial_grid(calibrated_center, image.shape, pixel_size,
+                    copy=False).ravel()
     I = image.ravel()
 
     phi_steps = np.linspace(-np.pi, np.pi, phi_steps, endpoint=True)
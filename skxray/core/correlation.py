@@ -46,6 +46,9 @@ This module is for functions specific to time correlation
 """
 from __future__ import absolute_import, division, print_function
 import logging
+import multiprocessing
+import os
+import tempfile
 import time
 
 import numpy as np
@@ -54,8 +57,19 @@ import skxray.core.utils as core
 
 logger = logging.getLogger(__name__)
 
+# ROIs with at least this many pixels on average are correlated with one
+# matrix-vector product per ROI instead of a single reduction over all of
+# the ROIs (see `_process`)
+_DOT_MIN_PIXELS = 1000
 
-def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
+# number of images handed to the worker processes at a time when
+# multi_tau_auto_corr runs in parallel
+_PARALLEL_CHUNK = 16
+
+
+def multi_tau_auto_corr(num_levels, num_bufs, labels, images,
+                        processes=None, buf_dtype=np.float64,
+                        level_dtype=np.float64, sparse=False):
     """
     This function computes one-time correlations.
     
@@ -81,6 +95,26 @@ def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
     images : iterable of 2D arrays
         dimensions are: (rr, cc)
 
+    processes : int, optional
+        Number of worker processes. The ROIs are independent, so they are
+        split into `processes` groups of about the same number of pixels
+        and each group is correlated in its own process. The images are
+        handed to the workers through shared memory. Default is None,
+        which computes everything in this process.
+
+    buf_dtype : dtype, optional
+        data type of the ring buffer for the images themselves (the
+        first level). See `MultiTauCorrelator`. Default is float64.
+
+    level_dtype : dtype, optional
+        data type of the ring buffer for the downsampled images (all
+        other levels). See `MultiTauCorrelator`. Default is float64.
+
+    sparse : bool, optional
+        If True, only correlate the non-zero pixels of each image. This
+        is much faster for sparse images, e.g. at low count rates.
+        See `MultiTauCorrelator`. Default is False.
+
     Returns
     -------
     g2 : array
@@ -97,6 +131,9 @@ def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
     This implementation is based on code in the language Yorick
     by Mark Sutton, based on published work. [1]_
 
+    See `MultiTauCorrelator` to compute the correlation incrementally,
+    as the images arrive.
+
     References
     ----------
 
@@ -106,85 +143,492 @@ def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
         scattering," Rev. Sci. Instrum., vol 70, p 3274-3289, 2000.
 
     """
-    # In order to calculate correlations for `num_bufs`, images must be
-    # kept for up to the maximum lag step. These are stored in the array
-    # buffer. This algorithm only keeps number of buffers and delays but
-    # several levels of delays number of levels are kept in buf. Each
-    # level has twice the delay times of the next lower one. To save
-    # needless copying, of cyclic storage of images in buf is used.
-
-    if num_bufs % 2 != 0:
-        raise ValueError("number of channels(number of buffers) in "
-                         "multiple-taus (must be even)")
-
     if hasattr(images, 'frame_shape'):
         # Give a user-friendly error if we can detect the shape from pims.
         if labels.shape != images.frame_shape:
             raise ValueError("Shape of the image stack should be equal to"
                              " shape of the labels array")
 
-    # get the pixels in each label
-    label_mask, pixel_list = extract_label_indices(labels)
+    if processes is not None and processes > 1:
+        return _parallel_multi_tau_auto_corr(num_levels, num_bufs, labels,
+                                             images, processes, buf_dtype,
+                                             level_dtype, sparse)
 
-    num_rois = np.max(label_mask)
+    correlator = MultiTauCorrelator(num_levels, num_bufs, labels,
+                                    buf_dtype=buf_dtype,
+                                    level_dtype=level_dtype, sparse=sparse)
+
+    start_time = time.time()  # used to log the computation time (optionally)
+
+    correlator.add_images(images)
+
+    # ending time for the process
+    end_time = time.time()
+
+    logger.info("Processing time for {0} images took {1} seconds."
+                "".format(correlator.num_images, (end_time - start_time)))
+
+    return correlator.results()
+
+
+def _parallel_multi_tau_auto_corr(num_levels, num_bufs, labels, images,
+                                  processes, buf_dtype, level_dtype,
+                                  sparse=False):
+    """
+    Run `multi_tau_auto_corr` with the ROIs sharded across processes.
+
+    The images are copied, a chunk at a time, into one of two shared
+    memory buffers; the workers correlate one buffer while the next
+    chunk is read into the other.
+    """
+    if num_bufs % 2 != 0:
+        raise ValueError("number of channels(number of buffers) in "
+                         "multiple-taus (must be even)")
+
+    labels = np.asarray(labels)
+    shards = _shard_labels(labels, processes)
+
+    frame_size = labels.size
+    shared_bufs = [multiprocessing.RawArray('d', _PARALLEL_CHUNK * frame_size)
+                   for _ in range(2)]
+    chunk_bufs = [np.frombuffer(b, dtype=np.float64).reshape(
+        (_PARALLEL_CHUNK, ) + labels.shape) for b in shared_bufs]
+
+    workers = []
+    for shard in shards:
+        # relabel the ROIs of the shard 1, 2, 3, ...
+        lookup = np.zeros(np.max(labels) + 1, dtype=np.int64)
+        lookup[shard] = np.arange(1, len(shard) + 1)
+        conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(
+            target=_shard_worker,
+            args=(child_conn, shared_bufs, labels.shape, num_levels,
+                  num_bufs, lookup[labels], buf_dtype, level_dtype,
+                  sparse))
+        proc.daemon = True
+        proc.start()
+        workers.append((proc, conn))
+
+    def wait_for_workers():
+        for proc, conn in workers:
+            reply = conn.recv()
+            if isinstance(reply, Exception):
+                raise reply
+
+    start_time = time.time()
+    num_images = 0
+    try:
+        in_progress = False
+        buf_index = 0
+        count = 0
+        for img in images:
+            if np.shape(img) != labels.shape:
+                raise ValueError("Shape of the image should be equal to"
+                                 " shape of the labels array")
+            chunk_bufs[buf_index][count] = img
+            count += 1
+            num_images += 1
+            if count == _PARALLEL_CHUNK:
+                if in_progress:
+                    wait_for_workers()
+                for proc, conn in workers:
+                    conn.send((buf_index, count))
+                in_progress = True
+                buf_index = 1 - buf_index
+                count = 0
+        if in_progress:
+            wait_for_workers()
+        if count:
+            for proc, conn in workers:
+                conn.send((buf_index, count))
+            wait_for_workers()
+
+        # collect and merge the un-normalized results of each shard
+        G = np.zeros(((num_levels + 1)*num_bufs//2, np.max(labels)))
+        past_intensity_norm = np.zeros_like(G)
+        future_intensity_norm = np.zeros_like(G)
+        for shard, (proc, conn) in zip(shards, workers):
+            conn.send(None)
+            reply = conn.recv()
+            if isinstance(reply, Exception):
+                raise reply
+            cols = shard - 1
+            G[:, cols], past_intensity_norm[:, cols], \
+                future_intensity_norm[:, cols] = reply
+    finally:
+        for proc, conn in workers:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+    end_time = time.time()
+    logger.info("Processing time for {0} images in {1} processes took {2} "
+                "seconds.".format(num_images, len(workers),
+                                  (end_time - start_time)))
+
+    return _normalize(G, past_intensity_norm, future_intensity_norm,
+                      num_levels, num_bufs)
+
+
+def _shard_labels(labels, num_shards):
+    """
+    Split the ROIs into groups with about the same number of pixels.
+
+    Parameters
+    ----------
+    labels : array
+        labeled array; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
 
-    # number of pixels per ROI
-    num_pixels = np.bincount(label_mask, minlength=(num_rois+1))
-    num_pixels = num_pixels[1:]
+    num_shards : int
+        the maximum number of groups
 
+    Returns
+    -------
+    shards : list
+        the sorted labels in each non-empty group
+    """
+    label_mask, pixel_list = extract_label_indices(labels)
+    num_pixels = np.bincount(label_mask)[1:]
     if np.any(num_pixels == 0):
         raise ValueError("Number of pixels of the required roi's"
                          " cannot be zero, "
                          "num_pixels = {0}".format(num_pixels))
 
-    # G holds the un normalized auto-correlation result. We
-    # accumulate computations into G as the algorithm proceeds.
-    G = np.zeros(((num_levels + 1)*num_bufs/2, num_rois),
-                 dtype=np.float64)
+    # greedily hand the largest remaining ROI to the smallest shard
+    shards = [[] for _ in range(min(num_shards, len(num_pixels)))]
+    shard_pixels = np.zeros(len(shards), dtype=np.int64)
+    for n in np.argsort(num_pixels, kind='mergesort')[::-1]:
+        smallest = np.argmin(shard_pixels)
+        shards[smallest].append(n + 1)
+        shard_pixels[smallest] += num_pixels[n]
 
-    # matrix of past intensity normalizations
-    past_intensity_norm = np.zeros(((num_levels + 1)*num_bufs/2, num_rois),
-                                   dtype=np.float64)
+    return [np.sort(shard) for shard in shards]
 
-    # matrix of future intensity normalizations
-    future_intensity_norm = np.zeros(((num_levels + 1)*num_bufs/2, num_rois),
-                                     dtype=np.float64)
 
-    # Ring buffer, a buffer with periodic boundary conditions.
-    # Images must be keep for up to maximum delay in buf.
-    buf = np.zeros((num_levels, num_bufs, np.sum(num_pixels)),
-                   dtype=np.float64)
+def _shard_worker(conn, shared_bufs, frame_shape, num_levels, num_bufs,
+                  labels, buf_dtype, level_dtype, sparse=False):
+    """
+    Correlate the images in the shared buffers for a subset of the ROIs.
 
-    # to track processing each level
-    track_level = np.zeros(num_levels)
+    Each message received on `conn` is ``(buffer index, image count)``,
+    answered with ``True`` once those images are added to the
+    correlation, or ``None``, answered with the un-normalized G and
+    intensity normalizations. Exceptions are sent back instead of
+    the answer.
+    """
+    try:
+        chunk_bufs = [np.frombuffer(b, dtype=np.float64).reshape(
+            (-1, ) + tuple(frame_shape)) for b in shared_bufs]
+        correlator = MultiTauCorrelator(num_levels, num_bufs, labels,
+                                        buf_dtype=buf_dtype,
+                                        level_dtype=level_dtype,
+                                        sparse=sparse)
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                conn.send((correlator.G, correlator.past_intensity_norm,
+                           correlator.future_intensity_norm))
+                break
+            buf_index, count = msg
+            correlator.add_images(chunk_bufs[buf_index][:count])
+            conn.send(True)
+    except Exception as err:
+        conn.send(err)
+    finally:
+        conn.close()
+
+
+class MultiTauCorrelator(object):
+    """
+    Compute one-time correlations incrementally.
+
+    This holds the state of the multi-tau scheme used by
+    `multi_tau_auto_corr` (the ring buffer of images for each level of
+    downsampling and the running averages) so images can be added one at
+    a time, or in chunks, as they are acquired. The normalized
+    correlation of all of the images added so far is available at any
+    time from `results`, and the state can be saved and restored to
+    resume a correlation later.
+
+    Parameters
+    ----------
+    num_levels : int
+        how many generations of downsampling to perform, i.e.,
+        the depth of the binomial tree of averaged frames
 
-    # to increment buffer
-    cur = np.ones(num_levels, dtype=np.int64)
+    num_bufs : int, must be even
+        maximum lag step to compute in each generation of
+        downsampling
 
-    # to track how many images processed in each level
-    img_per_level = np.zeros(num_levels, dtype=np.int64)
+    labels : array
+        labeled array of the same shape as the images;
+        each ROI is represented by a distinct label (i.e., integer)
 
-    start_time = time.time()  # used to log the computation time (optionally)
+    buf_dtype : dtype, optional
+        data type of the ring buffer for the images themselves (the first
+        level). An unsigned integer type (e.g. uint16) is enough for the
+        counts of a photon counting detector. Default is float64.
 
-    for n, img in enumerate(images):
+    level_dtype : dtype, optional
+        data type of the ring buffer for the downsampled images (all other
+        levels). The downsampled images are averages, so this should be a
+        floating point type (e.g. float32). Default is float64.
+
+    sparse : bool, optional
+        If True, only the non-zero pixels of each image are kept in the
+        ring buffer and correlated. This is much faster, and smaller, when
+        most pixels of each image are zero, e.g. for a photon counting
+        detector at low count rates. Default is False.
+
+    Notes
+    -----
+    The ring buffers hold ``num_levels * num_bufs`` copies of the pixels in
+    the ROIs and are by far the largest part of the state, so storing them
+    in smaller types cuts the memory (and memory bandwidth) by 4-8x. G and
+    the intensity normalizations are always accumulated in float64.
+
+    - An integer `buf_dtype` stores the images exactly. Images which do
+      not fit (negative, too large or not integers) raise a ValueError
+      instead of being wrapped or truncated.
+    - A float32 `buf_dtype` or `level_dtype` rounds each stored value
+      with a relative error of at most 2**-24 (about 6e-8). Each level of
+      downsampling averages values which were already rounded and rounds
+      the average again, so the values of level L (from 0) are off by at
+      most (L + 1) * 2**-24. The sums are taken in float64, so this does
+      not grow with the number of pixels or images, but, counting the
+      rounding of the products of two float32 values, the relative error
+      of g2 at level L is bounded by about 4 * (L + 2) * 2**-24, i.e.
+      ``(num_levels + 1) * 2.4e-7`` for the longest lags. The rounding
+      errors mostly average out, so in practice it is a few 2**-24 at
+      every level.
+
+    Images can be added either as arrays (`add_image`) or as lists of
+    photon events (`add_events`), e.g. from a droplet algorithm. In sparse
+    mode each image is stored as the sorted positions and values of its
+    non-zero pixels, and the products of each lag are only taken where
+    both images are non-zero, so the cost of each image scales with the
+    number of events rather than the number of pixels in the ROIs. The
+    results are the same as in dense mode.
+
+    Examples
+    --------
+    >>> correlator = MultiTauCorrelator(num_levels, num_bufs, labels)
+    >>> for img in images:
+    ...     correlator.add_image(img)
+    ...     g2, lag_steps = correlator.results()
+
+    For event lists, with the flat indices of the pixels into the image:
+
+    >>> correlator = MultiTauCorrelator(num_levels, num_bufs, labels,
+    ...                                 sparse=True)
+    >>> for indices, counts in frames:
+    ...     correlator.add_events(indices, counts)
+    """
+    # the arrays which make up the state of the correlation, in addition
+    # to the ring buffer of each level
+    _state_keys = ('buf_sums', 'G', 'past_intensity_norm',
+                   'future_intensity_norm', 'track_level', 'cur',
+                   'img_per_level')
+
+    def __init__(self, num_levels, num_bufs, labels, buf_dtype=np.float64,
+                 level_dtype=np.float64, sparse=False):
+        # In order to calculate correlations for `num_bufs`, images must be
+        # kept for up to the maximum lag step. These are stored in the array
+        # buffer. This algorithm only keeps number of buffers and delays but
+        # several levels of delays number of levels are kept in buf. Each
+        # level has twice the delay times of the next lower one. To save
+        # needless copying, of cyclic storage of images in buf is used.
+
+        if num_bufs % 2 != 0:
+            raise ValueError("number of channels(number of buffers) in "
+                             "multiple-taus (must be even)")
+
+        self.num_levels = num_levels
+        self.num_bufs = num_bufs
+        self.labels = np.asarray(labels)
+
+        # get the pixels in each label
+        label_mask, pixel_list = extract_label_indices(self.labels)
+
+        # Sort the pixels by label so that each ROI occupies a contiguous
+        # segment of the ring buffer. The per-ROI sums for every lag of a
+        # level can then be taken in a single `np.add.reduceat` call.
+        order = np.argsort(label_mask, kind='mergesort')
+        self._pixel_list = pixel_list[order]
+
+        num_rois = np.max(label_mask)
+
+        # number of pixels per ROI
+        num_pixels = np.bincount(label_mask, minlength=(num_rois+1))
+        self._num_pixels = num_pixels[1:]
+
+        if np.any(self._num_pixels == 0):
+            raise ValueError("Number of pixels of the required roi's"
+                             " cannot be zero, "
+                             "num_pixels = {0}".format(self._num_pixels))
+
+        # index of the first pixel of each ROI in the ring buffer
+        self._roi_starts = np.concatenate(([0],
+                                           np.cumsum(self._num_pixels)[:-1]))
+
+        # the ROI (from 0) of each pixel in the ring buffer
+        self._roi_index = np.repeat(np.arange(num_rois), self._num_pixels)
+
+        # the position in the ring buffer of each pixel of the image,
+        # -1 for pixels outside of the ROIs
+        self._buf_index = np.full(self.labels.size, -1, dtype=np.int64)
+        self._buf_index[self._pixel_list] = np.arange(len(self._pixel_list))
+
+        # G holds the un normalized auto-correlation result. We
+        # accumulate computations into G as the algorithm proceeds.
+        self.G = np.zeros(((num_levels + 1)*num_bufs//2, num_rois),
+                          dtype=np.float64)
+
+        # matrix of past intensity normalizations
+        self.past_intensity_norm = np.zeros_like(self.G)
+
+        # matrix of future intensity normalizations
+        self.future_intensity_norm = np.zeros_like(self.G)
+
+        # Ring buffer, a buffer with periodic boundary conditions.
+        # Images must be keep for up to maximum delay in buf.
+        # There is one array per level, so that the images and the
+        # downsampled images can be stored with different types.
+        self.buf_dtype = np.dtype(buf_dtype)
+        self.level_dtype = np.dtype(level_dtype)
+        if self.level_dtype.kind != 'f':
+            raise ValueError("The downsampled images are averages, "
+                             "level_dtype must be a floating point type "
+                             "not {0}".format(self.level_dtype))
+        # In sparse mode each image is a tuple of the (sorted) positions
+        # and the values of its non-zero pixels.
+        self.sparse = bool(sparse)
+        if self.sparse:
+            self.buf = [[(np.zeros(0, dtype=np.int64),
+                          np.zeros(0, dtype=self._level_type(level)))
+                         for _ in range(num_bufs)]
+                        for level in range(num_levels)]
+        else:
+            self.buf = [np.zeros((num_bufs, len(self._pixel_list)),
+                                 dtype=self._level_type(level))
+                        for level in range(num_levels)]
+
+        # the sum over each ROI of every image in the ring buffer
+        self.buf_sums = np.zeros((num_levels, num_bufs, num_rois),
+                                 dtype=np.float64)
+
+        # to track processing each level
+        self.track_level = np.zeros(num_levels)
+
+        # to increment buffer
+        self.cur = np.ones(num_levels, dtype=np.int64)
+
+        # to track how many images processed in each level
+        self.img_per_level = np.zeros(num_levels, dtype=np.int64)
+
+    @property
+    def num_images(self):
+        """The number of images added so far"""
+        return int(self.img_per_level[0])
+
+    def _level_type(self, level):
+        """The data type of the ring buffer of a level"""
+        return self.buf_dtype if level == 0 else self.level_dtype
+
+    def add_image(self, img):
+        """
+        Add the next image to the correlation.
+
+        Parameters
+        ----------
+        img : array
+            image of the same shape as the labels
+        """
+        if np.shape(img) != self.labels.shape:
+            raise ValueError("Shape of the image should be equal to"
+                             " shape of the labels array")
+        values = self._check_range((np.ravel(img))[self._pixel_list])
+        if self.sparse:
+            pos = np.flatnonzero(values)
+            values = (pos, values[pos])
+        self._add(values)
+
+    def add_events(self, indices, counts=None):
+        """
+        Add the next image to the correlation, as a list of photon events.
+
+        Parameters
+        ----------
+        indices : array
+            flat index (as from `np.ravel_multi_index`) into the image of
+            the pixel of each event. Pixels may appear more than once, and
+            events outside of the ROIs are ignored.
+
+        counts : array, optional
+            number of photons (or intensity) of each event.
+            Default is one photon per event.
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if counts is None:
+            counts = np.ones(len(indices), dtype=np.int64)
+        else:
+            counts = np.asarray(counts).ravel()
+            if len(counts) != len(indices):
+                raise ValueError("There must be one count per event, got "
+                                 "{0} counts for {1} events"
+                                 "".format(len(counts), len(indices)))
+        if len(indices) and (indices.min() < 0 or
+                             indices.max() >= self.labels.size):
+            raise ValueError("The event indices must be in the range "
+                             "[0, {0})".format(self.labels.size))
+
+        # add up the events of each pixel in the ROIs
+        pos = self._buf_index[indices]
+        in_rois = pos >= 0
+        pos, inverse = np.unique(pos[in_rois], return_inverse=True)
+        values = np.bincount(inverse, weights=counts[in_rois],
+                             minlength=len(pos))
+        if counts.dtype.kind in 'iub':
+            values = values.astype(np.int64)
+        values = self._check_range(values)
+
+        if self.sparse:
+            non_zero = values != 0
+            self._add((pos[non_zero], values[non_zero]))
+        else:
+            img = np.zeros(len(self._pixel_list), dtype=values.dtype)
+            img[pos] = values
+            self._add(img)
+
+    def _add(self, values):
+        """
+        Add the pixel values of the next image, in the ring buffer order
+        (as ``(positions, values)`` in sparse mode), to the correlation.
+        """
+        num_bufs = self.num_bufs
+        buf = self.buf
+        cur = self.cur
+        track_level = self.track_level
 
         cur[0] = (1 + cur[0]) % num_bufs  # increment buffer
 
         # Put the image into the ring buffer.
-        buf[0, cur[0] - 1] = (np.ravel(img))[pixel_list]
+        if self.sparse:
+            buf[0][cur[0] - 1] = (values[0],
+                                  values[1].astype(self.buf_dtype))
+        else:
+            buf[0][cur[0] - 1] = values
 
         # Compute the correlations between the first level
         # (undownsampled) frames. This modifies G,
         # past_intensity_norm, future_intensity_norm,
         # and img_per_level in place!
-        _process(buf, G, past_intensity_norm,
-                 future_intensity_norm, label_mask,
-                 num_bufs, num_pixels, img_per_level,
-                 level=0, buf_no=cur[0] - 1)
+        self._process(level=0, buf_no=cur[0] - 1)
 
         # check whether the number of levels is one, otherwise
         # continue processing the next level
-        processing = num_levels > 1
+        processing = self.num_levels > 1
 
         # Compute the correlations for all higher levels.
         level = 1
@@ -196,9 +640,8 @@ def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
                 prev = 1 + (cur[level - 1] - 2) % num_bufs
                 cur[level] = 1 + cur[level] % num_bufs
 
-                buf[level, cur[level] - 1] = (buf[level - 1, prev - 1] +
-                                              buf[level - 1,
-                                                  cur[level - 1] - 1])/2
+                self._downsample(level, prev - 1, cur[level - 1] - 1,
+                                 cur[level] - 1)
 
                 # make the track_level zero once that level is processed
                 track_level[level] = 0
@@ -207,21 +650,223 @@ def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
                 # for multi-tau levels greater than one
                 # Again, this is modifying things in place. See comment
                 # on previous call above.
-                _process(buf, G, past_intensity_norm,
-                         future_intensity_norm, label_mask,
-                         num_bufs, num_pixels, img_per_level,
-                         level=level, buf_no=cur[level]-1,)
+                self._process(level=level, buf_no=cur[level]-1)
                 level += 1
 
                 # Checking whether there is next level for processing
-                processing = level < num_levels
-
-    # ending time for the process
-    end_time = time.time()
+                processing = level < self.num_levels
+
+    def _downsample(self, level, prev, current, buf_no):
+        """
+        Store the average of two images of the previous level in the
+        ring buffer of a level.
+        """
+        buf = self.buf
+        if self.sparse:
+            (prev_pos, prev_vals), (cur_pos, cur_vals) = (
+                buf[level - 1][prev], buf[level - 1][current])
+            pos, inverse = np.unique(np.concatenate((prev_pos, cur_pos)),
+                                     return_inverse=True)
+            values = np.bincount(inverse,
+                                 weights=np.concatenate((prev_vals,
+                                                         cur_vals)),
+                                 minlength=len(pos))
+            buf[level][buf_no] = (pos,
+                                  (values / 2).astype(self.level_dtype))
+        else:
+            # average in the type of this level, so that integer
+            # images can not overflow
+            new_img = buf[level][buf_no]
+            np.add(buf[level - 1][prev], buf[level - 1][current],
+                   out=new_img, dtype=new_img.dtype)
+            new_img /= 2
+
+    def _check_range(self, values):
+        """
+        Make sure the pixel values can be stored in the first level buffer
+        """
+        dtype = self.buf_dtype
+        if (dtype.kind in 'iu' and len(values) and
+                not np.can_cast(values.dtype, dtype)):
+            info = np.iinfo(dtype)
+            if (values.min() < info.min or values.max() > info.max or
+                    np.any(np.mod(values, 1))):
+                raise ValueError("The image can not be stored in a ring "
+                                 "buffer of type {0}: the pixel values must "
+                                 "be integers in the range [{1}, {2}]"
+                                 "".format(dtype, info.min, info.max))
+        return values
+
+    def add_images(self, images):
+        """
+        Add a sequence of images to the correlation, in order.
+
+        Parameters
+        ----------
+        images : iterable of 2D arrays
+            dimensions are: (rr, cc)
+        """
+        for img in images:
+            self.add_image(img)
+
+    def _process(self, level, buf_no):
+        if self.sparse:
+            _process_sparse(self.buf, self.buf_sums, self.G,
+                            self.past_intensity_norm,
+                            self.future_intensity_norm, self._roi_index,
+                            self.num_bufs, self._num_pixels,
+                            self.img_per_level, level=level, buf_no=buf_no)
+        else:
+            _process(self.buf, self.buf_sums, self.G,
+                     self.past_intensity_norm, self.future_intensity_norm,
+                     self._roi_starts, self.num_bufs, self._num_pixels,
+                     self.img_per_level, level=level, buf_no=buf_no)
+
+    def results(self):
+        """
+        The normalized correlation of the images added so far.
+
+        Returns
+        -------
+        g2 : array
+            matrix of one-time correlation
+            shape (num_levels, number of labels(ROI))
+
+        lag_steps : array
+            delay or lag steps for the multiple tau analysis
+            shape num_levels
+        """
+        return _normalize(self.G, self.past_intensity_norm,
+                          self.future_intensity_norm, self.num_levels,
+                          self.num_bufs)
+
+    def get_state(self):
+        """
+        Get a copy of the state of the correlation.
+
+        Returns
+        -------
+        state : dict
+            everything needed to resume the correlation with
+            `MultiTauCorrelator.from_state`
+        """
+        state = dict((key, getattr(self, key).copy())
+                     for key in self._state_keys)
+        for level, level_buf in enumerate(self.buf):
+            if self.sparse:
+                # the images of the level, one after the other
+                positions, values = zip(*level_buf)
+                state['buf_{0}_pos'.format(level)] = np.concatenate(
+                    positions)
+                state['buf_{0}_vals'.format(level)] = np.concatenate(values)
+                state['buf_{0}_len'.format(level)] = np.array(
+                    [len(pos) for pos in positions], dtype=np.int64)
+            else:
+                state['buf_{0}'.format(level)] = level_buf.copy()
+        state.update(num_levels=self.num_levels, num_bufs=self.num_bufs,
+                     labels=self.labels.copy(),
+                     buf_dtype=self.buf_dtype.str,
+                     level_dtype=self.level_dtype.str,
+                     sparse=self.sparse)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Resume a correlation from a saved state.
+
+        Parameters
+        ----------
+        state : dict
+            state of a correlation, as returned by `get_state`
+
+        Returns
+        -------
+        correlator : MultiTauCorrelator
+        """
+        correlator = cls(int(state['num_levels']), int(state['num_bufs']),
+                         state['labels'],
+                         buf_dtype=np.dtype(str(state['buf_dtype'])),
+                         level_dtype=np.dtype(str(state['level_dtype'])),
+                         sparse=bool(state.get('sparse', False)))
+        arrays = [(key, getattr(correlator, key))
+                  for key in cls._state_keys]
+        if correlator.sparse:
+            for level in range(correlator.num_levels):
+                correlator.buf[level] = correlator._sparse_level_from_state(
+                    state, level)
+        else:
+            arrays.extend(('buf_{0}'.format(level), level_buf)
+                          for level, level_buf in enumerate(correlator.buf))
+        for key, current in arrays:
+            if current.shape != np.shape(state[key]):
+                raise ValueError("The saved {0} has shape {1}, expected {2}"
+                                 "".format(key, np.shape(state[key]),
+                                           current.shape))
+            current[...] = state[key]
+        return correlator
+
+    def _sparse_level_from_state(self, state, level):
+        """The sparse ring buffer of a level from a saved state"""
+        key = 'buf_{0}_{1}'.format
+        lengths = np.asarray(state[key(level, 'len')])
+        positions = np.asarray(state[key(level, 'pos')])
+        values = np.asarray(state[key(level, 'vals')])
+        if (len(lengths) != self.num_bufs or
+                np.sum(lengths) != len(positions) or
+                len(positions) != len(values)):
+            raise ValueError("The saved ring buffer of level {0} does not "
+                             "hold {1} images".format(level, self.num_bufs))
+        splits = np.cumsum(lengths)[:-1]
+        return list(zip(np.split(positions.astype(np.int64), splits),
+                        np.split(values.astype(self._level_type(level)),
+                                 splits)))
+
+    def save(self, fname):
+        """
+        Checkpoint the correlation to a file.
+
+        Parameters
+        ----------
+        fname : str or file
+            file name or open file to save the state to (in numpy's
+            ``.npz`` format)
+        """
+        np.savez(fname, **self.get_state())
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Resume a correlation checkpointed with `save`.
+
+        Parameters
+        ----------
+        fname : str or file
+            file name or open file to load the state from
+
+        Returns
+        -------
+        correlator : MultiTauCorrelator
+        """
+        with np.load(fname) as state:
+            return cls.from_state(dict(state))
+
+
+def _normalize(G, past_intensity_norm, future_intensity_norm, num_levels,
+               num_bufs):
+    """
+    Internal helper function to normalize G and find the matching lags.
 
-    logger.info("Processing time for {0} images took {1} seconds."
-                "".format(n, (end_time - start_time)))
+    Returns
+    -------
+    g2 : array
+        matrix of one-time correlation
+        shape (num_levels, number of labels(ROI))
 
+    lag_steps : array
+        delay or lag steps for the multiple tau analysis
+        shape num_levels
+    """
     # the normalization factor
     if len(np.where(past_intensity_norm == 0)[0]) != 0:
         g_max = np.where(past_intensity_norm == 0)[0][0]
@@ -239,18 +884,28 @@ def multi_tau_auto_corr(num_levels, num_bufs, labels, images):
     return g2, lag_steps
 
 
-def _process(buf, G, past_intensity_norm, future_intensity_norm,
-             label_mask, num_bufs, num_pixels, img_per_level, level, buf_no):
+def _process(buf, buf_sums, G, past_intensity_norm, future_intensity_norm,
+             roi_starts, num_bufs, num_pixels, img_per_level, level, buf_no):
     """
     Internal helper function. This modifies inputs in place.
 
     This helper function calculates G, past_intensity_norm and
     future_intensity_norm at each level, symmetric normalization is used.
+    All of the lags of a level are computed together, either with one
+    matrix-vector product per ROI or, for many small ROIs, by gathering the
+    delayed images into a (num_lags, num_pixels) block and taking the
+    per-ROI sums over the whole block at once. The per-ROI sums of each image
+    are only computed once, when it becomes the newest image of its level,
+    and are looked up from `buf_sums` when it is used as a past image.
 
     Parameters
     ----------
-    buf : array
-        image data array to use for correlation
+    buf : list
+        image data array of each level to use for correlation; the
+        pixels of each ROI must be contiguous along the last axis
+
+    buf_sums : array
+        sum over each ROI of every image in buf
 
     G : array
         matrix of auto-correlation function without
@@ -262,8 +917,8 @@ def _process(buf, G, past_intensity_norm, future_intensity_norm,
     future_intensity_norm : array
         matrix of future intensity normalizations
 
-    label_mask : array
-        labels of the required region of interests(roi's)
+    roi_starts : array
+        index of the first pixel of each ROI along the last axis of buf
 
     num_bufs : int, even
         number of buffers(channels)
@@ -302,37 +957,351 @@ def _process(buf, G, past_intensity_norm, future_intensity_norm,
     else:
         i_min = num_bufs//2
 
-    for i in range(i_min, min(img_per_level[level], num_bufs)):
-        t_index = level*num_bufs/2 + i
+    # the sum over each ROI of the newest image is needed both now and
+    # whenever it is used as a past image for a later one
+    future_img = buf[level][buf_no]
+    fi_binned = np.add.reduceat(future_img, roi_starts, dtype=np.float64)
+    buf_sums[level, buf_no] = fi_binned
+
+    lags = np.arange(i_min, min(img_per_level[level], num_bufs))
+    if not len(lags):
+        return None
+
+    t_index = level*num_bufs//2 + lags
+    delay_no = (buf_no - lags) % num_bufs
+
+    # number of images averaged so far for each lag
+    num_avg = (img_per_level[level] - lags)[:, np.newaxis]
+
+    #  get the matrix of auto-correlation function without normalizations
+    if len(num_pixels) * _DOT_MIN_PIXELS <= len(future_img):
+        # Few, large ROIs: a matrix-vector product per ROI correlates the
+        # newest image against every image of the level without making
+        # any temporaries.
+        # Buffers stored in smaller types are summed in float64.
+        tmp_binned = np.empty((num_bufs, len(num_pixels)))
+        for n, (start, stop) in enumerate(zip(roi_starts,
+                                              roi_starts + num_pixels)):
+            if future_img.dtype == np.float64:
+                tmp_binned[:, n] = np.dot(buf[level][:, start:stop],
+                                          future_img[start:stop])
+            else:
+                tmp_binned[:, n] = np.einsum('ij,j->i',
+                                             buf[level][:, start:stop],
+                                             future_img[start:stop],
+                                             dtype=np.float64)
+        tmp_binned = tmp_binned[delay_no]
+    else:
+        # Many, small ROIs: gather the delayed images for every lag into a
+        # (num_lags, num_pixels) block and reduce it in one call. Fancy
+        # indexing returns a copy, so it is safe to multiply in place,
+        # except that integer images are multiplied in float64 so the
+        # products can not overflow.
+        past_img = buf[level][delay_no]
+        if past_img.dtype.kind == 'f':
+            np.multiply(past_img, future_img, out=past_img)
+        else:
+            past_img = np.multiply(past_img, future_img, dtype=np.float64)
+        tmp_binned = np.add.reduceat(past_img, roi_starts, axis=1,
+                                     dtype=np.float64)
+    G[t_index] += (tmp_binned / num_pixels - G[t_index]) / num_avg
+
+    # get the matrix of past intensity normalizations
+    pi_binned = buf_sums[level, delay_no]
+    past_intensity_norm[t_index] += ((pi_binned / num_pixels -
+                                      past_intensity_norm[t_index]) /
+                                     num_avg)
+
+    # get the matrix of future intensity normalizations, the future
+    # image is the same for every lag
+    future_intensity_norm[t_index] += ((fi_binned / num_pixels -
+                                        future_intensity_norm[t_index]) /
+                                       num_avg)
+
+    return None  # modifies arguments in place!
+
+
+def _process_sparse(buf, buf_sums, G, past_intensity_norm,
+                    future_intensity_norm, roi_index, num_bufs, num_pixels,
+                    img_per_level, level, buf_no):
+    """
+    Internal helper function. This modifies inputs in place.
+
+    This is `_process` for sparse ring buffers, where each image is stored
+    as the sorted positions and the values of its non-zero pixels. The
+    products of the newest image with each delayed image are only taken
+    at the pixels which are non-zero in both, found for all of the lags
+    at once with a single `np.searchsorted`.
+
+    Parameters
+    ----------
+    buf : list
+        list of the ``(positions, values)`` of each image of each level
+
+    buf_sums : array
+        sum over each ROI of every image in buf
+
+    G : array
+        matrix of auto-correlation function without
+        normalizations
+
+    past_intensity_norm : array
+        matrix of past intensity normalizations
+
+    future_intensity_norm : array
+        matrix of future intensity normalizations
 
-        delay_no = (buf_no - i) % num_bufs
+    roi_index : array
+        the ROI (from 0) of each position in the ring buffer
 
-        past_img = buf[level, delay_no]
-        future_img = buf[level, buf_no]
+    num_bufs : int, even
+        number of buffers(channels)
+
+    num_pixels : array
+        number of pixels in certain roi's
+        roi's, dimensions are : [number of roi's]X1
 
-        #  get the matrix of auto-correlation function without normalizations
-        tmp_binned = (np.bincount(label_mask,
-                                  weights=past_img*future_img)[1:])
-        G[t_index] += ((tmp_binned / num_pixels - G[t_index]) /
-                       (img_per_level[level] - i))
+    img_per_level : array
+        to track how many images processed in each level
 
-        # get the matrix of past intensity normalizations
-        pi_binned = (np.bincount(label_mask,
-                                 weights=past_img)[1:])
-        past_intensity_norm[t_index] += ((pi_binned/num_pixels
-                                         - past_intensity_norm[t_index]) /
-                                         (img_per_level[level] - i))
+    level : int
+        the current multi-tau level
 
-        # get the matrix of future intensity normalizations
-        fi_binned = (np.bincount(label_mask,
-                                 weights=future_img)[1:])
-        future_intensity_norm[t_index] += ((fi_binned/num_pixels
-                                           - future_intensity_norm[t_index]) /
-                                           (img_per_level[level] - i))
+    buf_no : int
+        the current buffer number
+    """
+    img_per_level[level] += 1
+    num_rois = len(num_pixels)
+
+    if level == 0:
+        i_min = 0
+    else:
+        i_min = num_bufs//2
+
+    future_pos, future_vals = buf[level][buf_no]
+    future_rois = roi_index[future_pos]
+    fi_binned = np.bincount(future_rois, weights=future_vals,
+                            minlength=num_rois)
+    buf_sums[level, buf_no] = fi_binned
+
+    lags = np.arange(i_min, min(img_per_level[level], num_bufs))
+    if not len(lags):
+        return None
+
+    t_index = level*num_bufs//2 + lags
+    delay_no = (buf_no - lags) % num_bufs
+    num_avg = (img_per_level[level] - lags)[:, np.newaxis]
+
+    # Number the pixels of the delayed image of the n-th lag from
+    # n * size, so that the pixels of all of the delayed images make one
+    # sorted array, and look up the pixels of the newest image in it.
+    size = len(roi_index)
+    past_pos, past_vals = zip(*[buf[level][n] for n in delay_no])
+    past_keys = np.concatenate([n*size + pos
+                                for n, pos in enumerate(past_pos)])
+    tmp_binned = np.zeros((len(lags), num_rois))
+    if len(past_keys) and len(future_pos):
+        past_vals = np.concatenate(past_vals)
+        keys = (np.arange(len(lags))[:, np.newaxis] * size +
+                future_pos).ravel()
+        found = np.minimum(np.searchsorted(past_keys, keys),
+                           len(past_keys) - 1)
+        match = past_keys[found] == keys
+        products = (past_vals[found[match]].astype(np.float64) *
+                    np.tile(future_vals, len(lags))[match])
+        bins = (np.repeat(np.arange(len(lags)) * num_rois, len(future_pos)) +
+                np.tile(future_rois, len(lags)))[match]
+        tmp_binned += np.bincount(bins, weights=products,
+                                  minlength=tmp_binned.size).reshape(
+                                      tmp_binned.shape)
+    G[t_index] += (tmp_binned / num_pixels - G[t_index]) / num_avg
+
+    pi_binned = buf_sums[level, delay_no]
+    past_intensity_norm[t_index] += ((pi_binned / num_pixels -
+                                      past_intensity_norm[t_index]) /
+                                     num_avg)
+    future_intensity_norm[t_index] += ((fi_binned / num_pixels -
+                                        future_intensity_norm[t_index]) /
+                                       num_avg)
 
     return None  # modifies arguments in place!
 
 
+def two_time_corr(labels, images, downsample=1, block_size=256,
+                  filename=None):
+    """
+    This function computes two-time correlations.
+
+    For each ROI the two-time correlation of times t1 and t2 is
+
+    :math ::
+        C(t1, t2) = <I(t1)I(t2)> / (<I(t1)><I(t2)>)
+
+    where the averages are over the pixels of the ROI. Computed directly
+    this is O(num_times**2 * num_pixels), so the matrices are built in
+    (block_size, block_size) tiles, each tile being one matrix product
+    per ROI in single precision. Only the pixels in the ROIs are kept,
+    and only one tile of products is in memory at a time.
+
+    Parameters
+    ----------
+    labels : array
+        labeled array of the same shape as the images;
+        each ROI is represented by a distinct label (i.e., integer)
+
+    images : iterable of 2D arrays
+        dimensions are: (rr, cc)
+
+    downsample : int, optional
+        number of consecutive images averaged into each time step, e.g.
+        2**level to match a level of the multi-tau scheme. An incomplete
+        group at the end of the images is dropped. Default is 1. This is
+        a single level; for several levels call this once per level.
+
+    block_size : int, optional
+        the number of time steps along each side of a tile. Default is 256.
+
+    filename : str, optional
+        If given, the output is a memory-mapped file with this name (see
+        `numpy.memmap`), so that the tiles for a long series of images are
+        spilled to disk rather than kept in memory. The intensities of the
+        ROI pixels at each time are then kept in a temporary file in the
+        same directory while the tiles are computed.
+
+    Returns
+    -------
+    two_time : array
+        two-time correlation matrix of each ROI, in single precision
+        shape (number of labels(ROI), num_times, num_times)
+
+    """
+    if downsample < 1:
+        raise ValueError("downsample must be a positive integer, "
+                         "not {0}".format(downsample))
+    if block_size < 1:
+        raise ValueError("block_size must be a positive integer, "
+                         "not {0}".format(block_size))
+
+    labels = np.asarray(labels)
+    label_mask, pixel_list = extract_label_indices(labels)
+
+    # sort the pixels by label so each ROI is a contiguous block of columns
+    order = np.argsort(label_mask, kind='mergesort')
+    pixel_list = pixel_list[order]
+
+    num_rois = np.max(label_mask)
+    num_pixels = np.bincount(label_mask, minlength=(num_rois+1))[1:]
+    if np.any(num_pixels == 0):
+        raise ValueError("Number of pixels of the required roi's"
+                         " cannot be zero, "
+                         "num_pixels = {0}".format(num_pixels))
+    roi_stops = np.cumsum(num_pixels)
+    roi_starts = roi_stops - num_pixels
+
+    # the (downsampled) intensity of every pixel in the ROIs at each time,
+    # in a temporary file next to the output if there is one
+    series_file = None
+    if filename is not None:
+        series_file = tempfile.TemporaryFile(
+            dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        series = _series(labels.shape, pixel_list, images, downsample,
+                         series_file)
+        return _two_time_tiles(series, num_pixels, roi_starts, roi_stops,
+                               block_size, filename)
+    finally:
+        if series_file is not None:
+            series_file.close()
+
+
+def _series(shape, pixel_list, images, downsample, series_file=None):
+    """
+    The intensities of the pixels of pixel_list in the images, averaged
+    over groups of `downsample` images, shape (num_times, num_pixels).
+
+    The array is allocated once, memory-mapped onto series_file if it is
+    given, and grown in place when the number of images is not known up
+    front.
+    """
+    try:
+        capacity = max(len(images) // downsample, 1)
+    except TypeError:
+        capacity = 64
+
+    def allocate(num_times, mode):
+        if series_file is None:
+            return np.empty((num_times, len(pixel_list)), dtype=np.float32)
+        return np.memmap(series_file, dtype=np.float32, mode=mode,
+                         shape=(num_times, len(pixel_list)))
+
+    series = allocate(capacity, 'w+')
+    group = np.zeros(len(pixel_list), dtype=np.float64)
+    num_times = 0
+    for n, img in enumerate(images):
+        if np.shape(img) != shape:
+            raise ValueError("Shape of the image should be equal to"
+                             " shape of the labels array")
+        group += np.ravel(img)[pixel_list]
+        if (n + 1) % downsample == 0:
+            if num_times == len(series):
+                capacity *= 2
+                if series_file is None:
+                    series.resize((capacity, len(pixel_list)),
+                                  refcheck=False)
+                else:
+                    series.flush()
+                    # the file is extended, keeping the times so far
+                    series = allocate(capacity, 'r+')
+            group /= downsample
+            series[num_times] = group
+            num_times += 1
+            group[:] = 0
+    return series[:num_times]
+
+
+def _two_time_tiles(series, num_pixels, roi_starts, roi_stops, block_size,
+                    filename):
+    """
+    The two-time correlation matrices of `two_time_corr` of the series
+    of the ROI pixels, tile by tile.
+    """
+    num_rois = len(num_pixels)
+    num_times = len(series)
+
+    # mean intensity of each ROI at each time, shape (num_rois, num_times)
+    mean_intensity = np.array([series[:, start:stop].mean(axis=1)
+                               for start, stop in zip(roi_starts,
+                                                      roi_stops)])
+    mean_intensity = mean_intensity.reshape(num_rois, num_times)
+
+    shape = (num_rois, num_times, num_times)
+    if filename is None:
+        two_time = np.empty(shape, dtype=np.float32)
+    else:
+        two_time = np.memmap(filename, dtype=np.float32, mode='w+',
+                             shape=shape)
+
+    # only the tiles on and above the diagonal are computed, the matrices
+    # are symmetric
+    for t1 in range(0, num_times, block_size):
+        slc1 = slice(t1, t1 + block_size)
+        for t2 in range(t1, num_times, block_size):
+            slc2 = slice(t2, t2 + block_size)
+            for n, (start, stop) in enumerate(zip(roi_starts, roi_stops)):
+                tile = np.dot(series[slc1, start:stop],
+                              series[slc2, start:stop].T)
+                tile /= num_pixels[n]
+                tile /= np.outer(mean_intensity[n, slc1],
+                                 mean_intensity[n, slc2])
+                two_time[n, slc1, slc2] = tile
+                if t2 != t1:
+                    two_time[n, slc2, slc1] = tile.T
+        if filename is not None:
+            two_time.flush()
+
+    return two_time
+
+
 def extract_label_indices(labels):
     """
     This will find the label's required region of interests (roi's),
@@ -38,10 +38,13 @@ Fourier shift fitting
 """
 from __future__ import absolute_import, division, print_function
 import logging
+import multiprocessing
 logger = logging.getLogger(__name__)
 import numpy as np
 from scipy.optimize import minimize
 
+from . import utils
+
 
 def image_reduction(im, roi=None, bad_pixels=None):
     """
@@ -69,21 +72,105 @@ def image_reduction(im, roi=None, bad_pixels=None):
     yline : ndarray
         The column vector of the sums of each row.
 
+    See Also
+    --------
+    image_reduction_stack : the reductions of many images at once
+
     """
 
-    if bad_pixels:
-        im = im.copy()
-        for row, column in bad_pixels:
-            im[row, column] = 0
+    xlines, ylines = image_reduction_stack(np.asarray(im)[np.newaxis], roi,
+                                           bad_pixels)
+    return xlines[0], ylines[0]
+
+
+def image_reduction_stack(images, roi=None, bad_pixels=None, mask=None,
+                          chunk_size=None):
+    """
+    Sum each of many images over rows and columns, as `image_reduction`.
+
+    The bad pixels and the mask are turned into one boolean array of the
+    pixels to keep, and the images are reduced a chunk at a time, with the
+    other pixels set to 0 (not multiplied by 0, so NaN or inf bad pixels
+    are left out too).
+
+    Parameters
+    ----------
+    images : iterable of 2D arrays
+        A stack of images (num_img, rr, cc), or the images one at a time.
+        It may be a generator.
 
+    roi : ndarray, optional
+        [r, c, row, col], selects ROI im[r : r + row, c : c + col]. Default is
+        None, which uses the whole image.
+
+    bad_pixels : list, optional
+        List of (row, column) tuples marking bad pixels.
+        [(1, 5), (2, 6)] --> 2 bad pixels --> (1, 5) and (2, 6). Default is
+        None.
+
+    mask : ndarray, optional
+        Boolean array of the shape of the images, the pixels where it is
+        False are left out of the sums, like the bad pixels. Default is
+        None.
+
+    chunk_size : int, optional
+        Number of images reduced at a time. Defaults to
+        ``skxray.core.utils._defaults['chunk_size']``.
+
+    Returns
+    -------
+    xlines : ndarray
+        The sums of each column of each image, shape (num_img, cc), of the
+        type `np.sum` gives for the images.
+
+    ylines : ndarray
+        The sums of each row of each image, shape (num_img, rr), of the
+        same type.
+
+    """
+    xlines = []
+    ylines = []
+    window = None
+    for chunk in utils.image_chunks(images, chunk_size):
+        if window is None:
+            window, keep = _reduction_mask(chunk.shape[1:], roi,
+                                           bad_pixels, mask)
+        chunk = chunk[(slice(None),) + window]
+        if keep is not None:
+            # a zero of the type of the images, so the sums are of the
+            # same type as without bad pixels
+            chunk = np.where(keep, chunk, chunk.dtype.type(0))
+        xlines.append(np.sum(chunk, axis=1))
+        ylines.append(np.sum(chunk, axis=2))
+    if not xlines:
+        raise ValueError("There are no images to reduce")
+    return np.concatenate(xlines), np.concatenate(ylines)
+
+
+def _reduction_mask(shape, roi, bad_pixels, mask):
+    """
+    The window of the ROI in images of `shape`, and a boolean array of its
+    pixels which are neither bad nor masked, or None if there are none.
+    """
     if roi:
         r, c, row, col = roi
-        im = im[r:(r + row), c:(c + col)]
-
-    xline = np.sum(im, axis=0)
-    yline = np.sum(im, axis=1)
+        window = (slice(r, r + row), slice(c, c + col))
+    else:
+        window = (slice(None), slice(None))
+    if not bad_pixels and mask is None:
+        return window, None
 
-    return xline, yline
+    keep = np.ones(shape, dtype=bool)
+    if bad_pixels:
+        rows, columns = zip(*bad_pixels)
+        keep[list(rows), list(columns)] = False
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != tuple(shape):
+            raise ValueError("The mask must have the shape of the images "
+                             "{0}, not {1}".format(tuple(shape), mask.shape))
+        keep &= mask
+    return window, keep[window]
 
 
 def _rss_factory(length):
@@ -208,6 +295,196 @@ dpc_fit.solver = ['Nelder-Mead',
                   'SLSQP']
 
 
+def dpc_fit_batch(ref_reduction, diff_reductions, start_point, tol=1e-6,
+                  max_iters=2000):
+    """
+    Nonlinear fitting for 2 points, for many scanning points at once.
+
+    This minimizes the same cost function as `dpc_fit` with `_rss_factory`
+    for each of the diffraction patterns, with Levenberg-Marquardt
+    iterations on all of the patterns together. With the amplitude `a`
+    and the phase gradient `g` the model is ``ref * a * exp(1j * g * b)``,
+    whose Gauss-Newton normal matrix is diagonal,
+    ``diag(sum(|ref|**2), a**2 * sum(b**2 * |ref|**2))``, so each
+    iteration only takes two sums over each pattern.
+
+    Parameters
+    ----------
+    ref_reduction : ndarray
+        In DPC, the 1-D IFFT of the sum of the reference image data along x
+        or y direction.
+
+    diff_reductions : ndarray
+        In DPC, the 1-D IFFTs of the sums of the captured diffraction
+        patterns along x or y direction, one pattern per row.
+
+    start_point : list
+        start_point[0], start-searching value for the amplitude of the sample
+        transmission function at one scanning point.
+        start_point[1], start-searching value for the phase gradient (along x
+        or y direction) of the sample transmission function at one scanning
+        point.
+
+    tol : float, optional
+        Termination criteria of nonlinear fitting: the fit of a pattern stops
+        when the steps of both parameters are smaller than `tol`. Default is
+        1e-6.
+
+    max_iters : int, optional
+        Maximum iterations of nonlinear fitting. Default is 2000.
+
+    Returns
+    -------
+    ndarray
+        Fitting results, one row of (intensity attenuation, phase gradient)
+        for each diffraction pattern.
+
+    """
+    ref = np.asarray(ref_reduction)
+    diffs = np.atleast_2d(diff_reductions)
+    length = len(ref)
+    if diffs.shape[1] != length:
+        raise ValueError("The diffraction pattern reductions must be as long "
+                         "as the reference reduction ({0}), not {1}"
+                         "".format(length, diffs.shape[1]))
+    beta = np.linspace(-(length-1)//2, (length-1)//2, length)
+
+    # with w = conj(ref) * diff and c(g) = sum(w * exp(-1j * g * beta)),
+    # rss = sum(|diff|**2) - 2 * a * c.real + a**2 * sum(|ref|**2)
+    w = np.conj(ref) * diffs
+    ref2 = np.abs(ref)**2
+    s0 = np.sum(ref2)
+    s2 = np.sum(beta**2 * ref2)
+    diff2 = np.sum(np.abs(diffs)**2, axis=1)
+
+    def sums(w, g):
+        we = w * np.exp(-1j * np.outer(g, beta))
+        return np.sum(we, axis=1), np.dot(we, beta)
+
+    num = len(diffs)
+    a = np.ones(num) * start_point[0]
+    g = np.ones(num) * start_point[1]
+    damping = np.ones(num) * 1e-3
+    c, d = sums(w, g)
+    rss = diff2 - 2 * a * c.real + a**2 * s0
+
+    active = np.arange(num)
+    for _ in range(max_iters):
+        if not len(active):
+            break
+        a_k, g_k, damp_k = a[active], g[active], damping[active]
+        c_k, d_k = c[active], d[active]
+        # the Gauss-Newton steps, damped
+        step_a = (c_k.real - a_k * s0) / (s0 * (1 + damp_k))
+        h_gg = a_k**2 * s2 * (1 + damp_k)
+        step_g = np.zeros_like(g_k)
+        np.divide(a_k * d_k.imag, h_gg, out=step_g, where=h_gg > 0)
+        new_a = a_k + step_a
+        new_g = g_k + step_g
+        new_c, new_d = sums(w[active], new_g)
+        new_rss = diff2[active] - 2 * new_a * new_c.real + new_a**2 * s0
+
+        better = new_rss <= rss[active]
+        keep = active[better]
+        a[keep] = new_a[better]
+        g[keep] = new_g[better]
+        c[keep] = new_c[better]
+        d[keep] = new_d[better]
+        rss[keep] = new_rss[better]
+        damping[active] = np.where(better, damp_k / 10, damp_k * 10)
+
+        done = ((np.abs(step_a) <= tol) & (np.abs(step_g) <= tol) |
+                (damping[active] > 1e16))
+        active = active[~done]
+
+    return np.column_stack((a, g))
+
+
+def dpc_fit_fft(ref_reduction, diff_reductions, upsample=2, newton_iters=2):
+    """
+    Closed-form fitting for 2 points, for many scanning points at once.
+
+    This minimizes the same cost function as `dpc_fit` with `_rss_factory`
+    without a start point or a nonlinear solver. With
+    ``c(g) = sum(conj(ref) * diff * exp(-1j * g * b))``, the best amplitude
+    for a phase gradient `g` is ``c(g).real / sum(|ref|**2)``, which leaves
+    ``rss = sum(|diff|**2) - c(g).real**2 / sum(|ref|**2)``, so the best
+    `g` maximizes ``c(g).real``. `c` is the Fourier transform of
+    ``conj(ref) * diff``: its maximum on a grid of `g` comes from one
+    zero-padded FFT of each pattern, and a few Newton steps refine it.
+
+    Parameters
+    ----------
+    ref_reduction : ndarray
+        In DPC, the 1-D IFFT of the sum of the reference image data along x
+        or y direction.
+
+    diff_reductions : ndarray
+        In DPC, the 1-D IFFTs of the sums of the captured diffraction
+        patterns along x or y direction, one pattern per row.
+
+    upsample : int, optional
+        The grid of `g` is `upsample` times finer than the FFT of a pattern.
+        Default is 2.
+
+    newton_iters : int, optional
+        Number of Newton steps from the best `g` of the grid. Default is 2;
+        0 gives the grid estimates.
+
+    Returns
+    -------
+    ndarray
+        Fitting results, one row of (intensity attenuation, phase gradient)
+        for each diffraction pattern.
+
+    """
+    ref = np.asarray(ref_reduction)
+    diffs = np.atleast_2d(diff_reductions)
+    length = len(ref)
+    if diffs.shape[1] != length:
+        raise ValueError("The diffraction pattern reductions must be as long "
+                         "as the reference reduction ({0}), not {1}"
+                         "".format(length, diffs.shape[1]))
+    if upsample < 1:
+        raise ValueError("upsample must be at least 1, not "
+                         "{0}".format(upsample))
+    beta = np.linspace(-(length-1)//2, (length-1)//2, length)
+    w = np.conj(ref) * diffs
+    s0 = np.sum(np.abs(ref)**2)
+
+    # c on the grid g = 2 * pi * m / num_g, from the FFTs of the patterns
+    # wrapped so that beta = 0 comes first
+    num_g = upsample * length
+    wrapped = np.zeros((len(w), num_g), dtype=complex)
+    wrapped[:, beta.astype(int)] = w
+    grid = 2 * np.pi * np.fft.fftfreq(num_g)
+    g = grid[np.argmax(np.fft.fft(wrapped).real, axis=1)]
+
+    # Newton steps on c.real, at most a grid step each, with
+    # c(g), c'(g) / -1j and c''(g) / -1 from the sums of w * exp(-1j * g * b)
+    # weighted by 1, b and b**2
+    moments = np.vstack((np.ones(length), beta, beta**2)).T
+    max_step = 2 * np.pi / num_g
+    c = _phase_moments(w, g, beta, moments)
+    for _ in range(newton_iters):
+        step = np.zeros_like(g)
+        np.divide(c[:, 1].imag, c[:, 2].real, out=step,
+                  where=c[:, 2].real > 0)
+        g += np.clip(step, -max_step, max_step)
+        c = _phase_moments(w, g, beta, moments)
+    return np.column_stack((c[:, 0].real / s0, g))
+
+
+def _phase_moments(w, g, beta, moments):
+    """The moments of w * exp(-1j * g * beta), one row per pattern"""
+    angle = np.outer(-g, beta)
+    phasor = np.empty(angle.shape, dtype=complex)
+    np.cos(angle, out=phasor.real)
+    np.sin(angle, out=phasor.imag)
+    phasor *= w
+    return np.dot(phasor, moments)
+
+
 def recon(gx, gy, scan_xstep, scan_ystep, padding=0, weighting=0.5):
     """
     Reconstruct the final phase image.
@@ -246,50 +523,151 @@ def recon(gx, gy, scan_xstep, scan_ystep, padding=0, weighting=0.5):
     phase : ndarray
         Final phase image.
 
+    See Also
+    --------
+    PhaseReconstructor : keeps the Fourier kernels for one set-up
+
+    Notes
+    -----
+    The Fourier kernels of the two most recently used (shape, scan_xstep,
+    scan_ystep, padding, weighting) are cached, if they take at most 256 MB.
+    They are kept apart from the grids of `skxray.core.utils`, which they
+    would otherwise evict: the kernels take about 8 bytes for each point
+    of the padded image, e.g. 200 MB for a 1000 x 1000 scan with
+    padding=2.
+
     """
 
     if weighting < 0 or weighting > 1:
         raise ValueError('weighting should be within the range of [0, 1]!')
 
-    pad = 2 * padding + 1
     gx = np.asarray(gx)
-    rows, cols = gx.shape
-    pad_row = rows * pad
-    pad_col = cols * pad
+    kernel = _kernel_cache.get(
+        ('dpc_recon', gx.shape, scan_xstep, scan_ystep, padding, weighting),
+        lambda: _recon_kernel(gx.shape, scan_xstep, scan_ystep, padding,
+                              weighting))
+    return _integrate(kernel, gx, gy)
+
+
+class PhaseReconstructor(object):
+    """
+    Reconstruct phase images of one shape from their phase gradients, as
+    `recon` does, keeping the Fourier kernels between reconstructions.
 
-    gx_padding = np.zeros((pad_row, pad_col), dtype='d')
-    gy_padding = np.zeros((pad_row, pad_col), dtype='d')
+    Parameters
+    ----------
+    shape : tuple
+        Shape (N, M) of the phase gradients and phase images
+
+    scan_xstep, scan_ystep, padding, weighting
+        As for `recon`.
+
+    Examples
+    --------
+    >>> phase = PhaseReconstructor(gx.shape, 0.1, 0.1, padding=2)
+    >>> images = [phase(gx, gy) for gx, gy in gradients]
+    """
+    def __init__(self, shape, scan_xstep, scan_ystep, padding=0,
+                 weighting=0.5):
+        if weighting < 0 or weighting > 1:
+            raise ValueError('weighting should be within the range of '
+                             '[0, 1]!')
+        self.shape = tuple(shape)
+        self.scan_xstep = scan_xstep
+        self.scan_ystep = scan_ystep
+        self.padding = padding
+        self.weighting = weighting
+        self._kernel = _recon_kernel(self.shape, scan_xstep, scan_ystep,
+                                     padding, weighting)
+
+    def __call__(self, gx, gy):
+        """
+        Reconstruct the phase image.
 
-    roi_slice = (slice(padding * rows, (padding + 1) * rows),
-                 slice(padding * cols, (padding + 1) * cols))
-    gx_padding[roi_slice] = gx
-    gy_padding[roi_slice] = gy
+        Parameters
+        ----------
+        gx, gy : ndarray
+            Phase gradients along x and y direction, of `shape`
+
+        Returns
+        -------
+        phase : ndarray
+            Final phase image.
+        """
+        gx = np.asarray(gx)
+        if gx.shape != self.shape or np.shape(gy) != self.shape:
+            raise ValueError("The phase gradients must have shape {0}, not "
+                             "{1} and {2}".format(self.shape, gx.shape,
+                                                  np.shape(gy)))
+        return _integrate(self._kernel, gx, gy)
 
-    tx = np.fft.fftshift(np.fft.fft2(gx_padding))
-    ty = np.fft.fftshift(np.fft.fft2(gy_padding))
 
-    mid_col = pad_col // 2 + 1
-    mid_row = pad_row // 2 + 1
-    ax = (2 * np.pi * np.arange(1 - mid_col, pad_col - mid_col + 1) /
-          (pad_col * scan_xstep))
-    ay = (2 * np.pi * np.arange(1 - mid_row, pad_row - mid_row + 1) /
-          (pad_row * scan_ystep))
+# the Fourier kernels of `recon`, apart from `utils._grid_cache`
+_kernel_cache = utils._GridCache(2, utils._defaults['grid_cache_bytes'])
 
-    kappax, kappay = np.meshgrid(ax, ay)
-    div_v = kappax ** 2 * (1 - weighting) + kappay ** 2 * weighting
 
-    c = -1j * (kappax * tx * (1 - weighting) + kappay * ty * weighting) / div_v
-    c = np.fft.ifftshift(np.where(div_v == 0, 0, c))
+def _recon_kernel(shape, scan_xstep, scan_ystep, padding, weighting):
+    """
+    The Fourier kernels of `recon`, for the real FFTs of the phase gradients
+    along x and y direction, padded to (N*(2*padding+1), M*(2*padding+1)).
 
-    phase = np.fft.ifft2(c)[roi_slice].real
+    Returns
+    -------
+    kernel : ndarray
+        The x and y kernels, stacked along the first axis; multiplied by -1j
+        they give the Fourier transform of the phase.
+    """
+    pad = 2 * padding + 1
+    pad_row = shape[0] * pad
+    pad_col = shape[1] * pad
+
+    # the frequencies in FFT order; only the non-negative ones along x for
+    # the real FFTs
+    kappax = 2 * np.pi * np.fft.rfftfreq(pad_col, scan_xstep)
+    kappay = 2 * np.pi * np.fft.fftfreq(pad_row, scan_ystep)
+    div_v = ((kappax ** 2 * (1 - weighting))[np.newaxis, :] +
+             (kappay ** 2 * weighting)[:, np.newaxis])
+    zero = div_v == 0
+    div_v[zero] = 1
+
+    # The phase is the real part of the inverse FFT, to which the Nyquist
+    # frequencies (their own negatives) of the x kernel along x and of the y
+    # kernel along y do not contribute. Dropping them makes the Fourier
+    # transform of the phase Hermitian, as the inverse real FFT needs.
+    if pad_col % 2 == 0:
+        kappax[-1] = 0
+    if pad_row % 2 == 0:
+        kappay[pad_row // 2] = 0
+    kernel = np.empty((2,) + div_v.shape)
+    np.divide(kappax * (1 - weighting), div_v, out=kernel[0])
+    np.divide(kappay[:, np.newaxis] * weighting, div_v, out=kernel[1])
+    kernel[:, zero] = 0
+    return kernel
+
+
+def _integrate(kernel, gx, gy):
+    """
+    Integrate the phase gradients with the kernels from `_recon_kernel`.
 
-    return phase
+    The phase gradients are zero-padded at the end rather than in the
+    middle, which shifts the padded images circularly and so only shifts
+    the phase image the same way.
+    """
+    rows, cols = gx.shape
+    pad_shape = (kernel.shape[1], cols * (kernel.shape[1] // rows))
+    c = np.fft.rfft2(gx, pad_shape)
+    c *= kernel[0]
+    ty = np.fft.rfft2(gy, pad_shape)
+    ty *= kernel[1]
+    c += ty
+    c *= -1j
+    return np.fft.irfft2(c, pad_shape)[:rows, :cols]
 
 
 def dpc_runner(ref, image_sequence, start_point, pixel_size, focus_to_det,
                scan_rows, scan_cols, scan_xstep, scan_ystep, energy, padding=0,
                weighting=0.5, solver='Nelder-Mead', roi=None, bad_pixels=None,
-               negate=True, scale=True):
+               negate=True, scale=True, processes=None, chunk_size=None):
     """
     Controller function to run the whole Differential Phase Contrast (DPC)
     imaging calculation.
@@ -300,7 +678,8 @@ def dpc_runner(ref, image_sequence, start_point, pixel_size, focus_to_det,
         The reference image for a DPC calculation.
 
     image_sequence : iterable of 2D arrays
-        Return diffraction patterns (2D Numpy arrays) when iterated over.
+        Return diffraction patterns (2D Numpy arrays) when iterated over, in
+        scanning order. It may be a generator.
 
     start_point : list
         start_point[0], start-searching value for the amplitude of the sample
@@ -347,6 +726,12 @@ def dpc_runner(ref, image_sequence, start_point, pixel_size, focus_to_det,
 
     solver : str, optional
         Type of solver, one of the following (default 'Nelder-Mead'):
+        * 'LM', fits all of the scanning points of a chunk of diffraction
+          patterns at once, see `dpc_fit_batch`. This is much faster than
+          the scipy solvers, which fit the points one at a time.
+        * 'FFT', fits all of the scanning points of a chunk at once in closed
+          form, without start_point, see `dpc_fit_fft`. This is faster
+          still, for near real time DPC of large scans.
         * 'Nelder-Mead'
         * 'Powell'
         * 'CG'
@@ -374,6 +759,14 @@ def dpc_runner(ref, image_sequence, start_point, pixel_size, focus_to_det,
         If True, scale gx and gy according to the experiment set up.
         If False, ignore pixel_size, focus_to_det, energy. Default is True.
 
+    processes : int, optional
+        Number of worker processes to fit the chunks of diffraction patterns
+        in, for the scipy solvers. Default is None, fitting in this process.
+
+    chunk_size : int, optional
+        Number of diffraction patterns reduced and fitted at a time. Defaults
+        to ``skxray.core.utils._defaults['chunk_size']``.
+
     Returns
     -------
     phase : ndarray
@@ -387,69 +780,263 @@ def dpc_runner(ref, image_sequence, start_point, pixel_size, focus_to_det,
     multilayer Laue lenses. Sci. Rep. 3, 1307; DOI:10.1038/srep01307 (2013).
 
     """
+    dpc = DPCReconstructor(ref, start_point, pixel_size, focus_to_det,
+                           scan_rows, scan_cols, scan_xstep, scan_ystep,
+                           energy, padding, weighting, solver, roi,
+                           bad_pixels, negate, scale)
+    num_images = scan_rows * scan_cols
+    # Same calculation on each diffraction pattern, a chunk at a time
+    chunks = _reduced_chunks(image_sequence, roi, bad_pixels, chunk_size)
+    pool = None
+    if solver in ('LM', 'FFT') or processes is None or processes < 2:
+        fits = (dpc._fit(fx, fy) for fx, fy in chunks)
+    else:
+        tasks = ((dpc.ref_fx, dpc.ref_fy, fx, fy, start_point, solver)
+                 for fx, fy in chunks)
+        pool = multiprocessing.Pool(processes)
+        fits = pool.imap(_fit_chunk, tasks)
+
+    try:
+        index = 0
+        for fit_x, fit_y in fits:
+            # the diffraction patterns are in scanning order
+            dpc._store(np.arange(index, index + len(fit_x)), fit_x, fit_y)
+            index += len(fit_x)
+            logger.debug('dpc {}% complete'.format(100 * index // num_images))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
-    if weighting < 0 or weighting > 1:
-        raise ValueError('weighting should be within the range of [0, 1]!')
+    # Reconstruct the final phase image
+    return dpc.phase(), dpc.amplitude
 
-    # Initialize ax, ay, gx, gy and phase
-    ax = np.zeros((scan_rows, scan_cols), dtype='d')
-    ay = np.zeros((scan_rows, scan_cols), dtype='d')
-    gx = np.zeros((scan_rows, scan_cols), dtype='d')
-    gy = np.zeros((scan_rows, scan_cols), dtype='d')
-    phase = np.zeros((scan_rows, scan_cols), dtype='d')
 
-    # Dimension reduction along x and y direction
-    refx, refy = image_reduction(ref, roi, bad_pixels)
+class DPCReconstructor(object):
+    """
+    Differential Phase Contrast (DPC) imaging of a scan whose diffraction
+    patterns are added as they arrive.
 
-    # 1-D IFFT
-    ref_fx = np.fft.fftshift(np.fft.ifft(refx))
-    ref_fy = np.fft.fftshift(np.fft.ifft(refy))
+    The patterns can be added in any order, each with its scanning point,
+    and each is only fitted once. `phase` reconstructs the phase image of
+    the points fitted so far at any time, e.g. to watch a fly scan while it
+    runs; the points which have not been fitted have no phase gradient.
+    Adding a pattern for a point again replaces its fit.
 
-    ffx = _rss_factory(len(ref_fx))
-    ffy = _rss_factory(len(ref_fy))
-    num_images = len(image_sequence)
-    steps = np.max((num_images // 100, 1))
-    # Same calculation on each diffraction pattern
-    for index, im in enumerate(image_sequence):
-        i, j = np.unravel_index(index, (scan_rows, scan_cols))
-
-        # Dimension reduction along x and y direction
-        imx, imy = image_reduction(im, roi, bad_pixels)
-
-        # 1-D IFFT
-        fx = np.fft.fftshift(np.fft.ifft(imx))
-        fy = np.fft.fftshift(np.fft.ifft(imy))
-
-        # Nonlinear fitting
-        _ax, _gx = dpc_fit(ffx, ref_fx, fx, start_point, solver)
-        _ay, _gy = dpc_fit(ffy, ref_fy, fy, start_point, solver)
-
-        # Store one-point intermediate results
-        gx[i, j] = _gx
-        gy[i, j] = _gy
-        ax[i, j] = _ax
-        ay[i, j] = _ay
-        if (index+1) % steps == 0:
-            logger.debug('dpc {}% complete'.format(100*(index+1) // num_images))
-
-    if scale:
-        if pixel_size[0] != pixel_size[1]:
+    Parameters
+    ----------
+    ref : ndarray
+        The reference image for a DPC calculation.
+
+    start_point : list
+        start_point[0], start-searching value for the amplitude of the sample
+        transmission function at one scanning point.
+        start_point[1], start-searching value for the phase gradient (along x
+        or y direction) of the sample transmission function at one scanning
+        point.
+
+    pixel_size, focus_to_det, scan_rows, scan_cols, scan_xstep, scan_ystep,
+    energy, padding, weighting, roi, bad_pixels, negate, scale
+        As for `dpc_runner`.
+
+    solver : str, optional
+        Type of solver, one of `dpc_runner.solver`. Default is 'LM', see
+        `dpc_fit_batch`, unlike `dpc_runner` whose default is
+        'Nelder-Mead'; the fits of the two solvers differ slightly, so pass
+        the same solver to both to get the same results.
+
+    Attributes
+    ----------
+    filled : ndarray
+        True for the scanning points which have been fitted, shape
+        (scan_rows, scan_cols)
+
+    Examples
+    --------
+    >>> dpc = DPCReconstructor(ref, [1, 0], (55, 55), 1.46e6, 10, 10, 0.1,
+    ...                        0.1, 19.5)
+    >>> for index, frame in frames:
+    ...     dpc.add_frame(index, frame)
+    ...     show(dpc.phase())
+    """
+    def __init__(self, ref, start_point, pixel_size, focus_to_det,
+                 scan_rows, scan_cols, scan_xstep, scan_ystep, energy,
+                 padding=0, weighting=0.5, solver='LM', roi=None,
+                 bad_pixels=None, negate=True, scale=True):
+        if weighting < 0 or weighting > 1:
+            raise ValueError('weighting should be within the range of '
+                             '[0, 1]!')
+        if scale and pixel_size[0] != pixel_size[1]:
             raise ValueError('In DPC, detector pixels are squares!')
+        self.start_point = start_point
+        self.pixel_size = pixel_size
+        self.focus_to_det = focus_to_det
+        self.shape = (scan_rows, scan_cols)
+        self.scan_xstep = scan_xstep
+        self.scan_ystep = scan_ystep
+        self.energy = energy
+        self.padding = padding
+        self.weighting = weighting
+        self.solver = solver
+        self.roi = roi
+        self.bad_pixels = bad_pixels
+        self.negate = negate
+        self.scale = scale
+
+        # Dimension reduction along x and y direction, and 1-D IFFT
+        refx, refy = image_reduction(ref, roi, bad_pixels)
+        self.ref_fx = np.fft.fftshift(np.fft.ifft(refx))
+        self.ref_fy = np.fft.fftshift(np.fft.ifft(refy))
+
+        # the fits of the scanning points
+        self._ax = np.zeros(self.shape, dtype='d')
+        self._ay = np.zeros(self.shape, dtype='d')
+        self._gx = np.zeros(self.shape, dtype='d')
+        self._gy = np.zeros(self.shape, dtype='d')
+        self.filled = np.zeros(self.shape, dtype=bool)
+
+    def add_frame(self, index, image):
+        """
+        Fit the diffraction pattern of a scanning point.
+
+        Parameters
+        ----------
+        index : int or tuple
+            The scanning point, its index in scanning order, or its
+            (row, column)
+        image : ndarray
+            The diffraction pattern
+        """
+        if np.ndim(index):
+            index = [tuple(index)]
+        else:
+            index = [index]
+        self.add_frames(index, [image])
 
-        lambda_ = 12.4e-4 / energy
-        gx *= len(ref_fx) * pixel_size[0] / (lambda_ * focus_to_det)
-        gy *= len(ref_fy) * pixel_size[0] / (lambda_ * focus_to_det)
+    def add_frames(self, indices, images):
+        """
+        Fit the diffraction patterns of some scanning points, together.
+
+        Parameters
+        ----------
+        indices : array
+            The scanning points, their indices in scanning order, or
+            (row, column) pairs
+        images : iterable of 2D arrays
+            The diffraction patterns, one for each scanning point
+        """
+        indices = np.asarray(indices, dtype=int)
+        if indices.ndim == 2:
+            indices = np.ravel_multi_index(indices.T, self.shape)
+        elif np.any((indices < 0) | (indices >= self.filled.size)):
+            raise ValueError("The scanning points must be in [0, {0}), not "
+                             "{1}".format(self.filled.size, indices))
+        fx, fy = _reduce(images, self.roi, self.bad_pixels)
+        if len(fx) != len(indices):
+            raise ValueError("There must be one diffraction pattern for each "
+                             "scanning point, not {0} patterns for {1} points"
+                             "".format(len(fx), len(indices)))
+        self._store(indices, *self._fit(fx, fy))
+
+    def _fit(self, fx, fy):
+        """Fit the 1-D IFFTs of the reductions of diffraction patterns"""
+        if self.solver == 'LM':
+            return (dpc_fit_batch(self.ref_fx, fx, self.start_point),
+                    dpc_fit_batch(self.ref_fy, fy, self.start_point))
+        if self.solver == 'FFT':
+            return (dpc_fit_fft(self.ref_fx, fx), dpc_fit_fft(self.ref_fy, fy))
+        return _fit_chunk((self.ref_fx, self.ref_fy, fx, fy,
+                           self.start_point, self.solver))
+
+    def _store(self, indices, fit_x, fit_y):
+        """Store the fits of the scanning points at indices"""
+        for result, fit in zip((self._ax, self._gx, self._ay, self._gy),
+                               np.hstack((fit_x, fit_y)).T):
+            result.reshape(-1)[indices] = fit
+        self.filled.reshape(-1)[indices] = True
+
+    @property
+    def amplitude(self):
+        """
+        Amplitude of the sample transmission function, 0 where the
+        scanning points have not been fitted
+        """
+        return (self._ax + self._ay) / 2
 
-    if negate:
-        gx *= -1
+    def gradients(self):
+        """
+        The phase gradients along x and y direction, scaled and negated as
+        set up
 
-    # Reconstruct the final phase image
-    phase = recon(gx, gy, scan_xstep, scan_ystep, padding, weighting)
+        Returns
+        -------
+        gx, gy : ndarray
+            phase gradients, 0 where the scanning points have not been
+            fitted
+        """
+        gx = self._gx.copy()
+        gy = self._gy.copy()
+        if self.scale:
+            lambda_ = 12.4e-4 / self.energy
+            gx *= (len(self.ref_fx) * self.pixel_size[0] /
+                   (lambda_ * self.focus_to_det))
+            gy *= (len(self.ref_fy) * self.pixel_size[0] /
+                   (lambda_ * self.focus_to_det))
+        if self.negate:
+            gx *= -1
+        return gx, gy
+
+    def phase(self):
+        """
+        Reconstruct the phase image of the scanning points fitted so far.
+
+        Returns
+        -------
+        phase : ndarray
+            The reconstructed phase image.
+        """
+        gx, gy = self.gradients()
+        return recon(gx, gy, self.scan_xstep, self.scan_ystep, self.padding,
+                     self.weighting)
+
+
+def _reduce(images, roi, bad_pixels):
+    """
+    The 1-D IFFTs of the sums of the diffraction patterns along x and y
+    direction
+    """
+    imx, imy = image_reduction_stack(images, roi, bad_pixels)
+    return (np.fft.fftshift(np.fft.ifft(imx), axes=1),
+            np.fft.fftshift(np.fft.ifft(imy), axes=1))
+
+
+def _reduced_chunks(image_sequence, roi, bad_pixels, chunk_size):
+    """
+    The 1-D IFFTs of the sums of the diffraction patterns along x and y
+    direction, a chunk of patterns at a time
+    """
+    for chunk in utils.image_chunks(image_sequence, chunk_size):
+        yield _reduce(chunk, roi, bad_pixels)
+
+
+def _fit_chunk(task):
+    """
+    Fit a chunk of diffraction patterns with a scipy solver, one pattern at
+    a time. This is module level, so that it can run in worker processes.
+    """
+    ref_fx, ref_fy, fx, fy, start_point, solver = task
+    ffx = _rss_factory(len(ref_fx))
+    ffy = _rss_factory(len(ref_fy))
+    return (np.array([dpc_fit(ffx, ref_fx, f, start_point, solver)
+                      for f in fx]),
+            np.array([dpc_fit(ffy, ref_fy, f, start_point, solver)
+                      for f in fy]))
 
-    return phase, (ax + ay) / 2
 
 # attributes
-dpc_runner.solver = ['Nelder-Mead',
+dpc_runner.solver = ['LM',
+                     'FFT',
+                     'Nelder-Mead',
                      'Powell',
                      'CG',
                      'BFGS',
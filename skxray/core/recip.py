@@ -40,17 +40,21 @@ calculations.
 
 """
 from __future__ import absolute_import, division, print_function
+import hashlib
 import logging
+import numbers
+import os
+import tempfile
 
 import numpy as np
+import six
 
-from .utils import verbosedict
+from . import utils
+from .utils import verbosedict, _defaults, _GridCache, Grid3DAccumulator
 
 logger = logging.getLogger(__name__)
 import time
 
-from pyFAI import geometry as geo
-
 try:
     import src.ctrans as ctrans
 except ImportError:
@@ -62,7 +66,7 @@ except ImportError:
 
 def process_to_q(setting_angles, detector_size, pixel_size,
                  calibrated_center, dist_sample, wavelength, ub,
-                 frame_mode=None):
+                 frame_mode=None, out=None, dtype=None):
     """
     This will compute the hkl values for all pixels in a shape specified by
     detector_size.
@@ -107,6 +111,16 @@ def process_to_q(setting_angles, detector_size, pixel_size,
         See the `process_to_q.frame_mode` attribute for an exact list of
         valid options.
 
+    out : ndarray, optional
+        C contiguous array of shape [num_images * num_rows * num_columns][3]
+        and type float32 or float64 to write the HKL values to, e.g. a
+        `numpy.memmap` or the output of a previous scan. It is returned.
+
+    dtype : dtype, optional
+        np.float64 (default) or np.float32, the type of the HKL values when
+        `out` is not given. They are computed in double precision either
+        way; float32 halves the memory of the output.
+
     Returns
     -------
     hkl : ndarray
@@ -128,6 +142,76 @@ def process_to_q(setting_angles, detector_size, pixel_size,
        z-axis and (2+2)-Type geometries," J. Appl. Cryst., vol 31, pp 198-203,
        1998.
 
+    See Also
+    --------
+    DetectorGeometry : keeps the pixel directions of the detector arm
+        settings between calls
+
+    """
+    setting_angles, frame_mode = _validate_angles(setting_angles, frame_mode)
+    # ensure the ub matrix is an array
+    ub = np.asarray(ub)
+    # *********** Converting to Q   **************
+
+    # starting time for the process
+    t1 = time.time()
+
+    hkl = _q_output(out, dtype, len(setting_angles), detector_size)
+    _process_to_q(setting_angles, frame_mode, detector_size, pixel_size,
+                  calibrated_center, dist_sample, wavelength, ub, hkl)
+
+    # ending time for the process
+    t2 = time.time()
+    logger.info("Processing time for {0} {1} x {2} images took {3} seconds."
+                "".format(setting_angles.shape[0], detector_size[0],
+                          detector_size[1], (t2 - t1)))
+    return hkl
+
+# Assign frame_mode as an attribute to the process_to_q function so that the
+# autowrapping knows what the valid options are
+process_to_q.frame_mode = ['theta', 'phi', 'cart', 'hkl']
+
+
+def _process_to_q(setting_angles, mode, detector_size, pixel_size,
+                  calibrated_center, dist_sample, wavelength, ub, out):
+    """
+    `process_to_q` of validated angles into the array from `_q_output`,
+    without logging
+    """
+    # ctrans - c routines for fast data analysis
+    if ctrans is None:
+        _ccd_to_q(setting_angles, mode, detector_size, pixel_size,
+                  calibrated_center, dist_sample, wavelength, ub, out)
+    else:
+        ctrans.ccdToQ(angles=setting_angles * np.pi / 180.0,
+                      mode=mode,
+                      ccd_size=(detector_size),
+                      ccd_pixsize=(pixel_size),
+                      ccd_cen=(calibrated_center),
+                      dist=dist_sample,
+                      wavelength=wavelength,
+                      UBinv=np.matrix(ub).I,
+                      outarray=out)
+
+
+def _validate_angles(setting_angles, frame_mode):
+    """
+    Check the setting angles and convert the frame mode to the number
+    ctrans expects
+
+    Parameters
+    ----------
+    setting_angles : ndarray
+        six angles of all the images, [num_images][6]
+    frame_mode : str or None
+        one of `process_to_q.frame_mode`, or None for 'hkl'
+
+    Returns
+    -------
+    setting_angles : ndarray
+        the setting angles as a 2-D array
+    frame_mode : int
+        the frame mode number
     """
     # set default frame_mode
     if frame_mode is None:
@@ -136,8 +220,6 @@ def process_to_q(setting_angles, detector_size, pixel_size,
         str_to_int = verbosedict((k, j + 1) for j, k
                                  in enumerate(process_to_q.frame_mode))
         frame_mode = str_to_int[frame_mode]
-    # ensure the ub matrix is an array
-    ub = np.asarray(ub)
     # ensure setting angles is a 2-D
     setting_angles = np.atleast_2d(setting_angles)
     if setting_angles.ndim != 2:
@@ -149,32 +231,454 @@ def process_to_q(setting_angles, detector_size, pixel_size,
         raise ValueError('It is expected that there should be six angles in '
                          'the setting_angles parameter. You provided {0}'
                          ' angles.'.format(setting_angles.shape[1]))
-    # *********** Converting to Q   **************
+    return setting_angles, frame_mode
 
-    # starting time for the process
-    t1 = time.time()
 
-    # ctrans - c routines for fast data analysis
-    hkl = ctrans.ccdToQ(angles=setting_angles * np.pi / 180.0,
-                        mode=frame_mode,
-                        ccd_size=(detector_size),
-                        ccd_pixsize=(pixel_size),
-                        ccd_cen=(calibrated_center),
-                        dist=dist_sample,
-                        wavelength=wavelength,
-                        UBinv=np.matrix(ub).I)
-    # **kwargs)
+def _q_output(out, dtype, num_images, detector_size):
+    """
+    The array to write the (Qx, Qy, Qz) of the pixels of the images to:
+    `out` after checking its shape, or a new array of type `dtype`
+    """
+    shape = (num_images * detector_size[0] * detector_size[1], 3)
+    if out is None:
+        if dtype is None:
+            dtype = np.float64
+        return np.empty(shape, dtype=dtype)
+    if out.shape != shape:
+        raise ValueError("out must be of shape {0}, not {1}"
+                         "".format(shape, out.shape))
+    if dtype is not None and out.dtype != dtype:
+        raise ValueError("out is of type {0}, not {1}"
+                         "".format(out.dtype, np.dtype(dtype)))
+    if (out.dtype not in (np.float32, np.float64) or
+            not out.dtype.isnative or
+            not out.flags.c_contiguous or not out.flags.writeable):
+        raise ValueError("out must be a writeable, C contiguous array of "
+                         "native float32 or float64")
+    return out
+
+
+def _ccd_directions(detector_size, pixel_size, calibrated_center,
+                    dist_sample, delta, gamma):
+    """
+    The direction vectors of the pixels of the detector for a setting of
+    the detector arm, as computed by ``ctrans.ccdDirections``
 
-    # ending time for the process
+    Parameters
+    ----------
+    detector_size, pixel_size, calibrated_center, dist_sample
+        the detector, see `process_to_q`
+    delta, gamma : float
+        angles of the detector arm (degrees)
+
+    Returns
+    -------
+    directions : ndarray
+        (num_rows * num_columns, 3) array of
+        ``(-sin(gam), cos(del) * cos(gam), sin(del) * cos(gam))``, with
+        (del, gam) the angles of each pixel
+    """
+    # delta only depends on the row and gamma on the column
+    gam = np.radians(gamma) - np.arctan(
+        (np.arange(detector_size[0]) - calibrated_center[0]) *
+        pixel_size[0] / dist_sample)
+    dlt = np.radians(delta) - np.arctan(
+        (np.arange(detector_size[1]) - calibrated_center[1]) *
+        pixel_size[1] / dist_sample)
+    directions = np.empty((detector_size[1], detector_size[0], 3))
+    directions[..., 0] = -np.sin(gam)
+    directions[..., 1] = np.outer(np.cos(dlt), np.cos(gam))
+    directions[..., 2] = np.outer(np.sin(dlt), np.cos(gam))
+    return directions.reshape(-1, 3)
+
+
+def _ccd_to_q(setting_angles, mode, detector_size, pixel_size,
+              calibrated_center, dist_sample, wavelength, ub, out,
+              directions=None):
+    """
+    Compute the Q of the pixels of the images with numpy, the same way
+    as ``ctrans.ccdToQ``, for when ctrans is not available
+
+    The images are grouped by the setting of the detector arm, so that
+    the direction of each pixel is computed once for each setting, and
+    the rotations to the theta, phi and hkl frames of a batch of images
+    of a setting are done with a single matrix product.
+
+    Parameters
+    ----------
+    setting_angles : ndarray
+        six angles of all the images (degrees), [num_images][6]
+    mode : int
+        frame mode number (see `_validate_angles`)
+    detector_size, pixel_size, calibrated_center, dist_sample, wavelength
+        the detector and the beam, see `process_to_q`
+    ub : ndarray
+        UB matrix (orientation matrix) 3x3 matrix
+    out : ndarray
+        [num_images * num_rows * num_columns][3] array to write Q to
+    directions : callable, optional
+        ``directions(delta, gamma)``, the direction vectors of the pixels
+        for a setting of the detector arm. Defaults to `_ccd_directions`
+    """
+    if directions is None:
+        def directions(delta, gamma):
+            return _ccd_directions(detector_size, pixel_size,
+                                   calibrated_center, dist_sample, delta,
+                                   gamma)
+    num_pixels = detector_size[0] * detector_size[1]
+    out = out.reshape(len(setting_angles), num_pixels, 3)
+    kl = 2 * np.pi / wavelength
+    delta, theta, chi, phi, mu, gamma = np.radians(setting_angles).T
+
+    # Q in the theta frame is kl * (rot_theta . direction + offset)
+    zero = np.zeros_like(theta)
+    one = np.ones_like(theta)
+    matrix = np.array([[one, zero, zero],
+                       [zero, np.cos(theta), np.sin(theta)],
+                       [zero, -np.sin(theta), np.cos(theta)]])
+    offset = np.array([-np.sin(mu), -np.cos(theta) * np.cos(mu),
+                       np.sin(theta) * np.cos(mu)])
+    if mode > 1:
+        # to the phi frame
+        rot_phi = np.array(
+            [[np.cos(chi), zero, -np.sin(chi)],
+             [np.sin(phi) * np.sin(chi), np.cos(phi),
+              np.sin(phi) * np.cos(chi)],
+             [np.cos(phi) * np.sin(chi), -np.sin(phi),
+              np.cos(phi) * np.cos(chi)]])
+        matrix = np.einsum('ijn,jkn->ikn', rot_phi, matrix)
+        offset = np.einsum('ijn,jn->in', rot_phi, offset)
+    if mode == 4:
+        # to hkl, with the columns of the inverse of UB in the order ccdToQ
+        # uses them
+        ubinv = np.linalg.inv(ub)[:, ::-1] * [-1, 1, 1]
+        matrix = np.einsum('ij,jkn->ikn', ubinv, matrix)
+        offset = np.dot(ubinv, offset)
+    # one (3, 3) matrix and 3 offset for each image
+    matrix = kl * matrix.transpose(2, 0, 1)
+    offset = kl * offset.T
+
+    arms = {}
+    for j, arm in enumerate(zip(setting_angles[:, 0], setting_angles[:, 5])):
+        arms.setdefault(arm, []).append(j)
+    # batches of at most chunk_size images, and of 2**21 pixels (48 MB of
+    # Q) unless the images are larger than that
+    batch_size = max(1, min(_defaults['chunk_size'], 2**21 // num_pixels))
+    for (delta, gamma), images in arms.items():
+        pixel_directions = directions(delta, gamma)
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            q = np.tensordot(matrix[batch], pixel_directions,
+                             axes=([2], [1]))
+            out[batch] = q.transpose(0, 2, 1) + offset[batch, np.newaxis]
+
+
+def process_to_grid(setting_angles, detector_size, pixel_size,
+                    calibrated_center, dist_sample, wavelength, ub,
+                    img_stack, qmin=None, qmax=None, dqn=None,
+                    frame_mode=None, binary_mask=None, nthreads=None):
+    """
+    Convert the images to reciprocal space and grid them, in one pass.
+
+    This gives the same grid as ``grid3d(process_to_q(...), img_stack)``,
+    but each image is converted to HKL and gridded before the next one,
+    so the HKL values of all of the pixels are never stored and the
+    memory depends on the size of the grid rather than on the length of
+    the scan. The images are split between threads, each filling a grid
+    of its own, and the grids are merged at the end.
+
+    Parameters
+    ----------
+    setting_angles : ndarray
+        six angles of all the images - Required shape is [num_images][6]
+        Angle order: delta, theta, chi, phi, mu, gamma (degrees)
+    detector_size : tuple
+        2 element tuple defining the number of pixels in the detector. Order
+        is (num_columns, num_rows)
+    pixel_size : tuple
+        2 element tuple defining the size of each pixel in mm. Order is
+        (column_pixel_size, row_pixel_size)
+    calibrated_center : tuple
+        2 element tuple defining the center of the detector in pixels. Order
+        is (column_center, row_center)(x y)
+    dist_sample : float
+        distance from the sample to the detector (mm)
+    wavelength : float
+        wavelength of incident radiation (Angstroms)
+    ub : ndarray
+        UB matrix (orientation matrix) 3x3 matrix
+    img_stack : ndarray
+        Intensity array of the images
+        dimensions are: [num_img][num_rows][num_cols]
+        The images keep their integer or floating point type; each is
+        converted to float64 only while it is gridded.
+    qmin : array, optional
+        (xmin, ymin, zmin), the lower edges of the grid. Defaults to the
+        smallest values of the data
+    qmax : array, optional
+        (xmax, ymax, zmax), the upper edges of the grid. Defaults to just
+        above the largest values of the data. Finding the default bounds
+        takes an extra pass over the images, one image at a time.
+    dqn : array, optional
+        (nx, ny, nz), the number of voxels along each axis. Defaults to
+        the default number of voxels of `grid3d`
+    frame_mode : str, optional
+        Frame mode of the grid, see `process_to_q`. Defaults to 'hkl'
+    binary_mask : ndarray, optional
+        The pixels where the mask is False are left out. The mask is either
+        the shape of an image or of img_stack.
+    nthreads : int, optional
+        Number of threads to grid with. Defaults to the number of threads
+        ctrans was built with.
+
+    Returns
+    -------
+    mean : ndarray
+        intensity grid.  The values in this grid are the
+        mean of the values that fill with in the grid.
+    occupancy : ndarray
+        The number of data points that fell in the grid.
+    std_err : ndarray
+        This is the standard error of the value in the
+        grid box.
+    oob : int
+        Out Of Bounds. Number of data points that are outside of
+        the gridded region.
+    bounds : list
+        tuple of (min, max, step) for x, y, z in order: [x_bounds,
+        y_bounds, z_bounds]
+
+    See Also
+    --------
+    process_to_q, skxray.core.utils.grid3d
+    """
+    setting_angles, mode = _validate_angles(setting_angles, frame_mode)
+    img_stack = np.asarray(img_stack)
+    num_pixels = detector_size[0] * detector_size[1]
+    if img_stack.size != len(setting_angles) * num_pixels:
+        raise ValueError("img_stack must have {0} images of {1} pixels, "
+                         "not shape {2}".format(len(setting_angles),
+                                                num_pixels, img_stack.shape))
+    if binary_mask is not None:
+        binary_mask = np.asarray(binary_mask)
+        if binary_mask.size not in (num_pixels, img_stack.size):
+            raise ValueError("The binary mask must be the same shape as the "
+                             "img_stack ({0}) or a single image in the image "
+                             "stack.  The input binary mask is shaped ({1})"
+                             "".format(img_stack.shape, binary_mask.shape))
+        binary_mask = binary_mask.astype(bool)
+
+    if dqn is None:
+        dqn = [_defaults['nx'], _defaults['ny'], _defaults['nz']]
+    ub = np.asarray(ub)
+    # the Q values of one image at a time
+    hkl = _q_output(None, None, 1, detector_size)
+    if qmin is None or qmax is None:
+        # the extent of the data
+        lo, hi = [], []
+        for angles in setting_angles:
+            _process_to_q(angles[np.newaxis], mode, detector_size,
+                          pixel_size, calibrated_center, dist_sample,
+                          wavelength, ub, hkl)
+            lo.append(hkl.min(axis=0))
+            hi.append(hkl.max(axis=0))
+        if qmin is None:
+            qmin = np.min(lo, axis=0)
+        if qmax is None:
+            qmax = np.max(hi, axis=0)
+            # pad the upper edge by just enough to ensure that all of the
+            # points are in-bounds with the binning rules: lo <= val < hi
+            qmax += np.spacing(qmax)
+    bounds = np.array([qmin, qmax, dqn]).T
+
+    t1 = time.time()
+    if ctrans is None:
+        # an image at a time, with numpy
+        grid = Grid3DAccumulator(qmin, qmax, dqn)
+        images = img_stack.reshape(len(setting_angles), num_pixels)
+        if binary_mask is not None:
+            binary_mask = binary_mask.reshape(-1, num_pixels)
+        for j, angles in enumerate(setting_angles):
+            _process_to_q(angles[np.newaxis], mode, detector_size,
+                          pixel_size, calibrated_center, dist_sample,
+                          wavelength, ub, hkl)
+            grid.add(hkl, images[j], None if binary_mask is None else
+                     binary_mask[j % len(binary_mask)])
+        mean, occupancy, std_err, oob, _ = grid.finalize()
+    else:
+        mean, occupancy, std_err, oob = ctrans.ccdToGrid(
+            angles=setting_angles * np.pi / 180.0, mode=mode,
+            ccd_size=detector_size, ccd_pixsize=pixel_size,
+            ccd_cen=calibrated_center, dist=dist_sample,
+            wavelength=wavelength, UBinv=np.matrix(ub).I, images=img_stack,
+            grid_start=tuple(qmin), grid_stop=tuple(qmax),
+            grid_nsteps=tuple(int(n) for n in dqn), mask=binary_mask,
+            nthreads=nthreads or 0)
     t2 = time.time()
-    logger.info("Processing time for {0} {1} x {2} images took {3} seconds."
+    logger.info("Gridding {0} {1} x {2} images took {3} seconds."
                 "".format(setting_angles.shape[0], detector_size[0],
                           detector_size[1], (t2 - t1)))
-    return hkl[:, :3]
+    return mean, occupancy, std_err, oob, bounds
 
-# Assign frame_mode as an attribute to the process_to_q function so that the
-# autowrapping knows what the valid options are
-process_to_q.frame_mode = ['theta', 'phi', 'cart', 'hkl']
+
+class DetectorGeometry(object):
+    """
+    An area detector on the detector arm, which keeps the direction of
+    each pixel for the arm settings it has seen.
+
+    The directions of the pixels only depend on the detector and on the
+    (delta, gamma) angles of the arm, so in rocking scans (theta, phi,
+    ...) they are the same for every image. `process_to_q` computes them
+    once for each arm setting of the images, and keeps the most recently
+    used ones for the next call. The directions of the arm settings of a
+    call with several settings are also kept stacked together, as one
+    more entry of the same cache, so `max_settings` and `max_bytes` bound
+    them too.
+
+    Parameters
+    ----------
+    detector_size : tuple
+        2 element tuple defining the number of pixels in the detector. Order
+        is (num_columns, num_rows)
+    pixel_size : tuple
+        2 element tuple defining the size of each pixel in mm. Order is
+        (column_pixel_size, row_pixel_size)
+    calibrated_center : tuple
+        2 element tuple defining the center of the detector in pixels. Order
+        is (column_center, row_center)(x y)
+    dist_sample : float
+        distance from the sample to the detector (mm)
+    max_settings : int, optional
+        The number of arm settings to keep the directions of. Calls with
+        more arm settings than this compute the directions image by image
+        instead. Defaults to the size of the grid cache of
+        `skxray.core.utils`
+    max_bytes : int, optional
+        The maximum size of the directions kept, stacked or not, each
+        setting takes 24 bytes per pixel. Defaults to the size of the grid
+        cache of `skxray.core.utils`
+
+    Examples
+    --------
+    >>> geometry = DetectorGeometry((256, 256), (0.108, 0.108),
+    ...                             (128, 128), 355.0)
+    >>> for setting_angles in scans:
+    ...     hkl = geometry.process_to_q(setting_angles, wavelength, ub)
+    """
+    def __init__(self, detector_size, pixel_size, calibrated_center,
+                 dist_sample, max_settings=None, max_bytes=None):
+        if max_settings is None:
+            max_settings = _defaults['grid_cache_entries']
+        if max_bytes is None:
+            max_bytes = _defaults['grid_cache_bytes']
+        self.detector_size = tuple(int(n) for n in detector_size)
+        self.pixel_size = tuple(float(p) for p in pixel_size)
+        self.calibrated_center = tuple(float(c) for c in calibrated_center)
+        self.dist_sample = float(dist_sample)
+        self._directions = _GridCache(max_settings, max_bytes)
+
+    def directions(self, delta, gamma):
+        """
+        The direction of each pixel for a setting of the detector arm
+
+        Parameters
+        ----------
+        delta, gamma : float
+            angles of the detector arm (degrees)
+
+        Returns
+        -------
+        directions : ndarray
+            read-only (num_rows * num_columns, 3) array of
+            ``(-sin(gam), cos(del) * cos(gam), sin(del) * cos(gam))``,
+            with (del, gam) the angles of each pixel
+        """
+        delta, gamma = float(delta), float(gamma)
+        if ctrans is None:
+            def make_directions():
+                return _ccd_directions(self.detector_size, self.pixel_size,
+                                       self.calibrated_center,
+                                       self.dist_sample, delta, gamma)
+        else:
+            def make_directions():
+                return ctrans.ccdDirections(
+                    ccd_size=self.detector_size, ccd_pixsize=self.pixel_size,
+                    ccd_cen=self.calibrated_center, dist=self.dist_sample,
+                    arms=np.radians([[delta, gamma]]))[0]
+        return self._directions.get((delta, gamma), make_directions)
+
+    def process_to_q(self, setting_angles, wavelength, ub, frame_mode=None,
+                     out=None, dtype=None):
+        """
+        Compute the hkl values of all of the pixels of the images.
+
+        Parameters
+        ----------
+        setting_angles : ndarray
+            six angles of all the images - Required shape is
+            [num_images][6]
+            Angle order: delta, theta, chi, phi, mu, gamma (degrees)
+        wavelength : float
+            wavelength of incident radiation (Angstroms)
+        ub : ndarray
+            UB matrix (orientation matrix) 3x3 matrix
+        frame_mode : str, optional
+            Frame mode of the output, see `process_to_q`. Defaults to 'hkl'
+        out : ndarray, optional
+            array to write the HKL values to, see `process_to_q`
+        dtype : dtype, optional
+            type of the HKL values when `out` is not given, see
+            `process_to_q`
+
+        Returns
+        -------
+        hkl : ndarray
+            (Qx, Qy, Qz) - HKL values
+            shape is [num_images * num_rows * num_columns][3]
+        """
+        setting_angles, mode = _validate_angles(setting_angles, frame_mode)
+        t1 = time.time()
+        hkl = _q_output(out, dtype, len(setting_angles), self.detector_size)
+        if ctrans is None:
+            _ccd_to_q(setting_angles, mode, self.detector_size,
+                      self.pixel_size, self.calibrated_center,
+                      self.dist_sample, wavelength, ub, hkl,
+                      directions=self.directions)
+        else:
+            arms = {}
+            arm = np.array([arms.setdefault((delta, gamma), len(arms))
+                            for delta, gamma in setting_angles[:, [0, 5]]],
+                           dtype=np.intc)
+            settings = sorted(arms, key=arms.get)
+            if len(arms) == 1:
+                directions = self.directions(*settings[0])
+            elif len(arms) <= self._directions.max_entries:
+                # the directions of the settings, stacked in the order of
+                # `arm`, are kept along with those of each setting
+                settings = tuple(settings)
+                directions = self._directions.get(
+                    ('stack', settings),
+                    lambda: np.array([self.directions(delta, gamma)
+                                      for delta, gamma in settings]))
+            else:
+                directions = arm = None
+            ctrans.ccdToQ(angles=setting_angles * np.pi / 180.0,
+                          mode=mode,
+                          ccd_size=self.detector_size,
+                          ccd_pixsize=self.pixel_size,
+                          ccd_cen=self.calibrated_center,
+                          dist=self.dist_sample,
+                          wavelength=wavelength,
+                          UBinv=np.matrix(ub).I,
+                          outarray=hkl,
+                          directions=directions,
+                          arm=arm)
+        t2 = time.time()
+        logger.info("Processing time for {0} {1} x {2} images took {3} "
+                    "seconds.".format(setting_angles.shape[0],
+                                      self.detector_size[0],
+                                      self.detector_size[1], (t2 - t1)))
+        return hkl
 
 
 def hkl_to_q(hkl_arr):
@@ -198,11 +702,18 @@ def hkl_to_q(hkl_arr):
     return np.linalg.norm(hkl_arr, axis=1)
 
 
-def calibrated_pixels_to_q(detector_size, pyfai_kwargs):
+def calibrated_pixels_to_q(detector_size, pyfai_kwargs, cache_dir=None,
+                           copy=True):
     """
     For a given detector and pyfai calibrated geometry give back the q value
     for each pixel in the detector.
 
+    The q maps are kept in the cache of the geometry grids of
+    `skxray.core.utils` (see `skxray.core.utils.set_grid_cache_limits`),
+    and in `cache_dir` if it is given, so the pyFAI geometry is only
+    computed once for each calibration. A copy of the cached map is
+    returned unless `copy` is False.
+
     Parameters
     -----------
     detector_size : tuple
@@ -212,11 +723,87 @@ def calibrated_pixels_to_q(detector_size, pyfai_kwargs):
         The dictionary of pyfai geometry kwargs, given by pyFAI's calibration
         Ex: dist, poni1, poni2, rot1, rot2, rot3, splineFile, wavelength,
         detector, pixel1, pixel2
+    cache_dir : str, optional
+        Directory to keep the q maps in between processes, as .npy files
+        named by a hash of the detector size and of the calibration
+        (including the contents of the spline file). The maps are read
+        back memory mapped.
+    copy : bool, optional
+        If False, return the cached map itself, which is read-only (memory
+        mapped if it was read from `cache_dir`) and shared with the other
+        callers, without copying it. Default is True.
 
     Returns
     -------
     q_val : ndarray
-        Reciprocal values for each pixel shape is [num_rows * num_columns]
+        Reciprocal values for each pixel shape is [num_rows * num_columns].
+    """
+    def make_q_map():
+        # pyFAI takes a while to import, so only when it is needed
+        from pyFAI import geometry as geo
+        a = geo.Geometry(**pyfai_kwargs)
+        return a.qArray(detector_size)
+
+    key = _q_map_key(detector_size, pyfai_kwargs)
+    if key is None:
+        # a calibration that can not be hashed, e.g. with a detector object
+        return make_q_map()
+    if cache_dir is None:
+        q_map = utils._grid_cache.get(('q_map', key), make_q_map)
+    else:
+        path = os.path.join(cache_dir, key + '.npy')
+        q_map = utils._grid_cache.get(('q_map', key),
+                                      lambda: _cached_q_map(path, make_q_map))
+    # a plain array, also for a memory mapped map
+    return np.array(q_map) if copy else q_map
+
+
+def _q_map_key(detector_size, pyfai_kwargs):
+    """
+    The hash of a detector size and pyFAI calibration, or None if the
+    calibration has values other than numbers and strings
+    """
+    items = [('detector_size', tuple(int(n) for n in detector_size))]
+    for name, value in sorted(pyfai_kwargs.items()):
+        if value is not None and not isinstance(
+                value, (numbers.Number, six.string_types)):
+            return None
+        items.append((name, value))
+    digest = hashlib.sha1(repr(items).encode('utf-8'))
+    spline = pyfai_kwargs.get('splineFile')
+    if spline:
+        with open(spline, 'rb') as f:
+            digest.update(f.read())
+    return 'qmap-' + digest.hexdigest()
+
+
+def _cached_q_map(path, make_q_map):
     """
-    a = geo.Geometry(**pyfai_kwargs)
-    return a.qArray(detector_size)
+    Read the q map at path, or make it and write it there, also in place
+    of a map which can not be read
+    """
+    try:
+        return np.load(path, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        if os.path.exists(path):
+            logger.warning("Could not read the q map %s, making it again",
+                           path)
+    q_map = make_q_map()
+    # write to a temporary file and rename it, so that other processes
+    # never read a partly written map
+    directory = os.path.dirname(path)
+    f = None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = tempfile.NamedTemporaryFile(dir=directory, suffix='.npy',
+                                        delete=False)
+        with f:
+            np.save(f, q_map)
+        os.rename(f.name, path)
+    except (IOError, OSError) as err:
+        # e.g. a read-only directory, or another process wrote it first
+        logger.debug("Could not write the q map to %s: %s", path, err)
+        if f is not None and os.path.exists(f.name):
+            os.remove(f.name)
+    return q_map
@@ -42,15 +42,226 @@ from __future__ import absolute_import, division, print_function
 
 import collections
 import logging
-import scipy.ndimage.measurements as ndim
 
 import numpy as np
+import scipy.sparse
 
 from . import utils
+from .correlation import extract_label_indices
 
 logger = logging.getLogger(__name__)
 
 
+class LabelIndex(object):
+    """
+    Precomputed index of the pixels of each ROI of a labeled array.
+
+    The pixels of the ROIs are sorted by label, so that each ROI is a
+    contiguous segment of the pixel list, and the runs of pixels with the
+    same label along the rows of the image are found. The statistics of
+    every ROI are then computed for a whole stack of images by reducing
+    the runs in place (without copying the pixels) and then the runs of
+    each label, instead of a pass over the image (or a ``labels == n``
+    mask) per ROI and per image. Build it once and pass
+    it in place of the labeled array to `mean_intensity`,
+    `mean_intensity_sets`, `roi_pixel_values`, `roi_max_counts` and
+    `roi_kymograph`.
+
+    Parameters
+    ----------
+    labels : array
+        labeled array; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
+
+    index : list, optional
+        labels list
+        eg: 5 ROI's
+        index = [1, 2, 3, 4, 5]
+        Default is every label from 1 to the largest label.
+
+    Attributes
+    ----------
+    pixel_list : array
+        indices into the raveled image of the pixels of each label in
+        `index`, one label after the other, in raster order in each label
+
+    offsets : array
+        the pixels of ``index[n]`` are
+        ``pixel_list[offsets[n]:offsets[n + 1]]``
+
+    num_pixels : array
+        number of pixels of each label in `index`
+
+    Examples
+    --------
+    >>> label_index = LabelIndex(labels)
+    >>> mean_int = label_index.mean(images)  # (num_img, num_labels)
+    >>> mean_int, index = mean_intensity(images, label_index)
+    """
+    def __init__(self, labels, index=None):
+        self.labels = np.asarray(labels)
+        self.shape = self.labels.shape
+        if index is None:
+            index = np.arange(1, np.max(self.labels) + 1)
+        self.index = np.asarray(index)
+
+        label_mask, pixel_list = extract_label_indices(self.labels)
+
+        # the position in index of the label of each pixel
+        order = np.argsort(self.index, kind='mergesort')
+        sorted_index = self.index[order]
+        found = np.searchsorted(sorted_index, label_mask)
+        in_index = found < len(sorted_index)
+        in_index[in_index] = (sorted_index[found[in_index]] ==
+                              label_mask[in_index])
+        position = order[found[in_index]]
+
+        # sort the pixels by position, keeping them in raster order
+        # within each label
+        sort = np.argsort(position, kind='mergesort')
+        self.pixel_list = pixel_list[in_index][sort]
+        self.num_pixels = np.bincount(position,
+                                      minlength=len(self.index))
+        self.offsets = np.concatenate(([0], np.cumsum(self.num_pixels)))
+
+        # the runs of pixels of the raveled image with the same position,
+        # and the runs of each label in index, one label after the other
+        flat_position = np.full(self.labels.size, -1, dtype=np.int64)
+        flat_position[pixel_list[in_index]] = position
+        self._run_starts = np.flatnonzero(np.diff(flat_position)) + 1
+        self._run_starts = np.concatenate(([0], self._run_starts))
+        run_position = flat_position[self._run_starts]
+        in_rois = np.flatnonzero(run_position >= 0)
+        self._run_order = in_rois[np.argsort(run_position[in_rois],
+                                             kind='mergesort')]
+        num_runs = np.bincount(run_position[in_rois],
+                               minlength=len(self.index))
+        self._run_offsets = np.concatenate(([0], np.cumsum(num_runs)[:-1]))
+
+    def pixel_values(self, images):
+        """
+        Gather the values of the pixels of the ROIs.
+
+        Parameters
+        ----------
+        images : array
+            image data dimensions are: (rr, cc), or a stack of images
+            dimensions are: (num_img, rr, cc)
+
+        Returns
+        -------
+        values : array
+            the values of the pixels in `pixel_list`, for each image
+            shape (len(pixel_list), ) or (num_img, len(pixel_list))
+        """
+        images = np.asarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError("Shape of the images should be equal to"
+                             " shape of the label array")
+        flat = images.reshape(images.shape[:-2] + (-1, ))
+        return flat[..., self.pixel_list]
+
+    def split(self, values):
+        """
+        Split pixel values, as from `pixel_values`, by label.
+
+        Returns
+        -------
+        roi_pix : list
+            the values of the pixels of each label in `index`
+        """
+        return np.split(values, self.offsets[1:-1], axis=-1)
+
+    def _reduce(self, ufunc, images, empty, dtype=None):
+        """
+        Reduce the pixels of each label with a ufunc, using `empty` for
+        the labels without any pixels.
+        """
+        images = np.asarray(images)
+        if images.shape[-2:] != self.shape:
+            raise ValueError("Shape of the images should be equal to"
+                             " shape of the label array")
+        flat = images.reshape(images.shape[:-2] + (-1, ))
+        result = np.empty(flat.shape[:-1] + (len(self.index), ),
+                          dtype=dtype or flat.dtype)
+        result[...] = empty
+        # reduceat can not reduce an empty segment
+        has_pixels = self.num_pixels > 0
+        if np.any(has_pixels):
+            runs = ufunc.reduceat(flat, self._run_starts, axis=-1,
+                                  dtype=dtype)
+            result[..., has_pixels] = ufunc.reduceat(
+                runs[..., self._run_order],
+                self._run_offsets[has_pixels], axis=-1)
+        return result
+
+    def sum(self, images):
+        """
+        Sum of the pixel values of each label.
+
+        Parameters
+        ----------
+        images : array
+            image data dimensions are: (rr, cc), or a stack of images
+            dimensions are: (num_img, rr, cc)
+
+        Returns
+        -------
+        sums : array
+            shape (len(index), ) or (num_img, len(index))
+        """
+        return self._reduce(np.add, images, 0, dtype=np.float64)
+
+    def mean(self, images):
+        """
+        Mean of the pixel values of each label, NaN for labels without
+        any pixels.
+
+        Parameters
+        ----------
+        images : array
+            image data dimensions are: (rr, cc), or a stack of images
+            dimensions are: (num_img, rr, cc)
+
+        Returns
+        -------
+        means : array
+            shape (len(index), ) or (num_img, len(index))
+        """
+        with np.errstate(invalid='ignore'):
+            return self.sum(images) / self.num_pixels
+
+    def max(self, images):
+        """
+        Largest pixel value of each label, 0 for labels without any
+        pixels.
+
+        Parameters
+        ----------
+        images : array
+            image data dimensions are: (rr, cc), or a stack of images
+            dimensions are: (num_img, rr, cc)
+
+        Returns
+        -------
+        max_values : array
+            shape (len(index), ) or (num_img, len(index))
+        """
+        return self._reduce(np.maximum, images, 0)
+
+
+def _label_index(labels, index=None):
+    """
+    Get a `LabelIndex` of the labels, re-using `labels` if it already is
+    one for the same index.
+    """
+    if isinstance(labels, LabelIndex):
+        if index is None or np.array_equal(index, labels.index):
+            return labels
+        labels = labels.labels
+    return LabelIndex(labels, index)
+
+
 def rectangles(coords, shape):
     """
     This function wil provide the indices array for rectangle region of
@@ -132,7 +343,7 @@ def rings(edges, center, shape):
         raise ValueError("edges are expected to be monotonically increasing, "
                          "giving inner and outer radii of each ring from "
                          "r=0 outward")
-    r_coord = utils.radial_grid(center, shape).ravel()
+    r_coord = utils.radial_grid(center, shape, copy=False).ravel()
     label_array = np.digitize(r_coord, edges, right=False)
     # Even elements of label_array are in the space between rings.
     label_array = (np.where(label_array % 2 != 0, label_array, 0) + 1) // 2
@@ -263,9 +474,9 @@ def segmented_rings(edges, segments, center, shape, offset_angle=0):
                          "giving inner and outer radii of each ring from "
                          "r=0 outward")
 
-    agrid = utils.angle_grid(center, shape)
+    agrid = utils.angle_grid(center, shape, copy=False)
 
-    agrid[agrid < 0] = 2*np.pi + agrid[agrid < 0]
+    agrid = np.where(agrid < 0, 2*np.pi + agrid, agrid)
 
     segments_is_list = isinstance(segments, collections.Iterable)
     if segments_is_list:
@@ -282,7 +493,7 @@ def segmented_rings(edges, segments, center, shape, offset_angle=0):
 
     label_array = np.zeros(shape, dtype=np.int64)
     # radius grid for the image_shape
-    rgrid = utils.radial_grid(center, shape)
+    rgrid = utils.radial_grid(center, shape, copy=False)
 
     # assign indices value according to angles then rings
     len_segments = len(segments)
@@ -294,7 +505,8 @@ def segmented_rings(edges, segments, center, shape, offset_angle=0):
     return label_array
 
 
-def roi_max_counts(images_sets, label_array):
+def roi_max_counts(images_sets, label_array, chunk_size=None,
+                   prefetch=False):
     """
     Return the brightest pixel in any ROI in any image in the image set.
 
@@ -304,19 +516,29 @@ def roi_max_counts(images_sets, label_array):
         iterable of 4D arrays
         shapes is: (len(images_sets), )
 
-    label_array : array
+    label_array : array or LabelIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
+    chunk_size : int, optional
+        number of images to process at a time, see `utils.image_chunks`
+
+    prefetch : bool, optional
+        If True, read the next chunk of images on a background thread.
+        Default is False.
+
     Returns
     -------
     max_counts : int
         maximum pixel counts
     """
+    label_index = _label_index(label_array)
     max_cts = 0
     for img_set in images_sets:
-        for img in img_set:
-            max_cts = max(max_cts, ndim.maximum(img, label_array))
+        for chunk in utils.image_chunks(img_set, chunk_size, prefetch):
+            values = label_index.pixel_values(chunk)
+            if values.size:
+                max_cts = max(max_cts, values.max())
     return max_cts
 
 
@@ -331,7 +553,7 @@ def roi_pixel_values(image, labels, index=None):
     image : array
         image data dimensions are: (rr, cc)
 
-    labels : array
+    labels : array or LabelIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
@@ -350,16 +572,14 @@ def roi_pixel_values(image, labels, index=None):
     if labels.shape != image.shape:
         raise ValueError("Shape of the image data should be equal to"
                          " shape of the labeled array")
-    if index is None:
-        index = np.arange(1, np.max(labels) + 1)
+    label_index = _label_index(labels, index)
 
-    roi_pix = []
-    for n in index:
-        roi_pix.append(image[labels == n])
-    return roi_pix, index
+    roi_pix = label_index.split(label_index.pixel_values(image))
+    return roi_pix, label_index.index
 
 
-def mean_intensity_sets(images_set, labels):
+def mean_intensity_sets(images_set, labels, chunk_size=None,
+                        prefetch=False):
     """
     Mean intensities for ROIS' of the labeled array for different image sets
 
@@ -370,10 +590,17 @@ def mean_intensity_sets(images_set, labels):
         shapes is: (len(images_sets), )
         one images_set is iterable of 2D arrays dimensions are: (rr, cc)
 
-    labels : array
+    labels : array or LabelIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
+    chunk_size : int, optional
+        number of images to process at a time, see `utils.image_chunks`
+
+    prefetch : bool, optional
+        If True, read the next chunk of images on a background thread.
+        Default is False.
+
     Returns
     -------
     mean_intensity_list : list
@@ -384,22 +611,26 @@ def mean_intensity_sets(images_set, labels):
         labels list for each image set
 
     """
+    label_index = _label_index(labels)
     return tuple(map(list,
-                     zip(*[mean_intensity(im,
-                                          labels) for im in images_set])))
+                     zip(*[mean_intensity(im, label_index,
+                                          chunk_size=chunk_size,
+                                          prefetch=prefetch)
+                           for im in images_set])))
 
 
-def mean_intensity(images, labels, index=None):
+def mean_intensity(images, labels, index=None, chunk_size=None,
+                   prefetch=False):
     """
     Mean intensities for ROIS' of the labeled array for set of images
 
     Parameters
     ----------
-    images : array
+    images : array or iterable of 2D arrays
         Intensity array of the images
         dimensions are: (num_img, num_rows, num_cols)
 
-    labels : array
+    labels : array or LabelIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
@@ -408,6 +639,13 @@ def mean_intensity(images, labels, index=None):
         eg: 5 ROI's
         index = [1, 2, 3, 4, 5]
 
+    chunk_size : int, optional
+        number of images to process at a time, see `utils.image_chunks`
+
+    prefetch : bool, optional
+        If True, read the next chunk of images on a background thread.
+        Default is False.
+
     Returns
     -------
     mean_intensity : array
@@ -415,17 +653,16 @@ def mean_intensity(images, labels, index=None):
         shape (len(images), number of labels)
 
     """
-    if labels.shape != images[0].shape[0:]:
-        raise ValueError("Shape of the images should be equal to"
-                         " shape of the label array")
-    if index is None:
-        index = np.arange(1, np.max(labels) + 1)
+    label_index = _label_index(labels, index)
 
-    mean_intensity = np.zeros((images.shape[0], index.shape[0]))
-    for n, img in enumerate(images):
-        mean_intensity[n] = ndim.mean(img, labels, index=index)
+    mean_intensity = [label_index.mean(chunk) for chunk in
+                      utils.image_chunks(images, chunk_size, prefetch)]
+    if mean_intensity:
+        mean_intensity = np.concatenate(mean_intensity)
+    else:
+        mean_intensity = np.zeros((0, len(label_index.index)))
 
-    return mean_intensity, index
+    return mean_intensity, label_index.index
 
 
 def combine_mean_intensity(mean_int_list, index_list):
@@ -459,16 +696,260 @@ def combine_mean_intensity(mean_int_list, index_list):
     return combine_mean_intensity
 
 
+class CircularAveragePlan(object):
+    """
+    Precomputed circular average (radial integration) for a fixed
+    geometry.
+
+    The radial bin of each pixel and the number of pixels in each bin
+    are computed once, so that each image is then integrated with a single
+    `np.bincount`. Use it to integrate many images with the same center,
+    shape and pixel size.
+
+    With `split_pixels`, instead of putting each pixel in the bin of its
+    center, the intensity of each pixel is spread evenly over the range
+    of radii that it covers, from its nearest to its farthest point from
+    the center, and split between the bins in proportion to the overlap.
+    This removes the aliasing of the coarse bins, so that accurate
+    profiles are obtained with few bins. The split is precomputed as a
+    sparse (CSR) matrix from the pixels to the bins, so a whole stack is
+    integrated with one sparse-dense matrix product.
+
+    Parameters
+    ----------
+    calibrated_center : tuple
+        The center in pixels-units (row, col)
+
+    shape : tuple
+        shape of the images (rr, cc)
+
+    nx : int, optional
+        number of bins
+
+    pixel_size : tuple, optional
+        The size of a pixel in real units. (height, width). (mm)
+
+    mask : array, optional
+        boolean array of the shape of the images, the pixels where it is
+        False are left out of the average
+
+    threshold : int, optional
+        threshold value to mask; only the bins with more than `threshold`
+        pixels are kept
+
+    split_pixels : bool, optional
+        If True, split the intensity of each pixel between the bins which
+        it overlaps. Default is False.
+
+    Attributes
+    ----------
+    bin_edges : array
+        edges of all of the bins, length nx + 1
+
+    counts : array
+        number of pixels in each bin, length nx; with `split_pixels`, the
+        sum of the fractions of the pixels in each bin
+
+    bin_centers : array
+        centers of the bins with more than `threshold` pixels
+
+    Examples
+    --------
+    >>> plan = CircularAveragePlan(calibrated_center, image.shape, nx=200)
+    >>> ring_averages = plan(image)
+    >>> ring_averages = plan.integrate_stack(images)  # (num_img, nbins)
+    """
+    def __init__(self, calibrated_center, shape, nx=100, pixel_size=None,
+                 mask=None, threshold=0, split_pixels=False):
+        self.shape = tuple(shape)
+        self.nx = nx
+        self.split_pixels = split_pixels
+        radial_val = np.ravel(utils.radial_grid(calibrated_center, shape,
+                                                pixel_size, copy=False))
+        if mask is None:
+            self._pixels = None
+        else:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != self.shape:
+                raise ValueError("Shape of the mask should be equal to"
+                                 " shape of the images")
+            self._pixels = np.flatnonzero(mask)
+            radial_val = radial_val[self._pixels]
+        if not len(radial_val):
+            raise ValueError("There are no pixels to average")
+
+        # the same bins as utils.bin_1D
+        self.bin_edges, self._bins = utils.uniform_bin_indices(radial_val,
+                                                               nx)
+        if split_pixels:
+            self._matrix = _split_pixel_matrix(calibrated_center,
+                                               self.shape, pixel_size,
+                                               self.bin_edges, self._pixels)
+            self.counts = np.asarray(self._matrix.sum(axis=1)).ravel()
+        else:
+            self.counts = np.bincount(self._bins, minlength=nx)
+
+        self._th_mask = self.counts > threshold
+        self.bin_centers = utils.bin_edges_to_centers(
+            self.bin_edges)[self._th_mask]
+
+    def _pixel_values(self, image):
+        """The values of the pixels of the image which are averaged"""
+        flat = np.ravel(image)
+        if self._pixels is not None:
+            flat = flat[self._pixels]
+        return flat
+
+    def __call__(self, image):
+        """
+        Circular average of an image.
+
+        Parameters
+        ----------
+        image : array
+            input image
+
+        Returns
+        -------
+        ring_averages : array
+            circular integration of intensity in each bin of `bin_centers`
+        """
+        if np.shape(image) != self.shape:
+            raise ValueError("Shape of the image should be equal to"
+                             " shape of the plan")
+        if self.split_pixels:
+            sums = self._matrix.dot(np.ravel(image))
+        else:
+            sums = np.bincount(self._bins, weights=self._pixel_values(image),
+                               minlength=self.nx)
+        return sums[self._th_mask] / self.counts[self._th_mask]
+
+    def integrate_stack(self, images, chunk_size=None, prefetch=False):
+        """
+        Circular average of each image of a stack.
+
+        Parameters
+        ----------
+        images : array or iterable of 2D arrays
+            dimensions are: (num_img, rr, cc)
+
+        chunk_size : int, optional
+            number of images to process at a time, see
+            `utils.image_chunks`
+
+        prefetch : bool, optional
+            If True, read the next chunk of images on a background thread.
+            Default is False.
+
+        Returns
+        -------
+        ring_averages : array
+            circular integration of intensity of each image,
+            shape (num_img, len(bin_centers))
+        """
+        ring_sums = []
+        for chunk in utils.image_chunks(images, chunk_size, prefetch):
+            if chunk.shape[1:] != self.shape:
+                raise ValueError("Shape of the images should be equal to"
+                                 " shape of the plan")
+            if self.split_pixels:
+                flat = chunk.reshape(len(chunk), -1)
+                ring_sums.extend(
+                    self._matrix.dot(flat.T).T[:, self._th_mask])
+                continue
+            # one bincount per image is faster than a single bincount of
+            # the whole chunk, which needs an index for every value
+            for img in chunk:
+                ring_sums.append(np.bincount(
+                    self._bins, weights=self._pixel_values(img),
+                    minlength=self.nx)[self._th_mask])
+        if not ring_sums:
+            return np.zeros((0, len(self.bin_centers)))
+        return np.array(ring_sums) / self.counts[self._th_mask]
+
+
+def _split_pixel_matrix(calibrated_center, shape, pixel_size, bin_edges,
+                        pixels=None):
+    """
+    Sparse matrix of the fraction of each pixel in each radial bin.
+
+    Each pixel covers the radii from its nearest to its farthest point
+    from the center, and its intensity is spread evenly over them.
+
+    Parameters
+    ----------
+    calibrated_center : tuple
+        The center in pixels-units (row, col)
+
+    shape : tuple
+        shape of the images (rr, cc)
+
+    pixel_size : tuple
+        The size of a pixel in real units. (height, width)
+
+    bin_edges : array
+        edges of the uniform radial bins
+
+    pixels : array, optional
+        indices of the raveled image of the pixels to use, default is all
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        shape (number of bins, number of pixels of the images)
+    """
+    if pixel_size is None:
+        pixel_size = (1, 1)
+    x = np.abs(pixel_size[1] * (np.arange(shape[1]) - calibrated_center[1]))
+    y = np.abs(pixel_size[0] * (np.arange(shape[0]) - calibrated_center[0]))
+    half_x, half_y = pixel_size[1] / 2, pixel_size[0] / 2
+    # nearest and farthest points of each pixel from the center
+    r_min = np.hypot(np.maximum(x - half_x, 0)[np.newaxis, :],
+                     np.maximum(y - half_y, 0)[:, np.newaxis]).ravel()
+    r_max = np.hypot((x + half_x)[np.newaxis, :],
+                     (y + half_y)[:, np.newaxis]).ravel()
+    if pixels is None:
+        pixels = np.arange(r_min.size)
+    else:
+        r_min, r_max = r_min[pixels], r_max[pixels]
+
+    nx = len(bin_edges) - 1
+    # the range of bins overlapped by each pixel
+    first = np.clip(np.searchsorted(bin_edges, r_min, side='right') - 1,
+                    0, nx - 1)
+    last = np.clip(np.searchsorted(bin_edges, r_max, side='left') - 1,
+                   0, nx - 1)
+    num_bins = last - first + 1
+
+    # one entry for each bin overlapped by each pixel
+    entry_pixel = np.repeat(np.arange(len(pixels)), num_bins)
+    entry_bin = (np.arange(len(entry_pixel)) -
+                 np.repeat(np.cumsum(num_bins) - num_bins, num_bins) +
+                 first[entry_pixel])
+    lo = np.maximum(r_min[entry_pixel], bin_edges[entry_bin])
+    hi = np.minimum(r_max[entry_pixel], bin_edges[entry_bin + 1])
+    fraction = np.maximum(hi - lo, 0) / (r_max - r_min)[entry_pixel]
+    keep = fraction > 0
+
+    return scipy.sparse.csr_matrix(
+        (fraction[keep], (entry_bin[keep], pixels[entry_pixel[keep]])),
+        shape=(nx, shape[0] * shape[1]))
+
+
 def circular_average(image, calibrated_center, threshold=0, nx=100,
-                     pixel_size=None):
+                     pixel_size=None, chunk_size=None, prefetch=False,
+                     split_pixels=False):
     """
     Circular average(radial integration) of the intensity distribution of
     the image data.
 
+    See `CircularAveragePlan` to integrate many images with the same
+    geometry.
+
     Parameters
     ----------
-    image : array
-        input image
+    image : array or iterable of 2D arrays
+        input image, or a sequence of images to average each of them
 
     calibrated_center : tuple
         The center in pixels-units (row, col)
@@ -482,6 +963,19 @@ def circular_average(image, calibrated_center, threshold=0, nx=100,
     pixel_size : tuple, optional
         The size of a pixel in real units. (height, width). (mm)
 
+    chunk_size : int, optional
+        number of images of a sequence to process at a time, see
+        `utils.image_chunks`
+
+    prefetch : bool, optional
+        If True, read the next chunk of images on a background thread.
+        Default is False.
+
+    split_pixels : bool, optional
+        If True, split the intensity of each pixel between the bins which
+        it overlaps instead of putting it in the bin of its center, see
+        `CircularAveragePlan`. Default is False.
+
     Returns
     -------
     bin_centers : array
@@ -489,22 +983,38 @@ def circular_average(image, calibrated_center, threshold=0, nx=100,
         shape [nx]
 
     ring_averages : array
-        circular integration of intensity
+        circular integration of intensity,
+        shape (num_img, len(bin_centers)) for a sequence of images
     """
-    radial_val = utils.radial_grid(calibrated_center, image.shape,
-                                   pixel_size)
-
-    bin_edges, sums, counts = utils.bin_1D(np.ravel(radial_val),
-                                           np.ravel(image), nx)
-    th_mask = counts > threshold
-    ring_averages = sums[th_mask] / counts[th_mask]
-
-    bin_centers = utils.bin_edges_to_centers(bin_edges)[th_mask]
-
-    return bin_centers, ring_averages
-
-
-def roi_kymograph(images, labels, num):
+    if (isinstance(image, (list, tuple)) and len(image) and
+            np.ndim(image[0]) < 2):
+        # one image as nested lists of numbers, not a sequence of rows
+        image = np.asarray(image)
+    if isinstance(image, np.ndarray) and image.ndim not in (2, 3):
+        raise ValueError("image must be an image or a stack of images, not "
+                         "an array of shape {0}".format(image.shape))
+    if hasattr(image, 'shape') and np.ndim(image) == 2:
+        plan = CircularAveragePlan(calibrated_center, image.shape, nx=nx,
+                                   pixel_size=pixel_size,
+                                   threshold=threshold,
+                                   split_pixels=split_pixels)
+        return plan.bin_centers, plan(image)
+
+    # the plan needs the shape of the images
+    chunks = utils.image_chunks(image, chunk_size, prefetch)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("There are no images to average")
+    plan = CircularAveragePlan(calibrated_center, first.shape[1:], nx=nx,
+                               pixel_size=pixel_size, threshold=threshold,
+                               split_pixels=split_pixels)
+    ring_averages = np.concatenate(
+        [plan.integrate_stack(first)] +
+        [plan.integrate_stack(chunk) for chunk in chunks])
+    return plan.bin_centers, ring_averages
+
+
+def roi_kymograph(images, labels, num, chunk_size=None, prefetch=False):
     """
     This function will provide data for graphical representation of pixels
     variation over time for required ROI.
@@ -515,13 +1025,20 @@ def roi_kymograph(images, labels, num):
         Intensity array of the images
         dimensions are: (num_img, num_rows, num_cols)
 
-    labels : array
+    labels : array or LabelIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
     num : int
         required ROI label
 
+    chunk_size : int, optional
+        number of images to process at a time, see `utils.image_chunks`
+
+    prefetch : bool, optional
+        If True, read the next chunk of images on a background thread.
+        Default is False.
+
     Returns
     -------
     roi_kymograph : array
@@ -529,9 +1046,22 @@ def roi_kymograph(images, labels, num):
         for required ROI
 
     """
+    label_index = _label_index(labels)
+    n = np.flatnonzero(label_index.index == num)
+    if len(n):
+        pixels = label_index.pixel_list[label_index.offsets[n[0]]:
+                                        label_index.offsets[n[0] + 1]]
+    else:
+        pixels = label_index.pixel_list[:0]
     roi_kymo = []
-    for n, img in enumerate(images):
-        roi_kymo.append((roi_pixel_values(img,
-                                          labels == num)[0])[0])
+    for chunk in utils.image_chunks(images, chunk_size, prefetch):
+        if chunk.shape[1:] != label_index.shape:
+            raise ValueError("Shape of the images should be equal to"
+                             " shape of the label array")
+        roi_kymo.append(chunk.reshape(len(chunk), -1)[:, pixels])
+    if roi_kymo:
+        roi_kymo = np.concatenate(roi_kymo)
+    else:
+        roi_kymo = np.zeros((0, len(pixels)))
 
     return np.matrix(roi_kymo)
@@ -34,10 +34,15 @@
 ########################################################################
 from __future__ import absolute_import, division, print_function
 import logging
+import os
+import shutil
+import tempfile
 
 import numpy as np
+import six
 from numpy.testing import (assert_array_almost_equal,
-                           assert_almost_equal)
+                           assert_almost_equal, assert_array_equal)
+from nose.tools import assert_equal, assert_raises
 from skimage import data
 
 import skxray.core.correlation as corr
@@ -90,3 +95,251 @@ def test_image_stack_correlation():
 
     assert_almost_equal(True, np.all(g2[:, 0], axis=0))
     assert_almost_equal(True, np.all(g2[:, 1], axis=0))
+
+
+def test_correlation_lags_match_direct():
+    num_bufs = 8
+    num_frames = 6
+    labels = np.zeros((10, 12), dtype=np.int64)
+    labels[1:4, 2:9] = 1
+    labels[5:9, 1:3] = 2
+    labels[6:8, 9:11] = 3
+    # interleave the labels so the ROIs are not contiguous in raster order
+    labels[0, ::2] = 2
+
+    img_stack = np.random.randint(1, 10, size=(num_frames, ) + labels.shape)
+
+    # exercise both the per-ROI product and the block reduction
+    default_min_pixels = corr._DOT_MIN_PIXELS
+    try:
+        corr._DOT_MIN_PIXELS = 1
+        g2_dot, _ = corr.multi_tau_auto_corr(1, num_bufs, labels, img_stack)
+        corr._DOT_MIN_PIXELS = labels.size + 1
+        g2, lag_steps = corr.multi_tau_auto_corr(1, num_bufs, labels,
+                                                 img_stack)
+    finally:
+        corr._DOT_MIN_PIXELS = default_min_pixels
+    assert_array_almost_equal(g2_dot, g2)
+
+    # with a single level and enough buffers every pair of frames is
+    # correlated, so g2 can be computed directly
+    assert_array_almost_equal(lag_steps, np.arange(num_frames))
+    for n in range(1, 4):
+        pix = img_stack[:, labels == n].astype(float)
+        for lag in range(num_frames):
+            past = pix[:num_frames - lag]
+            future = pix[lag:]
+            expected = (np.mean(past * future) /
+                        (np.mean(past) * np.mean(future)))
+            assert_almost_equal(g2[lag, n - 1], expected)
+
+
+def test_incremental_correlation():
+    num_levels = 3
+    num_bufs = 4
+    labels = roi.rectangles(np.array(([2, 2, 6, 5], [10, 3, 4, 8])),
+                            (20, 20))
+    img_stack = np.random.randint(1, 10, size=(40, ) + labels.shape)
+
+    g2, lag_steps = corr.multi_tau_auto_corr(num_levels, num_bufs, labels,
+                                             img_stack)
+
+    correlator = corr.MultiTauCorrelator(num_levels, num_bufs, labels)
+    g2_partial, lag_partial = correlator.results()
+    assert_equal(len(lag_partial), 0)
+
+    # add some of the images one at a time and check the partial results
+    for img in img_stack[:7]:
+        correlator.add_image(img)
+    g2_partial, lag_partial = correlator.results()
+    g2_expected, lag_expected = corr.multi_tau_auto_corr(
+        num_levels, num_bufs, labels, img_stack[:7])
+    assert_array_almost_equal(g2_partial, g2_expected)
+    assert_array_almost_equal(lag_partial, lag_expected)
+
+    # checkpoint, resume and add the rest as a chunk
+    checkpoint = six.BytesIO()
+    correlator.save(checkpoint)
+    checkpoint.seek(0)
+    resumed = corr.MultiTauCorrelator.load(checkpoint)
+    resumed.add_images(img_stack[7:])
+    assert_equal(resumed.num_images, len(img_stack))
+
+    g2_resumed, lag_resumed = resumed.results()
+    assert_array_almost_equal(g2_resumed, g2)
+    assert_array_almost_equal(lag_resumed, lag_steps)
+
+    assert_raises(ValueError, correlator.add_image, np.ones((3, 3)))
+
+
+def test_parallel_correlation():
+    num_levels = 3
+    num_bufs = 4
+    labels = roi.rings(roi.ring_edges(2, 3, num_rings=5), (20, 20), (40, 40))
+    # more images than fit in one shared buffer, and not a multiple of it
+    img_stack = np.random.randint(1, 10, size=(37, ) + labels.shape)
+
+    g2, lag_steps = corr.multi_tau_auto_corr(num_levels, num_bufs, labels,
+                                             img_stack)
+    for processes in (2, 3):
+        g2_par, lag_par = corr.multi_tau_auto_corr(num_levels, num_bufs,
+                                                   labels, iter(img_stack),
+                                                   processes=processes)
+        assert_array_almost_equal(g2_par, g2)
+        assert_array_almost_equal(lag_par, lag_steps)
+
+    # every ROI ends up in exactly one shard
+    shards = corr._shard_labels(labels, 3)
+    assert_equal(len(shards), 3)
+    assert_array_equal(np.sort(np.concatenate(shards)), np.arange(1, 6))
+
+
+def test_two_time_corr():
+    labels = np.zeros((8, 9), dtype=np.int64)
+    labels[1:4, 1:7] = 1
+    labels[5:8, 2:5] = 2
+    img_stack = np.random.randint(1, 10, size=(15, ) + labels.shape)
+
+    two_time = corr.two_time_corr(labels, img_stack, block_size=4)
+    assert_equal(two_time.shape, (2, 15, 15))
+    for n in (1, 2):
+        pix = img_stack[:, labels == n].astype(float)
+        expected = (np.dot(pix, pix.T) / pix.shape[1] /
+                    np.outer(pix.mean(axis=1), pix.mean(axis=1)))
+        assert_array_almost_equal(two_time[n - 1], expected, decimal=5)
+
+    # average pairs of images, from an iterator, into a memory-mapped file
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'two_time.dat')
+        two_time = corr.two_time_corr(labels, iter(img_stack), downsample=2,
+                                      block_size=3, filename=fname)
+        assert_equal(two_time.shape, (2, 7, 7))
+        pix = img_stack[:14, labels == 2].astype(float)
+        pix = (pix[::2] + pix[1::2]) / 2
+        expected = (np.dot(pix, pix.T) / pix.shape[1] /
+                    np.outer(pix.mean(axis=1), pix.mean(axis=1)))
+        assert_array_almost_equal(two_time[1], expected, decimal=5)
+        del two_time
+
+        # more images from an iterator than the series first has room for,
+        # in memory and in a temporary file
+        img_stack = np.random.randint(1, 10, size=(150, ) + labels.shape)
+        pix = img_stack[:, labels == 1].astype(float)
+        expected = (np.dot(pix, pix.T) / pix.shape[1] /
+                    np.outer(pix.mean(axis=1), pix.mean(axis=1)))
+        for filename in (None, fname):
+            two_time = corr.two_time_corr(labels, iter(img_stack),
+                                          block_size=64, filename=filename)
+            assert_array_almost_equal(two_time[0], expected, decimal=5)
+            del two_time
+        # the temporary file is removed
+        assert_equal(os.listdir(tmpdir), ['two_time.dat'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_compact_buffers():
+    num_levels = 4
+    num_bufs = 4
+    labels = roi.rings(roi.ring_edges(1, 3, num_rings=3), (15, 15), (30, 30))
+    img_stack = np.random.randint(0, 300, size=(30, ) + labels.shape)
+
+    g2, lag_steps = corr.multi_tau_auto_corr(num_levels, num_bufs, labels,
+                                             img_stack)
+
+    # both the per-ROI product and the block reduction
+    default_min_pixels = corr._DOT_MIN_PIXELS
+    try:
+        for min_pixels in (1, labels.size + 1):
+            corr._DOT_MIN_PIXELS = min_pixels
+            g2_compact, lag_compact = corr.multi_tau_auto_corr(
+                num_levels, num_bufs, labels, img_stack,
+                buf_dtype=np.uint16, level_dtype=np.float32)
+            assert_array_almost_equal(g2_compact / g2, 1, decimal=6)
+            assert_array_equal(lag_compact, lag_steps)
+    finally:
+        corr._DOT_MIN_PIXELS = default_min_pixels
+
+    correlator = corr.MultiTauCorrelator(num_levels, num_bufs, labels,
+                                         buf_dtype=np.uint8)
+    assert_equal(correlator.buf[0].dtype, np.uint8)
+    assert_equal(correlator.buf[1].dtype, np.float64)
+    correlator.add_image(np.ones(labels.shape))
+    too_bright = np.ones(labels.shape) * 256
+    assert_raises(ValueError, correlator.add_image, too_bright)
+    assert_raises(ValueError, correlator.add_image, too_bright / 512)
+
+    # the types are kept through a checkpoint
+    resumed = corr.MultiTauCorrelator.from_state(correlator.get_state())
+    assert_equal(resumed.buf[0].dtype, np.uint8)
+    assert_equal(resumed.num_images, 1)
+
+    assert_raises(ValueError, corr.MultiTauCorrelator, num_levels, num_bufs,
+                  labels, level_dtype=np.uint16)
+
+
+def test_compact_buffers_error():
+    # the relative error of g2 with float32 downsampled images is bounded
+    # by 4 * (level + 2) * 2**-24 at each level
+    num_levels = 7
+    num_bufs = 4
+    labels = roi.rings(roi.ring_edges(1, 3, num_rings=3), (15, 15), (30, 30))
+    rs = np.random.RandomState(5)
+    img_stack = rs.random_sample((2 ** num_levels * 3, ) + labels.shape)
+    img_stack = 1 + 100 * img_stack
+
+    g2, lag_steps = corr.multi_tau_auto_corr(num_levels, num_bufs, labels,
+                                             img_stack)
+    levels = np.concatenate((np.zeros(num_bufs, dtype=int),
+                             np.repeat(np.arange(1, num_levels),
+                                       num_bufs // 2)))
+    assert_equal(len(levels), len(lag_steps))
+    bound = 4 * (levels + 2) * 2. ** -24
+    for buf_dtype in (np.float64, np.float32):
+        g2_compact, _ = corr.multi_tau_auto_corr(
+            num_levels, num_bufs, labels, img_stack, buf_dtype=buf_dtype,
+            level_dtype=np.float32)
+        error = np.abs(g2_compact / g2 - 1).max(axis=1)
+        assert np.all(error <= bound), (error, bound)
+
+
+def test_sparse_correlation():
+    num_levels = 4
+    num_bufs = 4
+    labels = roi.rings(roi.ring_edges(1, 3, num_rings=3), (15, 15), (30, 30))
+    # mostly empty images, as at low count rates
+    img_stack = np.random.poisson(0.05, size=(30, ) + labels.shape)
+
+    g2, lag_steps = corr.multi_tau_auto_corr(num_levels, num_bufs, labels,
+                                             img_stack)
+    g2_sparse, lag_sparse = corr.multi_tau_auto_corr(
+        num_levels, num_bufs, labels, img_stack, sparse=True)
+    assert_array_almost_equal(g2_sparse, g2)
+    assert_array_equal(lag_sparse, lag_steps)
+
+    # the same images as event lists, in both modes
+    for sparse in (False, True):
+        correlator = corr.MultiTauCorrelator(num_levels, num_bufs, labels,
+                                             sparse=sparse)
+        for img in img_stack:
+            # one event per photon, in no particular order
+            indices = np.repeat(np.arange(img.size), img.ravel())
+            correlator.add_events(np.random.permutation(indices))
+        assert_array_almost_equal(correlator.results()[0], g2)
+
+    # checkpoint half way through the sparse correlation
+    correlator = corr.MultiTauCorrelator(num_levels, num_bufs, labels,
+                                         buf_dtype=np.uint8, sparse=True)
+    correlator.add_images(img_stack[:13])
+    checkpoint = six.BytesIO()
+    correlator.save(checkpoint)
+    checkpoint.seek(0)
+    resumed = corr.MultiTauCorrelator.load(checkpoint)
+    assert resumed.sparse
+    assert_equal(resumed.buf[0][0][1].dtype, np.uint8)
+    resumed.add_images(img_stack[13:])
+    assert_array_almost_equal(resumed.results()[0], g2)
+
+    assert_raises(ValueError, correlator.add_events, [labels.size])
+    assert_raises(ValueError, correlator.add_events, [0, 1], [1])
@@ -40,7 +40,9 @@ Differential Phase Contrast (DPC) imaging based on Fourier-shift fitting.
 from __future__ import absolute_import, division, print_function
 import numpy as np
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
-                           assert_almost_equal)
+                           assert_almost_equal, assert_equal,
+                           assert_array_less, assert_raises)
+from scipy import ndimage
 
 import skxray.core.dpc as dpc
 
@@ -102,7 +104,58 @@ def test_image_reduction():
     assert_array_equal(yline_bp, ysum_bp)
     assert_array_equal(xline_roi, xsum_roi)
     assert_array_equal(yline_roi, ysum_roi)
-    
+
+
+def test_image_reduction_stack():
+    rs = np.random.RandomState(0)
+    images = rs.randint(0, 100, (7, 10, 12))
+    bad_pixels = [(0, 1), (4, 4), (7, 8), (-1, 1)]
+    mask = rs.uniform(size=(10, 12)) > 0.1
+    roi = (3, 2, 5, 6)
+
+    # each image with its bad pixels and masked pixels zeroed
+    masked = images.copy()
+    masked[:, ~mask] = 0
+    for kwargs in [dict(), dict(roi=roi), dict(bad_pixels=bad_pixels),
+                   dict(roi=roi, bad_pixels=bad_pixels)]:
+        expected = [dpc.image_reduction(im, **kwargs) for im in images]
+        xlines, ylines = dpc.image_reduction_stack(images, **kwargs)
+        assert_array_equal(xlines, [x for x, _ in expected])
+        assert_array_equal(ylines, [y for _, y in expected])
+        # in chunks, from a generator, with the mask
+        expected = [dpc.image_reduction(im, **kwargs) for im in masked]
+        xlines, ylines = dpc.image_reduction_stack(
+            (im for im in images), mask=mask, chunk_size=3, **kwargs)
+        assert_array_equal(xlines, [x for x, _ in expected])
+        assert_array_equal(ylines, [y for _, y in expected])
+
+    # the sums are of the type np.sum gives
+    for dtype in (np.uint16, np.int32, np.float32, np.float64):
+        xlines, ylines = dpc.image_reduction_stack(images.astype(dtype),
+                                                   roi, bad_pixels, mask)
+        assert_equal(xlines.dtype, np.sum(images.astype(dtype)).dtype)
+        assert_equal(ylines.dtype, xlines.dtype)
+        xline, yline = dpc.image_reduction(images[0].astype(dtype), roi,
+                                           bad_pixels)
+        assert_equal(xline.dtype, xlines.dtype)
+
+    # non-finite bad and masked pixels are left out of the sums
+    im = np.arange(20.).reshape(4, 5)
+    im[1, 2] = np.nan
+    im[2, 3] = np.inf
+    xline, yline = dpc.image_reduction(im, bad_pixels=[(1, 2), (2, 3)])
+    assert_array_equal(xline, [30, 34, 31, 29, 46])
+    assert_array_equal(yline, [10, 28, 47, 85])
+    xlines, ylines = dpc.image_reduction_stack([im, -im],
+                                               mask=np.isfinite(im))
+    assert_array_equal(xlines, [[30, 34, 31, 29, 46],
+                                [-30, -34, -31, -29, -46]])
+    assert_array_equal(ylines, [[10, 28, 47, 85], [-10, -28, -47, -85]])
+
+    assert_raises(ValueError, dpc.image_reduction_stack, images,
+                  mask=mask[:5])
+    assert_raises(ValueError, dpc.image_reduction_stack, [])
+
 
 def test_rss_factory():
     """
@@ -160,6 +213,122 @@ def test_dpc_fit():
     assert_array_almost_equal(res, v)
     
     
+def test_dpc_fit_batch():
+    start_point = [1, 0]
+    length = 100
+    xdata = np.arange(length)
+    beta = 1j * (np.arange(length) - length//2)
+    rss = dpc._rss_factory(length)
+    v = np.array([[1.02, -0.00023], [0.88, -0.0048], [0.98, 0.0068],
+                  [0.95, 0.0032], [1, 0]])
+    ydata = xdata * v[:, :1] * np.exp(v[:, 1:] * beta)
+    assert_array_almost_equal(dpc.dpc_fit_batch(xdata, ydata, start_point),
+                              v)
+
+    # the same fits as dpc_fit with noise
+    rs = np.random.RandomState(0)
+    ydata = ydata + rs.normal(0, 1, ydata.shape) + 1j * rs.normal(
+        0, 1, ydata.shape)
+    res = dpc.dpc_fit_batch(xdata, ydata, start_point)
+    for y, r in zip(ydata, res):
+        assert_array_almost_equal(r, dpc.dpc_fit(rss, xdata, y, start_point),
+                                  decimal=5)
+    assert_raises(ValueError, dpc.dpc_fit_batch, xdata, ydata[:, :10],
+                  start_point)
+
+
+def test_dpc_fit_fft():
+    start_point = [1, 0]
+    rs = np.random.RandomState(0)
+    for length in [100, 101]:
+        xdata = np.arange(length)
+        beta = 1j * np.linspace(-(length-1)//2, (length-1)//2, length)
+        v = np.array([[1.02, -0.00023], [0.88, -0.0048], [0.98, 0.0068],
+                      [0.95, 0.0032], [1, 0], [0.9, 0.4]])
+        ydata = xdata * v[:, :1] * np.exp(v[:, 1:] * beta)
+        assert_array_almost_equal(dpc.dpc_fit_fft(xdata, ydata), v)
+
+        # the least squares fits, as dpc_fit_batch, with noise; the last
+        # phase gradient is too far from the start point for dpc_fit_batch
+        ydata = ydata + rs.normal(0, 1, ydata.shape) + 1j * rs.normal(
+            0, 1, ydata.shape)
+        res = dpc.dpc_fit_fft(xdata, ydata)
+        assert_array_almost_equal(
+            res[:-1], dpc.dpc_fit_batch(xdata, ydata[:-1], start_point),
+            decimal=5)
+        assert_array_almost_equal(res[-1], v[-1], decimal=2)
+        # the grid estimates, within a grid step
+        res = dpc.dpc_fit_fft(xdata, ydata, upsample=8, newton_iters=0)
+        assert_array_less(np.abs(res[:, 1] - v[:, 1]),
+                          2 * np.pi / (8 * length))
+    assert_raises(ValueError, dpc.dpc_fit_fft, xdata, ydata[:, :10])
+    assert_raises(ValueError, dpc.dpc_fit_fft, xdata, ydata, 0)
+
+
+def test_dpc_runner_solvers():
+    # a scan over a sample which shifts and attenuates the beam
+    scan_rows, scan_cols = 3, 4
+    yy, xx = np.mgrid[:30, :40]
+    ref_image = np.exp(-((xx - 20)**2 + (yy - 15)**2) / 50.)
+    rs = np.random.RandomState(1)
+    shifts = rs.uniform(-0.5, 0.5, (scan_rows * scan_cols, 2))
+    image_sequence = [rs.uniform(0.8, 1) * ndimage.shift(ref_image, shift)
+                      for shift in shifts]
+    args = (ref_image, image_sequence, [1, 0], (55, 55), 1.46e6, scan_rows,
+            scan_cols, 0.1, 0.1, 19.5)
+
+    phase, amplitude = dpc.dpc_runner(*args)
+    # chunked, in a pool of processes, or fitted in batches
+    for kwargs in [dict(chunk_size=5), dict(processes=2, chunk_size=5),
+                   dict(solver='LM'), dict(solver='LM', chunk_size=5),
+                   dict(solver='FFT', chunk_size=5)]:
+        result = dpc.dpc_runner(*args, **kwargs)
+        assert_array_almost_equal(result[0], phase, decimal=3)
+        assert_array_almost_equal(result[1], amplitude, decimal=4)
+
+
+def test_dpc_reconstructor():
+    scan_rows, scan_cols = 3, 4
+    yy, xx = np.mgrid[:30, :40]
+    ref_image = np.exp(-((xx - 20)**2 + (yy - 15)**2) / 50.)
+    rs = np.random.RandomState(2)
+    image_sequence = [rs.uniform(0.8, 1) *
+                      ndimage.shift(ref_image, rs.uniform(-0.5, 0.5, 2))
+                      for _ in range(scan_rows * scan_cols)]
+    args = (ref_image, [1, 0], (55, 55), 1.46e6, scan_rows, scan_cols, 0.1,
+            0.1, 19.5)
+    phase, amplitude = dpc.dpc_runner(args[0], iter(image_sequence),
+                                      *args[1:], solver='LM')
+
+    # the frames in any order, the first half one at a time and by (row,
+    # column), the rest together
+    dpc_stream = dpc.DPCReconstructor(*args)
+    order = rs.permutation(scan_rows * scan_cols)
+    for index in order[:6]:
+        dpc_stream.add_frame(np.unravel_index(index, (scan_rows, scan_cols)),
+                             image_sequence[index])
+    filled = np.zeros(scan_rows * scan_cols, dtype=bool)
+    filled[order[:6]] = True
+    assert_array_equal(dpc_stream.filled.ravel(), filled)
+    assert_array_almost_equal(dpc_stream.amplitude.ravel()[filled],
+                              amplitude.ravel()[filled])
+    assert_equal(dpc_stream.amplitude.ravel()[~filled], 0)
+    # the phase of the points so far
+    gx, gy = dpc_stream.gradients()
+    assert_equal(gx.ravel()[~filled], 0)
+    assert_array_almost_equal(dpc_stream.phase(),
+                              dpc.recon(gx, gy, 0.1, 0.1, 0, 0.5))
+
+    dpc_stream.add_frames(order[6:], [image_sequence[i] for i in order[6:]])
+    assert dpc_stream.filled.all()
+    assert_array_almost_equal(dpc_stream.phase(), phase)
+    assert_array_almost_equal(dpc_stream.amplitude, amplitude)
+
+    assert_raises(ValueError, dpc_stream.add_frame, 12, image_sequence[0])
+    assert_raises(ValueError, dpc_stream.add_frames, [0, 1],
+                  image_sequence[:1])
+
+
 def test_dpc_end_to_end():
     """
     Integrated test for DPC based on dpc_runner.
@@ -195,6 +364,68 @@ def test_dpc_end_to_end():
     assert_array_almost_equal(a, np.ones((scan_rows, scan_cols)))
 
 
+def _recon_fftshift(gx, gy, scan_xstep, scan_ystep, padding, weighting):
+    """recon with full, shifted FFTs of gradients padded in the middle"""
+    pad = 2 * padding + 1
+    rows, cols = gx.shape
+    pad_row, pad_col = rows * pad, cols * pad
+    roi_slice = (slice(padding * rows, (padding + 1) * rows),
+                 slice(padding * cols, (padding + 1) * cols))
+    gx_padding = np.zeros((pad_row, pad_col))
+    gy_padding = np.zeros((pad_row, pad_col))
+    gx_padding[roi_slice] = gx
+    gy_padding[roi_slice] = gy
+    tx = np.fft.fftshift(np.fft.fft2(gx_padding))
+    ty = np.fft.fftshift(np.fft.fft2(gy_padding))
+    mid_col = pad_col // 2 + 1
+    mid_row = pad_row // 2 + 1
+    ax = (2 * np.pi * np.arange(1 - mid_col, pad_col - mid_col + 1) /
+          (pad_col * scan_xstep))
+    ay = (2 * np.pi * np.arange(1 - mid_row, pad_row - mid_row + 1) /
+          (pad_row * scan_ystep))
+    kappax, kappay = np.meshgrid(ax, ay)
+    div_v = kappax ** 2 * (1 - weighting) + kappay ** 2 * weighting
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = -1j * (kappax * tx * (1 - weighting) +
+                   kappay * ty * weighting) / div_v
+    c = np.fft.ifftshift(np.where(div_v == 0, 0, c))
+    return np.fft.ifft2(c)[roi_slice].real
+
+
+def test_recon():
+    from skxray.core import utils
+    utils.clear_grid_cache()
+    rs = np.random.RandomState(3)
+    for shape in [(8, 6), (7, 5), (6, 9)]:
+        gx = rs.randn(*shape)
+        gy = rs.randn(*shape)
+        for padding in [0, 1, 2]:
+            for weighting in [0, 0.3, 1]:
+                expected = _recon_fftshift(gx, gy, 0.1, 0.2, padding,
+                                           weighting)
+                assert_array_almost_equal(
+                    dpc.recon(gx, gy, 0.1, 0.2, padding, weighting),
+                    expected, decimal=10)
+                phase = dpc.PhaseReconstructor(shape, 0.1, 0.2, padding,
+                                               weighting)
+                assert_array_almost_equal(phase(gx, gy), expected,
+                                          decimal=10)
+                # the kernels are reused
+                assert_array_almost_equal(phase(gy, gx),
+                                          _recon_fftshift(gy, gx, 0.1, 0.2,
+                                                          padding,
+                                                          weighting),
+                                          decimal=10)
+    # the kernels are kept apart from the geometry grids
+    assert len(utils._grid_cache) == 0
+    assert len(dpc._kernel_cache) == 2
+
+    assert_raises(ValueError, dpc.recon, gx, gy, 0.1, 0.1, 0, 1.5)
+    assert_raises(ValueError, dpc.PhaseReconstructor, gx.shape, 0.1, 0.1,
+                  0, -0.5)
+    assert_raises(ValueError, phase, gx.T, gy.T)
+
+
 if __name__ == "__main__":
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
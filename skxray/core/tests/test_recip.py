@@ -33,13 +33,18 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import sys
+import tempfile
+import types
 import six
 import numpy as np
 import numpy.testing as npt
 from nose.tools import raises
 
 from skxray.testing.decorators import known_fail_if
-from skxray.core import recip
+from skxray.core import recip, utils
 
 
 @known_fail_if(six.PY3)
@@ -126,6 +131,143 @@ def test_frame_mode_fail():
         yield _process_to_q_exception, pdict, fails
 
 
+def test_calibrated_pixels_to_q():
+    from pyFAI import geometry as geo
+    pyfai_kwargs = dict(dist=0.1, poni1=0.01, poni2=0.012, rot1=0.01,
+                        pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    detector_size = (200, 300)
+    expected = geo.Geometry(**pyfai_kwargs).qArray(detector_size)
+    utils.clear_grid_cache()
+
+    q = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs,
+                                     copy=False)
+    npt.assert_array_almost_equal(q, expected)
+    assert not q.flags.writeable
+    # the same calibration gives back the same map, or a copy of it
+    assert recip.calibrated_pixels_to_q(detector_size, dict(pyfai_kwargs),
+                                        copy=False) is q
+    q_copy = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs)
+    assert q_copy.flags.writeable
+    npt.assert_array_equal(q_copy, q)
+    q2 = recip.calibrated_pixels_to_q(detector_size,
+                                      dict(pyfai_kwargs, rot1=0.02),
+                                      copy=False)
+    assert q2 is not q
+    assert np.any(q2 != q)
+
+    # on disk, for other processes
+    cache_dir = tempfile.mkdtemp()
+    try:
+        utils.clear_grid_cache()
+        q = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs,
+                                         cache_dir=cache_dir)
+        files = os.listdir(cache_dir)
+        npt.assert_equal(len(files), 1)
+        utils.clear_grid_cache()
+        from_disk = recip.calibrated_pixels_to_q(
+            detector_size, pyfai_kwargs, cache_dir=cache_dir, copy=False)
+        assert isinstance(from_disk, np.memmap)
+        npt.assert_array_equal(from_disk, expected)
+        npt.assert_equal(os.listdir(cache_dir), files)
+        del from_disk
+
+        # a truncated map is made again, and replaced
+        path = os.path.join(cache_dir, files[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) // 2)
+        utils.clear_grid_cache()
+        q = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs,
+                                         cache_dir=cache_dir)
+        npt.assert_array_almost_equal(q, expected)
+        npt.assert_equal(os.listdir(cache_dir), files)
+        npt.assert_array_almost_equal(np.load(path), expected)
+    finally:
+        utils.clear_grid_cache()
+        shutil.rmtree(cache_dir)
+
+
+class _StubGeometry(object):
+    """Stands in for pyFAI.geometry.Geometry, counting the q maps made"""
+    made = 0
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def qArray(self, shape):
+        _StubGeometry.made += 1
+        return np.arange(np.prod(shape), dtype=float).reshape(
+            shape) * self.kwargs['dist']
+
+
+def _stub_pyfai():
+    """Replace pyFAI.geometry with _StubGeometry, returns the undo"""
+    saved = dict((name, sys.modules.get(name))
+                 for name in ('pyFAI', 'pyFAI.geometry'))
+    geometry = types.ModuleType('pyFAI.geometry')
+    geometry.Geometry = _StubGeometry
+    pyfai = types.ModuleType('pyFAI')
+    pyfai.geometry = geometry
+    sys.modules.update({'pyFAI': pyfai, 'pyFAI.geometry': geometry})
+
+    def undo():
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    return undo
+
+
+def test_calibrated_pixels_to_q_cache():
+    # the caching, with a stub pyFAI
+    undo = _stub_pyfai()
+    cache_dir = tempfile.mkdtemp()
+    detector_size = (20, 30)
+    pyfai_kwargs = dict(dist=0.1, poni1=0.01, wavelength=1e-10)
+    expected = np.arange(600.).reshape(detector_size) * 0.1
+    try:
+        utils.clear_grid_cache()
+        _StubGeometry.made = 0
+        q = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs)
+        npt.assert_array_equal(q, expected)
+        recip.calibrated_pixels_to_q(detector_size, dict(pyfai_kwargs))
+        npt.assert_equal(_StubGeometry.made, 1)
+
+        # written to cache_dir, and read back from it
+        utils.clear_grid_cache()
+        recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs,
+                                     cache_dir=cache_dir)
+        npt.assert_equal(len(os.listdir(cache_dir)), 1)
+        utils.clear_grid_cache()
+        q = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs,
+                                         cache_dir=cache_dir)
+        npt.assert_array_equal(q, expected)
+        npt.assert_equal(_StubGeometry.made, 2)
+        # a writeable copy of the memory mapped map, unless copy is False
+        assert not isinstance(q, np.memmap)
+        q += 1
+        q = recip.calibrated_pixels_to_q(detector_size, pyfai_kwargs,
+                                         cache_dir=cache_dir, copy=False)
+        assert isinstance(q, np.memmap)
+        assert not q.flags.writeable
+        npt.assert_array_equal(q, expected)
+
+        # a cache_dir which can not be written to still gives the q map
+        not_a_dir = os.path.join(cache_dir, 'not_a_dir')
+        open(not_a_dir, 'w').close()
+        for directory in (not_a_dir, os.path.join(not_a_dir, 'sub')):
+            utils.clear_grid_cache()
+            q = recip.calibrated_pixels_to_q(
+                detector_size, dict(pyfai_kwargs, dist=0.2),
+                cache_dir=directory)
+            npt.assert_array_equal(q, 2 * expected)
+        npt.assert_equal(len(os.listdir(cache_dir)), 2)
+    finally:
+        undo()
+        utils.clear_grid_cache()
+        shutil.rmtree(cache_dir)
+
+
 def test_hkl_to_q():
     b = np.array([[-4, -3, -2],
                   [-1, 0, 1],
@@ -138,6 +280,243 @@ def test_hkl_to_q():
     npt.assert_array_almost_equal(b_norm, recip.hkl_to_q(b))
 
 
+def test_process_to_q_numpy():
+    # the numpy implementation, used when ctrans is not available
+    pdict = dict(detector_size=(256, 256), pixel_size=(0.0135*8, 0.0135*8),
+                 calibrated_center=(256/2.0, 256/2.0), dist_sample=355.0,
+                 wavelength=12398.4 / 640,
+                 ub=np.array([[-0.01231028454, 0.7405370482, 0.06323870032],
+                              [0.4450897473, 0.04166852402, -0.9509449389],
+                              [-0.7449130975, 0.01265920962, -0.5692399963]]))
+    setting_angles = np.array([[40., 15., 30., 25., 10., 5.],
+                               [90., 60., 0., 30., 10., 5.],
+                               [40., 16., 31., 25., 11., 5.]])
+    img_stack = np.random.RandomState(2).random_sample((3, 256, 256))
+    frame_modes = ['theta', 'phi', 'cart', 'hkl']
+    ctrans = recip.ctrans
+    try:
+        recip.ctrans = None
+        hkl = dict((frame_mode, recip.process_to_q(
+            setting_angles, frame_mode=frame_mode, **pdict))
+            for frame_mode in frame_modes)
+        geometry = recip.DetectorGeometry(*[pdict[k] for k in (
+            'detector_size', 'pixel_size', 'calibrated_center',
+            'dist_sample')])
+        from_geometry = geometry.process_to_q(
+            setting_angles, pdict['wavelength'], pdict['ub'])
+        grid = recip.process_to_grid(setting_angles, img_stack=img_stack,
+                                     dqn=(5, 6, 7), **pdict)
+    finally:
+        recip.ctrans = ctrans
+
+    # Known HKL values for the given six angles, as in test_process_to_q
+    known_hkl = [(32896, np.array([-0.15471196, 0.19673939, -0.11440936])),
+                 (98432, np.array([0.10205953,  0.45624416, -0.27200778]))]
+    for pixel, kn_hkl in known_hkl:
+        npt.assert_array_almost_equal(hkl['hkl'][pixel], kn_hkl, decimal=8)
+    npt.assert_array_almost_equal(from_geometry, hkl['hkl'])
+    expected = utils.Grid3DAccumulator(grid[4][:, 0], grid[4][:, 1],
+                                       grid[4][:, 2])
+    expected.add(hkl['hkl'], img_stack)
+    for value, expected_value in zip(grid, expected.finalize()):
+        npt.assert_array_almost_equal(value, expected_value)
+    npt.assert_equal(grid[1].sum() + grid[3], img_stack.size)
+
+    if ctrans is not None:
+        # the same as ctrans
+        for frame_mode in frame_modes:
+            npt.assert_array_almost_equal(
+                hkl[frame_mode],
+                recip.process_to_q(setting_angles, frame_mode=frame_mode,
+                                   **pdict), decimal=12)
+
+
+@known_fail_if(six.PY3)
+def test_process_to_q_out():
+    pdict = dict(detector_size=(40, 30), pixel_size=(0.0135*8, 0.0135*8),
+                 calibrated_center=(20.5, 14.5), dist_sample=355.0,
+                 wavelength=12398.4 / 640,
+                 ub=np.array([[-0.01231028454, 0.7405370482, 0.06323870032],
+                              [0.4450897473, 0.04166852402, -0.9509449389],
+                              [-0.7449130975, 0.01265920962, -0.5692399963]]))
+    setting_angles = np.array([[40., 15., 30., 25., 10., 5.],
+                               [90., 60., 0., 30., 10., 5.],
+                               [41., 15., 30., 25., 10., 6.]])
+    hkl = recip.process_to_q(setting_angles, **pdict)
+    npt.assert_equal(hkl.shape, (3 * 40 * 30, 3))
+    assert hkl.flags.c_contiguous
+
+    # float32
+    hkl32 = recip.process_to_q(setting_angles, dtype=np.float32, **pdict)
+    assert hkl32.dtype == np.float32
+    npt.assert_array_almost_equal(hkl32, hkl, decimal=6)
+
+    # into a given array, e.g. the one of the previous scan
+    for dtype in (np.float64, np.float32):
+        out = np.zeros_like(hkl, dtype=dtype)
+        assert recip.process_to_q(setting_angles, out=out, **pdict) is out
+        npt.assert_array_almost_equal(out, hkl, decimal=6)
+    geometry = recip.DetectorGeometry(**dict((k, pdict[k]) for k in (
+        'detector_size', 'pixel_size', 'calibrated_center', 'dist_sample')))
+    assert geometry.process_to_q(setting_angles, pdict['wavelength'],
+                                 pdict['ub'], out=out) is out
+    npt.assert_array_almost_equal(out, hkl, decimal=6)
+
+    # into a memmap
+    with tempfile.NamedTemporaryFile() as f:
+        out = np.memmap(f.name, dtype=np.float32, mode='w+',
+                        shape=hkl.shape)
+        recip.process_to_q(setting_angles, out=out, **pdict)
+        out.flush()
+        npt.assert_array_almost_equal(
+            np.fromfile(f.name, dtype=np.float32).reshape(hkl.shape), hkl,
+            decimal=6)
+
+    # '>f8' and '>f4' on little-endian machines
+    swapped = [np.dtype(t).newbyteorder() for t in (np.float64, np.float32)]
+    for out, dtype in [(np.zeros((10, 3)), None),
+                       (np.zeros_like(hkl), np.float32),
+                       (np.zeros((len(hkl), 6))[:, ::2], None),
+                       (np.zeros_like(hkl, dtype=int), None),
+                       (np.zeros_like(hkl, dtype=swapped[0]), None),
+                       (np.zeros_like(hkl, dtype=swapped[1]), None)]:
+        npt.assert_raises(ValueError, recip.process_to_q, setting_angles,
+                          out=out, dtype=dtype, **pdict)
+
+    # byte-swapped arrays are refused by ctrans itself too
+    for dtype in swapped:
+        npt.assert_raises(ValueError, recip.ctrans.ccdToQ,
+                          angles=setting_angles * np.pi / 180.0, mode=4,
+                          ccd_size=pdict['detector_size'],
+                          ccd_pixsize=pdict['pixel_size'],
+                          ccd_cen=pdict['calibrated_center'],
+                          dist=pdict['dist_sample'],
+                          wavelength=pdict['wavelength'],
+                          UBinv=np.matrix(pdict['ub']).I,
+                          outarray=np.zeros_like(hkl, dtype=dtype))
+
+    # directions without the arm setting of each image
+    for arm in [{}, {'arm': None}]:
+        npt.assert_raises(ValueError, recip.ctrans.ccdToQ,
+                          angles=np.zeros((1, 6)), mode=1, ccd_size=(4, 5),
+                          ccd_pixsize=(1., 1.), ccd_cen=(2., 2.), dist=100.,
+                          wavelength=1., UBinv=np.eye(3),
+                          directions=np.zeros((1, 20, 3)), **arm)
+
+
+@known_fail_if(six.PY3)
+def test_detector_geometry():
+    pdict = dict(detector_size=(40, 30), pixel_size=(0.0135*8, 0.0135*8),
+                 calibrated_center=(20.5, 14.5), dist_sample=355.0)
+    wavelength = 12398.4 / 640
+    ub = np.array([[-0.01231028454, 0.7405370482, 0.06323870032],
+                   [0.4450897473, 0.04166852402, -0.9509449389],
+                   [-0.7449130975, 0.01265920962, -0.5692399963]])
+    # a theta rocking scan with the detector arm at two settings
+    setting_angles = np.array([[40., 15., 30., 25., 10., 5.],
+                               [40., 15.5, 30., 25., 10., 5.],
+                               [42., 16., 30., 25., 10., 6.],
+                               [40., 16.5, 30., 25., 10., 5.]])
+    geometry = recip.DetectorGeometry(max_settings=2, **pdict)
+    for frame_mode in ['theta', 'phi', 'cart', 'hkl']:
+        expected = recip.process_to_q(setting_angles, wavelength=wavelength,
+                                      ub=ub, frame_mode=frame_mode, **pdict)
+        hkl = geometry.process_to_q(setting_angles, wavelength, ub,
+                                    frame_mode=frame_mode)
+        npt.assert_array_almost_equal(hkl, expected, decimal=12)
+    # the directions of the arm settings are kept stacked
+    stack_key = ('stack', ((40., 5.), (42., 6.)))
+    stack = geometry._directions.get(stack_key, None)
+    npt.assert_equal(stack.shape, (2, 40 * 30, 3))
+    geometry.process_to_q(setting_angles, wavelength, ub)
+    assert geometry._directions.get(stack_key, None) is stack
+    directions = geometry.directions(40., 5.)
+    assert not directions.flags.writeable
+    assert geometry.directions(40, 5) is directions
+    npt.assert_equal(directions.shape, (40 * 30, 3))
+    npt.assert_array_almost_equal(np.sum(directions**2, axis=1), 1)
+
+    # more arm settings than are kept
+    setting_angles[:, 0] += np.arange(4)
+    expected = recip.process_to_q(setting_angles, wavelength=wavelength,
+                                  ub=ub, **pdict)
+    hkl = geometry.process_to_q(setting_angles, wavelength, ub)
+    npt.assert_array_almost_equal(hkl, expected, decimal=12)
+
+    # the directions kept, stacked or not, fit in max_bytes
+    setting_bytes = 40 * 30 * 24
+    setting_angles[:, 0] = [40., 40., 42., 40.]
+    expected = recip.process_to_q(setting_angles, wavelength=wavelength,
+                                  ub=ub, **pdict)
+    for max_bytes in (setting_bytes, 2 * setting_bytes, 3 * setting_bytes,
+                      5 * setting_bytes):
+        geometry = recip.DetectorGeometry(max_bytes=max_bytes, **pdict)
+        for _ in range(2):
+            hkl = geometry.process_to_q(setting_angles, wavelength, ub)
+            npt.assert_array_almost_equal(hkl, expected, decimal=12)
+            assert geometry._directions.nbytes <= max_bytes
+    # the stack and the directions of each setting both fit
+    npt.assert_equal(geometry._directions.nbytes, 4 * setting_bytes)
+
+
+@known_fail_if(six.PY3)
+def test_process_to_grid():
+    pdict = dict(detector_size=(40, 30), pixel_size=(0.0135*8, 0.0135*8),
+                 calibrated_center=(20.5, 14.5), dist_sample=355.0,
+                 wavelength=12398.4 / 640,
+                 ub=np.array([[-0.01231028454, 0.7405370482, 0.06323870032],
+                              [0.4450897473, 0.04166852402, -0.9509449389],
+                              [-0.7449130975, 0.01265920962, -0.5692399963]]))
+    setting_angles = np.array([[40., 15., 30., 25., 10., 5.],
+                               [41., 15.5, 30., 25., 10., 5.],
+                               [42., 16., 30., 25., 10., 5.]])
+    rs = np.random.RandomState(3)
+    img_stack = rs.random_sample((3, 30, 40))
+    mask = rs.random_sample((30, 40)) > 0.2
+    dqn = (6, 7, 8)
+
+    hkl = recip.process_to_q(setting_angles, **pdict)
+    expected = utils.grid3d(hkl, img_stack, *dqn, binary_mask=mask)
+    for nthreads in (1, 2, 5):
+        grid = recip.process_to_grid(setting_angles, img_stack=img_stack,
+                                     dqn=dqn, binary_mask=mask,
+                                     nthreads=nthreads, **pdict)
+        npt.assert_array_almost_equal(grid[4], expected[4])
+        npt.assert_array_almost_equal(grid[0], expected[0])
+        npt.assert_array_equal(grid[1], expected[1])
+        npt.assert_array_almost_equal(grid[2], expected[2])
+        npt.assert_equal(grid[3], expected[3])
+
+    # a smaller grid, with a mask for each image
+    qmin = hkl.min(axis=0) / 2
+    qmax = hkl.max(axis=0) / 2
+    masks = np.array([mask, ~mask, mask])
+    expected = utils.grid3d(hkl, img_stack, *dqn, xmin=qmin[0],
+                            ymin=qmin[1], zmin=qmin[2], xmax=qmax[0],
+                            ymax=qmax[1], zmax=qmax[2], binary_mask=masks)
+    grid = recip.process_to_grid(setting_angles, img_stack=img_stack,
+                                 qmin=qmin, qmax=qmax, dqn=dqn,
+                                 binary_mask=masks, **pdict)
+    assert expected[3] > 0
+    for value, expected_value in zip(grid, expected):
+        npt.assert_array_almost_equal(value, expected_value)
+
+    npt.assert_raises(ValueError, recip.process_to_grid, setting_angles,
+                      img_stack=img_stack[:2], **pdict)
+
+    # integer images, as they are, and byte-swapped or of a type which is
+    # converted up front
+    counts = rs.randint(0, 1000, img_stack.shape)
+    expected = utils.grid3d(hkl, counts.astype(float), *dqn,
+                            binary_mask=mask)
+    for dtype in (np.uint16, np.int32, '>i4', np.float32, np.float16):
+        grid = recip.process_to_grid(setting_angles,
+                                     img_stack=counts.astype(dtype),
+                                     dqn=dqn, binary_mask=mask, **pdict)
+        for value, expected_value in zip(grid, expected):
+            npt.assert_array_almost_equal(value, expected_value)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
@@ -340,6 +340,15 @@ def test_circular_average():
     assert_array_almost_equal(ring_avg, [8., 2.5, 5.55555556, 0.,
                                          0., 0.], decimal=6)
 
+    # one image as nested lists, and a list of images
+    assert_array_almost_equal(
+        roi.circular_average(image.tolist(), calib_center, nx=6)[1],
+        ring_avg)
+    assert_array_almost_equal(
+        roi.circular_average([image, image], calib_center, nx=6)[1],
+        [ring_avg, ring_avg])
+    assert_raises(ValueError, roi.circular_average, image[0], calib_center)
+
 
 def test_roi_kymograph():
     calib_center = (25, 25)
@@ -356,3 +365,143 @@ def test_roi_kymograph():
     kymograph_data = roi.roi_kymograph(np.asarray(images), labels, num=1)
 
     assert_almost_equal(kymograph_data[:, 0],  np.arange(100).reshape(100, 1))
+
+
+def test_label_index():
+    labels = roi.rings(roi.ring_edges(2, 3, num_rings=4), (20, 15), (40, 30))
+    images = np.random.randint(0, 100, size=(5, ) + labels.shape)
+    label_index = roi.LabelIndex(labels)
+    assert_array_equal(label_index.index, [1, 2, 3, 4])
+    assert_array_equal(label_index.num_pixels, np.bincount(labels.ravel())[1:])
+
+    for n, label in enumerate(label_index.index):
+        mask = labels == label
+        assert_array_equal(label_index.split(
+            label_index.pixel_values(images[0]))[n], images[0][mask])
+        assert_array_almost_equal(label_index.mean(images)[:, n],
+                                  [img[mask].mean() for img in images])
+        assert_array_equal(label_index.max(images)[:, n],
+                           [img[mask].max() for img in images])
+        assert_array_equal(label_index.sum(images[0])[n],
+                           images[0][mask].sum())
+
+    # a subset of the labels in any order, with a label not in the array
+    label_index = roi.LabelIndex(labels, index=[3, 7, 1])
+    mean_int, index = roi.mean_intensity(images, label_index)
+    assert_array_equal(index, [3, 7, 1])
+    assert_array_almost_equal(mean_int[:, 0],
+                              [img[labels == 3].mean() for img in images])
+    assert_true(np.all(np.isnan(mean_int[:, 1])))
+    assert_array_equal(label_index.max(images)[:, 1], 0)
+
+    # the functions give the same results for labels and a LabelIndex
+    mean_labels, _ = roi.mean_intensity(images, labels, index=index)
+    assert_array_equal(mean_int, mean_labels)
+    assert_array_equal(roi.roi_kymograph(images, label_index, num=3),
+                       roi.roi_kymograph(images, labels, num=3))
+    assert_equal(roi.roi_max_counts([images], label_index),
+                 roi.roi_max_counts([images], labels))
+
+    assert_raises(ValueError, label_index.pixel_values, np.zeros((5, 5)))
+
+
+def test_chunked_roi_functions():
+    labels = roi.rings(roi.ring_edges(2, 3, num_rings=4), (20, 15), (40, 30))
+    images = np.random.randint(0, 100, size=(7, ) + labels.shape)
+
+    def lazy_images():
+        for img in images:
+            yield img
+
+    mean_int, index = roi.mean_intensity(images, labels)
+    for prefetch in (False, True):
+        assert_array_equal(roi.mean_intensity(lazy_images(), labels,
+                                              chunk_size=3,
+                                              prefetch=prefetch)[0],
+                           mean_int)
+    assert_equal(roi.mean_intensity(iter([]), labels)[0].shape, (0, 4))
+
+    assert_equal(roi.roi_max_counts([lazy_images()], labels, chunk_size=2),
+                 roi.roi_max_counts([images], labels))
+    assert_array_equal(roi.roi_kymograph(lazy_images(), labels, 2,
+                                         chunk_size=2),
+                       roi.roi_kymograph(images, labels, 2))
+
+    # the circular average of each image of a sequence
+    bin_centers, ring_averages = roi.circular_average(lazy_images(), (20, 15),
+                                                      nx=10, chunk_size=3)
+    assert_equal(ring_averages.shape, (len(images), len(bin_centers)))
+    for img, ring_avg in zip(images, ring_averages):
+        centers, expected = roi.circular_average(img, (20, 15), nx=10)
+        assert_array_almost_equal(centers, bin_centers)
+        assert_array_almost_equal(ring_avg, expected)
+
+
+def test_circular_average_plan():
+    calib_center = (20.3, 14.6)
+    images = np.random.random((6, 40, 30))
+    plan = roi.CircularAveragePlan(calib_center, (40, 30), nx=20)
+
+    # the same bins as utils.bin_1D
+    radial_val = core.radial_grid(calib_center, (40, 30)).ravel()
+    bin_edges, sums, counts = core.bin_1D(radial_val, images[0].ravel(), 20)
+    assert_array_almost_equal(plan.bin_edges, bin_edges)
+    assert_array_equal(plan.counts, counts)
+    assert_array_almost_equal(plan(images[0]), sums / counts)
+
+    ring_averages = plan.integrate_stack(images, chunk_size=4)
+    assert_equal(ring_averages.shape, (6, 20))
+    for img, ring_avg in zip(images, ring_averages):
+        assert_array_almost_equal(ring_avg, plan(img))
+
+    # leave out the pixels of the mask and the bins with few pixels
+    mask = np.ones((40, 30), dtype=bool)
+    mask[:, :10] = False
+    plan = roi.CircularAveragePlan(calib_center, (40, 30), nx=20,
+                                   mask=mask, threshold=5)
+    radial_val = core.radial_grid(calib_center, (40, 30))[mask]
+    bin_edges, sums, counts = core.bin_1D(radial_val, images[0][mask], 20)
+    assert_array_almost_equal(plan(images[0]),
+                              sums[counts > 5] / counts[counts > 5])
+    assert_array_almost_equal(plan.bin_centers,
+                              core.bin_edges_to_centers(bin_edges)[
+                                  counts > 5])
+
+    assert_raises(ValueError, plan, np.zeros((30, 40)))
+    assert_raises(ValueError, roi.CircularAveragePlan, calib_center,
+                  (40, 30), mask=np.zeros((40, 30), dtype=bool))
+
+
+def test_split_pixels():
+    calib_center = (20.3, 14.6)
+    shape = (40, 30)
+    for pixel_size in (None, (0.2, 0.1)):
+        plan = roi.CircularAveragePlan(calib_center, shape, nx=12,
+                                       pixel_size=pixel_size,
+                                       split_pixels=True)
+        # each pixel is split between the bins, only the parts of the
+        # pixels beyond the outer bins are lost
+        pixel_total = np.asarray(plan._matrix.sum(axis=0)).ravel()
+        assert_true(np.all(pixel_total <= 1 + 1e-12))
+        assert_almost_equal(np.median(pixel_total), 1)
+        assert_array_almost_equal(plan(np.ones(shape)), 1)
+
+        # the average radius of each bin is in the bin
+        radii = core.radial_grid(calib_center, shape, pixel_size)
+        ring_avg = plan(radii)
+        assert_true(np.all(ring_avg >= plan.bin_edges[:-1]))
+        assert_true(np.all(ring_avg <= plan.bin_edges[1:]))
+
+    # a whole stack at once, and with a mask
+    images = np.random.random((5, ) + shape)
+    mask = np.ones(shape, dtype=bool)
+    mask[:, :10] = False
+    plan = roi.CircularAveragePlan(calib_center, shape, nx=12, mask=mask,
+                                   split_pixels=True)
+    for img, ring_avg in zip(images, plan.integrate_stack(images)):
+        assert_array_almost_equal(ring_avg, plan(img))
+        assert_array_almost_equal(ring_avg, plan(img * mask))
+
+    bin_centers, ring_avg = roi.circular_average(images[0], calib_center,
+                                                 nx=12, split_pixels=True)
+    assert_equal(len(bin_centers), 12)
@@ -37,6 +37,7 @@ import logging
 
 import six
 import numpy as np
+import scipy.stats
 
 logger = logging.getLogger(__name__)
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
@@ -79,6 +80,40 @@ def test_statistics_1D():
                               np.linspace(0, 1, nx + 1, endpoint=True))
     assert_array_almost_equal(val,
                               np.sum(y.reshape(nx, -1), axis=1)/10.)
+def test_uniform_bin_indices():
+    # values on and next to the edges, and outside of the bins
+    edges = np.linspace(0.1, 0.7, 7)
+    x = np.concatenate((edges, np.nextafter(edges, 0),
+                        np.nextafter(edges, 1), [-1, 0.8, np.nan],
+                        np.random.random(1000)))
+    bin_edges, indices = core.uniform_bin_indices(x, 6, 0.1, 0.7)
+    assert_array_equal(bin_edges, edges)
+    # the same bins as np.histogram
+    for n in range(6):
+        count, _ = np.histogram(x[indices == n], bins=edges)
+        assert_equal(count[n], np.sum(indices == n))
+    count, _ = np.histogram(x[np.isfinite(x)], bins=edges)
+    assert_array_equal(count, np.bincount(indices[indices >= 0]))
+
+    # all of the values in one place
+    assert_array_equal(core.uniform_bin_indices(np.ones(3), 4)[1], 3)
+
+
+def test_statistics_1D_fast():
+    x = np.random.random(500)
+    y = np.random.random(500) * 10
+    # the bins above x = 1 are empty
+    empty_value = {'mean': np.nan, 'std': np.nan, 'count': 0, 'sum': 0}
+    for stat in ('mean', 'std', 'count', 'sum'):
+        edges, val = core.statistics_1D(x, y, stat=stat, nx=20,
+                                        min_x=0.2, max_x=1.2)
+        empty = edges[:-1] >= 1
+        assert_array_equal(val[empty], empty_value[stat])
+        expected, _, _ = scipy.stats.binned_statistic(x, y, statistic=stat,
+                                                      bins=edges)
+        assert_array_almost_equal(val[~empty], expected[~empty])
+
+
 def test_bin_1D_2():
     """
     Test for appropriate default value handling
@@ -278,6 +313,77 @@ def test_process_grid_std_err():
                             np.std(np.arange(1, 6))/np.sqrt(5 - 1)))
 
 
+def test_grid3d_threads():
+    rs = np.random.RandomState(5)
+    data = rs.random_sample((5000, 3))
+    I = rs.random_sample(5000) * 10
+    param_dict = {'nx': 4, 'ny': 5, 'nz': 6,
+                  'xmin': 0, 'ymin': 0, 'zmin': 0,
+                  'xmax': 0.9, 'ymax': 1, 'zmax': 1}
+    mean, occupancy, std_err, oob, bounds = core.grid3d(data, I, nthreads=1,
+                                                        **param_dict)
+
+    # the mean and standard error of each voxel
+    index = np.floor(data / [0.9 / 4, 1. / 5, 1. / 6]).astype(int)
+    inside = index[:, 0] < 4
+    npt.assert_equal(oob, np.sum(~inside))
+    for i, j, k in [(0, 0, 0), (3, 4, 5), (1, 2, 3)]:
+        in_voxel = inside & np.all(index == (i, j, k), axis=1)
+        npt.assert_equal(occupancy[i, j, k], np.sum(in_voxel))
+        assert_almost_equal(mean[i, j, k], np.mean(I[in_voxel]))
+        assert_almost_equal(std_err[i, j, k],
+                            np.std(I[in_voxel]) /
+                            np.sqrt(np.sum(in_voxel) - 1))
+
+    # splitting the points between threads gives the same grid
+    for nthreads in (2, 3, 7):
+        threaded = core.grid3d(data, I, nthreads=nthreads, **param_dict)
+        assert_array_almost_equal(threaded[0], mean)
+        npt.assert_array_equal(threaded[1], occupancy)
+        assert_array_almost_equal(threaded[2], std_err)
+        npt.assert_equal(threaded[3], oob)
+
+
+def test_grid3d_accumulator():
+    rs = np.random.RandomState(5)
+    data = rs.random_sample((5000, 3))
+    I = rs.random_sample(5000) * 10
+    mask = rs.random_sample(5000) > 0.1
+    grid = core.Grid3DAccumulator((0, 0, 0), (0.9, 1, 1), (4, 5, 6))
+    grid.add(data, I, binary_mask=mask)
+    mean, occupancy, std_err, oob, bounds = grid.finalize()
+    npt.assert_array_equal(bounds, [[0, 0.9, 4], [0, 1, 5], [0, 1, 6]])
+
+    # the mean and standard error of each voxel
+    index = np.floor(data / [0.9 / 4, 1. / 5, 1. / 6]).astype(int)
+    inside = index[:, 0] < 4
+    npt.assert_equal(oob, np.sum(~inside & mask))
+    npt.assert_equal(occupancy.sum(), np.sum(inside & mask))
+    for i, j, k in [(0, 0, 0), (3, 4, 5), (1, 2, 3)]:
+        in_voxel = inside & mask & np.all(index == (i, j, k), axis=1)
+        npt.assert_equal(occupancy[i, j, k], np.sum(in_voxel))
+        assert_almost_equal(mean[i, j, k], np.mean(I[in_voxel]))
+        assert_almost_equal(std_err[i, j, k],
+                            np.std(I[in_voxel]) /
+                            np.sqrt(np.sum(in_voxel) - 1))
+
+    # adding the points in chunks, e.g. one image at a time, gives the
+    # same grid
+    chunked = core.Grid3DAccumulator((0, 0, 0), (0.9, 1, 1), (4, 5, 6))
+    for start in range(0, 5000, 700):
+        chunk = slice(start, start + 700)
+        chunked.add(data[chunk].reshape(-1, 10, 3), I[chunk].reshape(-1, 10),
+                    binary_mask=mask[chunk])
+    chunked = chunked.finalize()
+    assert_array_almost_equal(chunked[0], mean)
+    npt.assert_array_equal(chunked[1], occupancy)
+    assert_array_almost_equal(chunked[2], std_err)
+    npt.assert_equal(chunked[3], oob)
+
+    npt.assert_raises(ValueError, grid.add, data, I[:10])
+    npt.assert_raises(ValueError, core.Grid3DAccumulator, (0, 0, 0), (0, 1, 1))
+
+
 def test_bin_edge2center():
     test_edges = np.arange(11)
     centers = core.bin_edges_to_centers(test_edges)
@@ -382,10 +488,65 @@ def test_multi_tau_lags():
     assert_array_equal(delay_steps, lag_steps)
 
 
-@raises(NotImplementedError)
 def test_wedge_integration():
-    core.wedge_integration(src_data=None, center=None, theta_start=None,
-                           delta_theta=None, r_inner=None, delta_r=None)
+    # a block of pixels below and to the left of the center
+    image = np.zeros((101, 101))
+    image[60:70, 35:45] = 1
+    center = (50, 50)
+
+    def wedge(theta_start, delta_theta, r_inner=0, delta_r=30):
+        return core.wedge_integration(image, center, theta_start,
+                                      delta_theta, r_inner, delta_r)
+
+    # clockwise from the y axis (down) is towards the left
+    assert_equal(wedge(0, 90), 100)
+    assert_equal(wedge(90, -90), 100)
+    assert_equal(wedge(0, -90), 0)
+    assert_equal(wedge(-45, 360), 100)
+    # the wedges can wrap around
+    assert_equal(wedge(350, 30) + wedge(20, 60), 100)
+    assert_equal(wedge(0, 90, r_inner=25), 0)
+    assert_equal(wedge(0, 90, r_inner=0, delta_r=10), 0)
+
+    npt.assert_raises(ValueError, wedge, 0, 90, -1, 30)
+    npt.assert_raises(ValueError, wedge, 0, 90, 0, -1)
+
+
+def test_cake_plan():
+    center = (20.3, 14.6)
+    shape = (40, 30)
+    plan = core.CakePlan(center, shape, nr=8, nchi=12)
+    assert_equal(plan.counts.shape, (8, 12))
+    assert_equal(plan.counts.sum(), 40 * 30)
+
+    sums, counts = plan(np.ones(shape))
+    assert_array_equal(sums, counts)
+
+    # the pixels in each bin are in the range of the bin
+    r = core.radial_grid(center, shape)
+    chi = core.angle_grid(center, shape)
+    filled = counts > 0
+    for grid, edges, axis in ((r, plan.r_edges, 0),
+                              (chi, plan.chi_edges, 1)):
+        mean = plan(grid)[0][filled] / counts[filled]
+        low = np.expand_dims(edges[:-1], 1 - axis) * np.ones(counts.shape)
+        high = np.expand_dims(edges[1:], 1 - axis) * np.ones(counts.shape)
+        assert_true(np.all(mean >= low[filled] - 1e-12))
+        assert_true(np.all(mean <= high[filled] + 1e-12))
+
+    # a stack, with a mask and a smaller range
+    images = np.random.random((5, ) + shape)
+    mask = np.ones(shape, dtype=bool)
+    mask[:5] = False
+    plan = core.CakePlan(center, shape, nr=4, nchi=6, mask=mask,
+                         r_range=(5, 15), chi_range=(0, np.pi))
+    keep = mask & (r >= 5) & (r <= 15) & (chi >= 0)
+    assert_equal(plan.counts.sum(), keep.sum())
+    sums, counts = plan.integrate_stack(images, chunk_size=2)
+    assert_equal(sums.shape, (5, 4, 6))
+    for img, img_sums in zip(images, sums):
+        assert_array_almost_equal(img_sums, plan(img)[0])
+        assert_almost_equal(img_sums.sum(), img[keep].sum())
 
 
 def test_subtract_reference_images():
@@ -458,6 +619,32 @@ def test_subtract_reference_images():
 def _fail_img_to_relative_xyi_helper(input_dict):
     core.img_to_relative_xyi(**input_dict)
 
+def test_image_chunks():
+    images = np.random.random((10, 4, 5))
+
+    def lazy_images():
+        for img in images:
+            yield img
+
+    for prefetch in (False, True):
+        for source in (images, lazy_images(), list(images)):
+            chunks = list(core.image_chunks(source, chunk_size=4,
+                                            prefetch=prefetch))
+            assert_equal([len(chunk) for chunk in chunks], [4, 4, 2])
+            assert_array_equal(np.concatenate(chunks), images)
+
+    def broken_images():
+        yield images[0]
+        raise IOError("can not read the next image")
+
+    chunks = core.image_chunks(broken_images(), chunk_size=1,
+                               prefetch=True)
+    assert_array_equal(next(chunks)[0], images[0])
+    npt.assert_raises(IOError, next, chunks)
+
+    npt.assert_raises(ValueError, core.image_chunks, images, 0)
+
+
 def test_img_to_relative_fails():
     fail_dicts = [
         # invalid values of x and y
@@ -558,6 +745,48 @@ def test_radial_grid():
     assert_equal(a[3, 4], 1)
 
 
+def test_grid_cache():
+    core.clear_grid_cache()
+    try:
+        a = core.radial_grid((3, 3), (7, 7), copy=False)
+        # the cached grid is returned, read-only
+        assert_true(core.radial_grid((3., 3.), [7, 7], copy=False) is a)
+        npt.assert_raises(ValueError, a.__setitem__, (0, 0), 1)
+        # or by default a copy of it, which can be modified
+        c = core.radial_grid((3, 3), (7, 7))
+        assert_true(c is not a)
+        assert_array_equal(c, a)
+        c[0, 0] = 1
+        assert_true(a[0, 0] != 1)
+        # the angles are cached separately
+        b = core.angle_grid((3, 3), (7, 7), copy=False)
+        assert_true(b is not a)
+        assert_true(core.radial_grid((3, 3), (7, 7), (2, 2),
+                                     copy=False) is not a)
+        assert_almost_equal(core.radial_grid((3, 3), (7, 7), (2, 2))[3, 4],
+                            2)
+
+        # the least recently used grid is evicted first
+        core.set_grid_cache_limits(max_entries=2)
+        core.radial_grid((3, 3), (7, 7))
+        core.angle_grid((3, 3), (7, 7))
+        a = core.radial_grid((3, 3), (7, 7), copy=False)
+        core.radial_grid((2, 2), (7, 7))
+        assert_true(core.radial_grid((3, 3), (7, 7), copy=False) is a)
+        assert_true(core.angle_grid((3, 3), (7, 7), copy=False) is not b)
+
+        # grids over the memory limit are not kept
+        core.set_grid_cache_limits(max_bytes=a.nbytes - 1)
+        c = core.radial_grid((3, 3), (7, 7), copy=False)
+        assert_true(c is not a)
+        assert_true(core.radial_grid((3, 3), (7, 7), copy=False) is not c)
+        assert_array_equal(c, a)
+    finally:
+        core.set_grid_cache_limits(core._defaults['grid_cache_entries'],
+                                   core._defaults['grid_cache_bytes'])
+        core.clear_grid_cache()
+
+
 def test_geometric_series():
     time_series = core.geometric_series(common_ratio=5, number_of_images=150)
 
@@ -44,8 +44,10 @@ from six import string_types
 
 import time
 import sys
+import threading
 
-from collections import namedtuple, MutableMapping, defaultdict, deque
+from collections import (namedtuple, MutableMapping, defaultdict, deque,
+                         OrderedDict)
 import numpy as np
 import scipy.stats
 from itertools import tee
@@ -69,7 +71,10 @@ _defaults = {
     "bins": 100,
     'nx': 100,
     'ny': 100,
-    'nz': 100
+    'nz': 100,
+    'chunk_size': 64,
+    'grid_cache_entries': 8,
+    'grid_cache_bytes': 256 * 2**20,
 }
 
 
@@ -500,6 +505,105 @@ def subtract_reference_images(imgs, is_reference):
     return list(corrected_image)
 
 
+def image_chunks(images, chunk_size=None, prefetch=False):
+    """
+    Iterate over a sequence of images in stacks of `chunk_size` images.
+
+    This only needs to iterate over `images`, so it works for lazy
+    readers (e.g. pims sequences) and generators, and at most about two
+    chunks of images are in memory at a time. Slices of arrays (including
+    memmaps) are yielded without copying.
+
+    Parameters
+    ----------
+    images : iterable of 2D arrays
+        dimensions are: (rr, cc)
+
+    chunk_size : int, optional
+        number of images in each chunk, defaults to
+        ``_defaults['chunk_size']``
+
+    prefetch : bool, optional
+        If True, read the next chunk on a background thread while the
+        current chunk is processed, so the I/O of lazy readers overlaps
+        the computation. Default is False.
+
+    Yields
+    ------
+    chunk : array
+        stack of images, dimensions are: (num_img, rr, cc) where num_img
+        is `chunk_size` except for the last chunk
+    """
+    if chunk_size is None:
+        chunk_size = _defaults['chunk_size']
+    if chunk_size < 1:
+        raise ValueError("The chunk size must be at least 1, "
+                         "not {0}".format(chunk_size))
+    chunks = _image_chunks(images, chunk_size)
+    if prefetch:
+        chunks = _prefetch(chunks)
+    return chunks
+
+
+def _image_chunks(images, chunk_size):
+    """Generator of the chunks of `image_chunks`"""
+    if isinstance(images, np.ndarray):
+        for start in range(0, len(images), chunk_size):
+            yield images[start:start + chunk_size]
+        return
+    chunk = []
+    for img in images:
+        chunk.append(img)
+        if len(chunk) == chunk_size:
+            yield np.asarray(chunk)
+            chunk = []
+    if chunk:
+        yield np.asarray(chunk)
+
+
+def _prefetch(iterable):
+    """
+    Generator of the items of `iterable`, read one item ahead on a
+    background thread. Exceptions raised while reading are re-raised in
+    the calling thread.
+    """
+    queue = six.moves.queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def put(item):
+        # give up if the consumer stopped reading
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception:
+            put((False, sys.exc_info()))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            more, item = queue.get()
+            if not more:
+                if item is not None:
+                    six.reraise(*item)
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def img_to_relative_xyi(img, cx, cy, pixel_size_x=None, pixel_size_y=None):
     """
     Convert the 2D image to a list of x y I coordinates where
@@ -556,6 +660,85 @@ def img_to_relative_xyi(img, cx, cy, pixel_size_x=None, pixel_size_y=None):
     return x.ravel(), y.ravel(), img.ravel()
 
 
+def uniform_bin_indices(x, nx=None, min_x=None, max_x=None):
+    """
+    Find the bin of each x-coordinate for `nx` uniform bins.
+
+    The bins are the same as for ``np.histogram`` with the edges
+    ``np.linspace(min_x, max_x, nx + 1)``: each bin includes its left
+    edge, and the last bin also includes its right edge. The bins are
+    computed arithmetically in O(N), instead of with a binary search for
+    each value, and then corrected by comparing with the edges.
+
+    Parameters
+    ----------
+    x : array
+        position
+    nx : integer, optional
+        number of bins to use defaults to default bin value
+    min_x : float, optional
+        Left edge of first bin defaults to minimum value of x
+    max_x : float, optional
+        Right edge of last bin defaults to maximum value of x
+
+    Returns
+    -------
+    edges : array
+        edges of bins, length nx + 1
+
+    indices : array
+        bin of each value of x, -1 for values outside of the bins
+    """
+    x = np.ravel(x)
+    # handle default values
+    if min_x is None:
+        min_x = np.min(x)
+    if max_x is None:
+        max_x = np.max(x)
+    if nx is None:
+        nx = _defaults["bins"]
+
+    edges = np.linspace(start=min_x, stop=max_x, num=nx+1, endpoint=True)
+    indices = np.full(x.shape, -1, dtype=np.intp)
+    in_range = np.flatnonzero((x >= min_x) & (x <= max_x))
+    if max_x == min_x:
+        indices[in_range] = nx - 1
+        return edges, indices
+
+    x_in = x[in_range]
+    ind = ((x_in - min_x) * (nx / (max_x - min_x))).astype(np.intp)
+    np.clip(ind, 0, nx - 1, out=ind)
+    # rounding can put values next to an edge in the neighbouring bin
+    ind[x_in < edges[ind]] -= 1
+    ind[(x_in >= edges[ind + 1]) & (ind < nx - 1)] += 1
+    indices[in_range] = ind
+    return edges, indices
+
+
+def _bin_sums(x, y, nx=None, min_x=None, max_x=None, squares=False):
+    """
+    Number of values, sum of values (and sum of the squared deviations
+    from the mean of each bin) in each uniform bin.
+    """
+    edges, indices = uniform_bin_indices(x, nx, min_x, max_x)
+    nx = len(edges) - 1
+    y = np.ravel(y)
+    keep = indices >= 0
+    if not np.all(keep):
+        indices = indices[keep]
+        y = y[keep]
+    count = np.bincount(indices, minlength=nx)
+    val = np.bincount(indices, weights=y, minlength=nx)
+    if not squares:
+        return edges, val, count
+    # two passes, which is much more accurate than sum(y**2) - n*mean**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = val / count
+    deviations = np.bincount(indices, weights=(y - mean[indices])**2,
+                             minlength=nx)
+    return edges, val, count, deviations
+
+
 def bin_1D(x, y, nx=None, min_x=None, max_x=None):
     """
     Bin the values in y based on their x-coordinates
@@ -584,22 +767,10 @@ def bin_1D(x, y, nx=None, min_x=None, max_x=None):
     count : array
         The number of counts in each bin, length nx
     """
-
-    # handle default values
-    if min_x is None:
-        min_x = np.min(x)
-    if max_x is None:
-        max_x = np.max(x)
-    if nx is None:
-        nx = _defaults["bins"]
-
-    # use a weighted histogram to get the bin sum
-    bins = np.linspace(start=min_x, stop=max_x, num=nx+1, endpoint=True)
-    val, _ = np.histogram(a=x, bins=bins, weights=y)
-    # use an un-weighted histogram to get the counts
-    count, _ = np.histogram(a=x, bins=bins)
-    # return the three arrays
-    return bins, val, count
+    # the bins are uniform, so the bin of each value is found
+    # arithmetically, and the sums and counts are taken with bincount
+    # (see uniform_bin_indices), rather than two calls to np.histogram
+    return _bin_sums(x, y, nx, min_x, max_x)
 
 
 def statistics_1D(x, y, stat='mean', nx=None, min_x=None, max_x=None):
@@ -614,7 +785,9 @@ def statistics_1D(x, y, stat='mean', nx=None, min_x=None, max_x=None):
         intensity
     stat: str or func, optional
         statistic to be used on the binned values defaults to mean
-        see scipy.stats.binned_statistic
+        see scipy.stats.binned_statistic. 'mean', 'std', 'count' and
+        'sum' are computed in a single binning pass; the 'mean' and 'std'
+        of empty bins are NaN.
     nx : integer, optional
         number of bins to use defaults to default bin value
     min_x : float, optional
@@ -630,6 +803,19 @@ def statistics_1D(x, y, stat='mean', nx=None, min_x=None, max_x=None):
     val : array
         statistics of values in each bin, length nx
     """
+    if isinstance(stat, string_types) and stat in ('mean', 'std', 'count',
+                                                   'sum'):
+        binned = _bin_sums(x, y, nx, min_x, max_x, squares=(stat == 'std'))
+        edges, val, count = binned[:3]
+        # empty bins have a NaN mean and std, and 0 count and sum
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if stat == 'mean':
+                val = val / count
+            elif stat == 'std':
+                val = np.sqrt(binned[3] / count)
+            elif stat == 'count':
+                val = count.astype(np.float64)
+        return edges, val
 
     # handle default values
     if min_x is None:
@@ -647,10 +833,131 @@ def statistics_1D(x, y, stat='mean', nx=None, min_x=None, max_x=None):
     return bins, val
 
 
-def radial_grid(center, shape, pixel_size=None):
+class _GridCache(object):
+    """
+    Least recently used cache of read-only arrays.
+
+    The module level `_grid_cache` keeps the grids of `radial_grid` and
+    `angle_grid` and the q maps of
+    `skxray.core.recip.calibrated_pixels_to_q`, which share its limits.
+    The Fourier kernels of `skxray.core.dpc.recon` are kept in a cache of
+    their own, so that they do not evict them.
+    At most `max_entries` grids, taking at most `max_bytes` in total, are
+    kept; the least recently used grids are evicted first. The grids are
+    read-only so that they can be shared safely.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._grids = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Total size of the cached grids"""
+        return sum(grid.nbytes for grid in self._grids.values())
+
+    def __len__(self):
+        return len(self._grids)
+
+    def get(self, key, make_grid):
+        """
+        Get the grid for key, calling ``make_grid()`` to make it if it is
+        not in the cache.
+        """
+        with self._lock:
+            grid = self._grids.pop(key, None)
+            if grid is not None:
+                # most recently used last
+                self._grids[key] = grid
+                return grid
+        grid = make_grid()
+        grid.flags.writeable = False
+        with self._lock:
+            if grid.nbytes <= self.max_bytes and self.max_entries > 0:
+                self._grids[key] = grid
+                self._evict()
+        return grid
+
+    def _evict(self):
+        nbytes = self.nbytes
+        while (len(self._grids) > self.max_entries or
+               nbytes > self.max_bytes):
+            _, grid = self._grids.popitem(last=False)
+            nbytes -= grid.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._grids.clear()
+
+    def resize(self, max_entries=None, max_bytes=None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+
+_grid_cache = _GridCache(_defaults['grid_cache_entries'],
+                         _defaults['grid_cache_bytes'])
+
+
+def clear_grid_cache():
+    """
+    Empty the cache of the grids made by `radial_grid` and `angle_grid`
+    and of the q maps made by `skxray.core.recip.calibrated_pixels_to_q`.
+    """
+    _grid_cache.clear()
+
+
+def set_grid_cache_limits(max_entries=None, max_bytes=None):
+    """
+    Set the size of the cache of the grids made by `radial_grid` and
+    `angle_grid` and of the q maps made by
+    `skxray.core.recip.calibrated_pixels_to_q`. They all count against the
+    same limits, and the least recently used ones are evicted to fit. The
+    Fourier kernels of `skxray.core.dpc.recon` are not in this cache.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        maximum number of grids and q maps to keep, 0 disables the cache
+
+    max_bytes : int, optional
+        maximum total size of the grids and q maps to keep
+    """
+    _grid_cache.resize(max_entries, max_bytes)
+
+
+def _grid_key(kind, center, shape, pixel_size):
+    """The cache key of a grid"""
+    if pixel_size is None:
+        pixel_size = (1, 1)
+    return (kind, tuple(float(c) for c in center[:2]),
+            tuple(int(n) for n in shape[:2]),
+            tuple(float(p) for p in pixel_size[:2]))
+
+
+def _pixel_coordinates(center, shape, pixel_size):
+    """
+    The positions of the columns (x) and of the rows (y) relative to the
+    center, shaped to broadcast against each other.
+    """
+    if pixel_size is None:
+        pixel_size = (1, 1)
+    x = pixel_size[1] * (np.arange(shape[1]) - center[1])
+    y = pixel_size[0] * (np.arange(shape[0]) - center[0])
+    return x[np.newaxis, :], y[:, np.newaxis]
+
+
+def radial_grid(center, shape, pixel_size=None, copy=True):
     """
     Make a grid of radial positions.
 
+    The grids are cached (see `set_grid_cache_limits`), and a copy of the
+    cached grid is returned unless `copy` is False.
+
     Parameters
     ----------
     center : tuple
@@ -661,28 +968,37 @@ def radial_grid(center, shape, pixel_size=None):
         Image shape which is used to determine the maximum extent of output
         pixel coordinates. Order is (rr, cc).
 
+    pixel_size : tuple, optional
+        The size of a pixel in real units. (height, width).
+
+    copy : bool, optional
+        If False, return the cached grid itself, which is read-only and
+        shared with the other callers, without copying it. Default is
+        True.
+
     Returns
     -------
     r : array
         The L2 norm of the distance of each pixel from the calibrated center.
     """
+    def make_grid():
+        x, y = _pixel_coordinates(center, shape, pixel_size)
+        return np.sqrt(x*x + y*y)
 
-    if pixel_size is None:
-        pixel_size = (1, 1)
-
-    X, Y = np.meshgrid(pixel_size[1] * (np.arange(shape[1]) -
-                                        center[1]),
-                       pixel_size[0] * (np.arange(shape[0]) -
-                                        center[0]))
-    return np.sqrt(X*X + Y*Y)
+    grid = _grid_cache.get(_grid_key('radial', center, shape, pixel_size),
+                           make_grid)
+    return grid.copy() if copy else grid
 
 
-def angle_grid(center, shape, pixel_size=None):
+def angle_grid(center, shape, pixel_size=None, copy=True):
     """
     Make a grid of angular positions.
 
     Read note for our conventions here -- there be dragons!
 
+    The grids are cached (see `set_grid_cache_limits`), and a copy of the
+    cached grid is returned unless `copy` is False.
+
     Parameters
     ----------
     center : tuple
@@ -693,6 +1009,14 @@ def angle_grid(center, shape, pixel_size=None):
         Image shape which is used to determine the maximum extent of output
         pixel coordinates. Order is (rr, cc).
 
+    pixel_size : tuple, optional
+        The size of a pixel in real units. (height, width).
+
+    copy : bool, optional
+        If False, return the cached grid itself, which is read-only and
+        shared with the other callers, without copying it. Default is
+        True.
+
     Returns
     -------
     agrid : array
@@ -704,16 +1028,14 @@ def angle_grid(center, shape, pixel_size=None):
     :math:`\\theta \\el [-\pi, \pi]`.  In array indexing and the conventional
     axes for images (origin in upper left), positive y is downward.
     """
+    def make_grid():
+        # row is y, column is x. "so say we all. amen."
+        x, y = _pixel_coordinates(center, shape, pixel_size)
+        return np.arctan2(y, x)
 
-    if pixel_size is None:
-        pixel_size = (1, 1)
-
-    # row is y, column is x. "so say we all. amen."
-    x, y = np.meshgrid(pixel_size[1] * (np.arange(shape[1]) -
-                                        center[1]),
-                       pixel_size[0] * (np.arange(shape[0]) -
-                                        center[0]))
-    return np.arctan2(y, x)
+    grid = _grid_cache.get(_grid_key('angle', center, shape, pixel_size),
+                           make_grid)
+    return grid.copy() if copy else grid
 
 
 def radius_to_twotheta(dist_sample, radius):
@@ -769,8 +1091,184 @@ def wedge_integration(src_data, center, theta_start,
     -------
     float
         The integrated intensity under the wedge
+
+    Note
+    ----
+    The y-axis is the row axis, which points down in the conventional
+    axes for images, so that clockwise is from the positive y axis
+    towards the negative x axis (see `angle_grid`). A pixel is in the
+    wedge if its center is. See `CakePlan` to regrid whole images into
+    (radius, angle) bins.
+    """
+    if r_inner < 0:
+        raise ValueError("r_inner must be non-negative, "
+                         "not {0}".format(r_inner))
+    if delta_r < 0:
+        raise ValueError("delta_r must be non-negative, "
+                         "not {0}".format(delta_r))
+    src_data = np.asarray(src_data)
+    r = radial_grid(center, src_data.shape, copy=False)
+    # angle_grid is counter-clockwise from the x axis in the usual
+    # axes, which is clockwise in the image axes, so only the origin
+    # has to move to the y axis
+    theta = np.rad2deg(angle_grid(center, src_data.shape, copy=False)) - 90
+    if delta_theta < 0:
+        theta_start, delta_theta = theta_start + delta_theta, -delta_theta
+    in_wedge = (np.mod(theta - theta_start, 360) <= delta_theta)
+    if delta_theta >= 360:
+        in_wedge[...] = True
+    in_wedge &= (r >= r_inner) & (r < r_inner + delta_r)
+    return float(np.sum(src_data[in_wedge]))
+
+
+class CakePlan(object):
+    """
+    Precomputed caking: regridding of images into (radius, angle) bins.
+
+    The radial and angular bin of each pixel (from `radial_grid` and
+    `angle_grid`) are computed once, as a single index into the
+    flattened (nr, nchi) grid, so that each image is then caked with one
+    `np.bincount`.
+
+    Parameters
+    ----------
+    center : tuple
+        point in image where r=0; may be a float giving subpixel precision.
+        Order is (rr, cc).
+
+    shape : tuple
+        shape of the images (rr, cc)
+
+    nr : int, optional
+        number of radial bins
+
+    nchi : int, optional
+        number of angular bins
+
+    pixel_size : tuple, optional
+        The size of a pixel in real units. (height, width).
+
+    mask : array, optional
+        boolean array of the shape of the images, the pixels where it is
+        False are left out
+
+    r_range : tuple, optional
+        (min, max) of the radial bins, default is the range of the radii
+        of the pixels
+
+    chi_range : tuple, optional
+        (min, max) of the angular bins in radians, with the convention of
+        `angle_grid`. Default is (-pi, pi).
+
+    Attributes
+    ----------
+    r_edges : array
+        edges of the radial bins, length nr + 1
+
+    chi_edges : array
+        edges of the angular bins, length nchi + 1
+
+    counts : array
+        number of pixels in each bin, shape (nr, nchi)
+
+    Examples
+    --------
+    The sums and counts of many images (or of several detectors) can be
+    added up before the average is taken
+
+    >>> plan = CakePlan(center, image.shape, nr=500, nchi=360)
+    >>> sums, counts = plan(image)
+    >>> cake = sums / counts
     """
-    raise NotImplementedError()
+    def __init__(self, center, shape, nr=100, nchi=36, pixel_size=None,
+                 mask=None, r_range=None, chi_range=None):
+        self.shape = tuple(shape)
+        self.nr = nr
+        self.nchi = nchi
+        r = np.ravel(radial_grid(center, shape, pixel_size, copy=False))
+        chi = np.ravel(angle_grid(center, shape, pixel_size, copy=False))
+        if r_range is None:
+            r_range = (np.min(r), np.max(r))
+        if chi_range is None:
+            chi_range = (-np.pi, np.pi)
+
+        self.r_edges, r_bins = uniform_bin_indices(r, nr, *r_range)
+        self.chi_edges, chi_bins = uniform_bin_indices(chi, nchi,
+                                                       *chi_range)
+        in_cake = (r_bins >= 0) & (chi_bins >= 0)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if mask.shape != self.shape:
+                raise ValueError("Shape of the mask should be equal to"
+                                 " shape of the images")
+            in_cake &= np.ravel(mask)
+        self._pixels = np.flatnonzero(in_cake)
+        self._bins = r_bins[self._pixels] * nchi + chi_bins[self._pixels]
+        self.counts = np.bincount(self._bins,
+                                  minlength=nr * nchi).reshape(nr, nchi)
+
+    def _sums(self, image):
+        """The sum over each bin of a (flattened) image"""
+        return np.bincount(self._bins, weights=image[self._pixels],
+                           minlength=self.nr * self.nchi).reshape(self.nr,
+                                                                  self.nchi)
+
+    def __call__(self, image):
+        """
+        Cake an image.
+
+        Parameters
+        ----------
+        image : array
+            input image
+
+        Returns
+        -------
+        sums : array
+            sum of the pixels in each bin, shape (nr, nchi)
+
+        counts : array
+            number of pixels in each bin, shape (nr, nchi)
+        """
+        if np.shape(image) != self.shape:
+            raise ValueError("Shape of the image should be equal to"
+                             " shape of the plan")
+        return self._sums(np.ravel(image)), self.counts
+
+    def integrate_stack(self, images, chunk_size=None, prefetch=False):
+        """
+        Cake each image of a stack.
+
+        Parameters
+        ----------
+        images : array or iterable of 2D arrays
+            dimensions are: (num_img, rr, cc)
+
+        chunk_size : int, optional
+            number of images to process at a time, see `image_chunks`
+
+        prefetch : bool, optional
+            If True, read the next chunk of images on a background thread.
+            Default is False.
+
+        Returns
+        -------
+        sums : array
+            sum of the pixels in each bin, shape (num_img, nr, nchi)
+
+        counts : array
+            number of pixels in each bin, shape (nr, nchi)
+        """
+        sums = []
+        for chunk in image_chunks(images, chunk_size, prefetch):
+            if chunk.shape[1:] != self.shape:
+                raise ValueError("Shape of the images should be equal to"
+                                 " shape of the plan")
+            sums.extend(self._sums(img)
+                        for img in chunk.reshape(len(chunk), -1))
+        if not sums:
+            return np.zeros((0, self.nr, self.nchi)), self.counts
+        return np.array(sums), self.counts
 
 
 def bin_edges(range_min=None, range_max=None, nbins=None, step=None):
@@ -878,7 +1376,7 @@ def grid3d(q, img_stack,
            nx=None, ny=None, nz=None,
            xmin=None, xmax=None, ymin=None,
            ymax=None, zmin=None, zmax=None,
-           binary_mask=None):
+           binary_mask=None, nthreads=None):
     """Grid irregularly spaced data points onto a regular grid via histogramming
 
     This function will process the set of reciprocal space values (q), the
@@ -916,6 +1414,12 @@ def grid3d(q, img_stack,
         Binary mask can be two different shapes.
         - 1: 2-D with binary_mask.shape == np.asarray(img_stack[0]).shape
         - 2: 3-D with binary_mask.shape == np.asarray(img_stack).shape
+    nthreads : int, optional
+        Number of threads to grid with. The data points are split between
+        the threads, each filling a grid of its own, and the grids are
+        merged at the end. Defaults to the number of threads ctrans was
+        built with (``max_threads`` in setup.cfg, twice the number of
+        CPUs by default); ctrans built without threads always uses one.
 
     Returns
     -------
@@ -934,6 +1438,10 @@ def grid3d(q, img_stack,
         tuple of (min, max, step) for x, y, z in order: [x_bounds,
         y_bounds, z_bounds]
 
+    See Also
+    --------
+    Grid3DAccumulator : grid the data a chunk (e.g. an image) at a time
+
     """
     # validate input
     img_stack = np.asarray(img_stack)
@@ -998,7 +1506,8 @@ def grid3d(q, img_stack,
     t1 = time.time()
 
     # call the c library
-    mean, occupancy, std_err, oob = ctrans.grid3d(q, qmin, qmax, dqn, norm=1)
+    mean, occupancy, std_err, oob = ctrans.grid3d(q, qmin, qmax, dqn, norm=1,
+                                                  nthreads=nthreads or 0)
 
     # ending time for the gridding
     t2 = time.time()
@@ -1018,6 +1527,140 @@ def grid3d(q, img_stack,
     return mean, occupancy, std_err, oob, bounds
 
 
+class Grid3DAccumulator(object):
+    """
+    Grid irregularly spaced data points onto a regular grid incrementally.
+
+    This is `grid3d` for data which arrive in chunks, e.g. one image of a
+    scan at a time. Only the state of the grid (the number of points, and
+    the running mean and sum of squared deviations of each voxel) is
+    kept, so the memory does not depend on the length of the scan, and
+    the chunks are used as they are, without building an Nx4 array. The
+    statistics of each chunk are merged into the grid with the pairwise
+    update of Chan et al., so the result does not depend on how the data
+    are split into chunks.
+
+    Parameters
+    ----------
+    qmin : array
+        (xmin, ymin, zmin), the lower edges of the grid
+    qmax : array
+        (xmax, ymax, zmax), the upper edges of the grid. As for `grid3d`,
+        a point is in the grid if ``qmin <= q < qmax``.
+    dqn : array, optional
+        (nx, ny, nz), the number of voxels along each axis. Defaults to
+        the default number of voxels of `grid3d`
+
+    Examples
+    --------
+    >>> grid = Grid3DAccumulator(qmin, qmax, (100, 100, 100))
+    >>> for q, img in zip(q_per_image, images):
+    ...     grid.add(q, img)
+    >>> mean, occupancy, std_err, oob, bounds = grid.finalize()
+    """
+    def __init__(self, qmin, qmax, dqn=None):
+        if dqn is None:
+            dqn = [_defaults['nx'], _defaults['ny'], _defaults['nz']]
+        self.qmin = np.asarray(qmin, dtype=np.float64)
+        self.qmax = np.asarray(qmax, dtype=np.float64)
+        self.dqn = np.asarray(dqn, dtype=np.int64)
+        if (self.qmin.shape, self.qmax.shape, self.dqn.shape) != ((3, ), ) * 3:
+            raise ValueError("qmin, qmax and dqn must each have 3 values")
+        if np.any(self.qmax <= self.qmin) or np.any(self.dqn < 1):
+            raise ValueError("The grid must have qmax > qmin and at least "
+                             "one voxel along each axis")
+        self.bounds = np.array([self.qmin, self.qmax, self.dqn]).T
+
+        grid_size = int(np.prod(self.dqn))
+        self.occupancy = np.zeros(grid_size, dtype=np.int64)
+        self._mean = np.zeros(grid_size)
+        self._m2 = np.zeros(grid_size)
+        self.oob = 0
+
+    def add(self, q, intensity, binary_mask=None):
+        """
+        Add data points to the grid.
+
+        Parameters
+        ----------
+        q : ndarray
+            (Qx, Qy, Qz) of each point, Nx3 array (or any array whose
+            last dimension is 3, e.g. (num_rows, num_cols, 3) for an
+            image)
+        intensity : ndarray
+            value of each point, N values (e.g. an image)
+        binary_mask : ndarray, optional
+            the points where the mask is False are left out
+        """
+        q = np.asarray(q).reshape(-1, 3)
+        intensity = np.ravel(intensity)
+        if len(intensity) != len(q):
+            raise ValueError("There must be one intensity for each q, got "
+                             "{0} intensities for {1} q"
+                             "".format(len(intensity), len(q)))
+        if binary_mask is not None:
+            binary_mask = np.ravel(binary_mask).astype(bool)
+            q = q[binary_mask]
+            intensity = intensity[binary_mask]
+
+        # the same rule as grid3d for the voxel of each point
+        rel = (q - self.qmin) / (self.qmax - self.qmin)
+        inside = np.all((rel >= 0) & (rel < 1), axis=1)
+        self.oob += int(len(q) - np.count_nonzero(inside))
+        if not np.all(inside):
+            rel = rel[inside]
+            intensity = intensity[inside]
+        voxel = (rel * self.dqn).astype(np.int64)
+        voxel = np.ravel_multi_index(voxel.T, self.dqn)
+
+        # the statistics of the chunk, with two passes for the variance.
+        # Only the voxels the chunk touches are counted, so the work does
+        # not depend on the size of the grid
+        touched, voxel = np.unique(voxel, return_inverse=True)
+        count = np.bincount(voxel)
+        mean = np.bincount(voxel, weights=intensity) / count
+        m2 = np.bincount(voxel, weights=(intensity - mean[voxel])**2)
+
+        # merge the chunk into the grid
+        n_a = self.occupancy[touched]
+        n = n_a + count
+        delta = mean - self._mean[touched]
+        self._mean[touched] += delta * count / n
+        self._m2[touched] += m2 + delta**2 * n_a * count / n
+        self.occupancy[touched] = n
+
+    def finalize(self):
+        """
+        The grid of the data points added so far.
+
+        Returns
+        -------
+        mean : ndarray
+            intensity grid.  The values in this grid are the
+            mean of the values that fill with in the grid.
+        occupancy : ndarray
+            The number of data points that fell in the grid.
+        std_err : ndarray
+            This is the standard error of the value in the
+            grid box.
+        oob : int
+            Out Of Bounds. Number of data points that are outside of
+            the gridded region.
+        bounds : list
+            tuple of (min, max, step) for x, y, z in order: [x_bounds,
+            y_bounds, z_bounds]
+        """
+        shape = tuple(self.dqn)
+        occupancy = self.occupancy
+        std_err = np.zeros(len(occupancy))
+        many = occupancy > 1
+        std_err[many] = np.sqrt(self._m2[many] / (occupancy[many] - 1) /
+                                occupancy[many])
+        return (self._mean.reshape(shape).copy(),
+                occupancy.reshape(shape).copy(), std_err.reshape(shape),
+                self.oob, self.bounds)
+
+
 def bin_edges_to_centers(input_edges):
     """
     Helper function for turning a array of bin edges into
@@ -55,6 +55,8 @@ from skxray.core.fitting import gausssian_step
 
 # import fast conversions to reciprocal space
 from skxray.core.recip import process_to_q
+from skxray.core.recip import process_to_grid
+from skxray.core.recip import DetectorGeometry
 from skxray.core.recip import hkl_to_q
 
 # import utilities for real <-> reciprocal space
@@ -83,7 +85,7 @@ __all__ = [
     'pvoigt', 'gaussian_tail', 'gausssian_step',
 
     # recip
-    'process_to_q', 'hkl_to_q',
+    'process_to_q', 'process_to_grid', 'hkl_to_q', 'DetectorGeometry',
 
 
     # core
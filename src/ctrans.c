@@ -17,24 +17,30 @@
 static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
   static char *kwlist[] = { "angles", "mode", "ccd_size", "ccd_pixsize", 
 			    "ccd_cen", "dist", "wavelength", 
-			    "UBinv", "outarray", NULL };
+			    "UBinv", "outarray", "directions", "arm", NULL };
   PyObject *angles = NULL;
   PyObject *_angles = NULL;
   PyObject *_ubinv = NULL;
   PyObject *ubinv = NULL;
   PyObject *_outarray = NULL;
   PyObject *qOut = NULL;
+  PyObject *_directions = NULL, *directions = NULL;
+  PyObject *_arm = NULL, *arm = NULL;
   CCD ccd;
   npy_intp dims[2];
-  npy_intp nimages;
+  npy_intp nimages, nsettings = 0;
   int i, j, t, stride;
+  int *armp = NULL;
+  _float *directionsp = NULL;
   int ndelgam;
   int mode;
 
   _float lambda;
 
   _float *anglesp;
-  _float *qOutp;
+  char *qOutp;
+  npy_intp out_cols;
+  int out_type;
   _float *ubinvp;
   _float UBI[3][3];
 
@@ -44,7 +50,7 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
 #endif
   imageThreadData threadData[NTHREADS];
 
-  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "Oi(ii)(dd)(dd)ddO|O", kwlist,
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "Oi(ii)(dd)(dd)ddO|OOO", kwlist,
 				  &_angles,
 				  &mode,
 				  &ccd.xSize, &ccd.ySize,
@@ -53,9 +59,14 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
 				  &ccd.dist,
 				  &lambda,
 				  &_ubinv,
-				  &_outarray)){
+				  &_outarray,
+				  &_directions,
+				  &_arm)){
     return NULL;
   }
+  if(_outarray == Py_None){
+    _outarray = NULL;
+  }
 
   angles = PyArray_FROMANY(_angles, NPY_DOUBLE, 2, 2, NPY_IN_ARRAY);
   if(!angles){
@@ -90,18 +101,59 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
       goto cleanup;
     }
   } else {
-    qOut = PyArray_FROMANY(_outarray, NPY_DOUBLE, 2, 2, NPY_INOUT_ARRAY);
-    if(!qOut){
-      PyErr_SetString(PyExc_ValueError, "outarray must be a 2-D array of floats");
+    // Write straight into the array given (which may be a memmap), as
+    // (Qx, Qy, Qz) or (Qx, Qy, Qz, -) rows of float64 or float32
+    if(!PyArray_Check(_outarray) || (PyArray_NDIM(_outarray) != 2) ||
+       !PyArray_ISCARRAY(_outarray) || !PyArray_ISNOTSWAPPED(_outarray) ||
+       ((PyArray_TYPE(_outarray) != NPY_DOUBLE) &&
+	(PyArray_TYPE(_outarray) != NPY_FLOAT)) ||
+       ((PyArray_DIM(_outarray, 1) != 3) && (PyArray_DIM(_outarray, 1) != 4))){
+      PyErr_SetString(PyExc_ValueError, "outarray must be a writeable, C "
+		      "contiguous Nx3 or Nx4 array of native float32 or "
+		      "float64");
       goto cleanup;
     }
-    if(PyArray_Size(qOut) != (4 * nimages * ndelgam)){
+    if(PyArray_DIM(_outarray, 0) != dims[0]){
       PyErr_SetString(PyExc_ValueError, "outarray is of the wrong size");
       goto cleanup;
     }
+    qOut = _outarray;
+    Py_INCREF(qOut);
   }
+  out_cols = PyArray_DIM(qOut, 1);
+  out_type = PyArray_TYPE(qOut);
+  // Direction vectors of the pixels computed beforehand (by ccdDirections)
+  // for each setting of the detector arm, and the setting of each image
+  if(_directions && (_directions != Py_None)){
+    if(_arm && (_arm != Py_None)){
+      directions = PyArray_FROMANY(_directions, NPY_DOUBLE, 0, 0,
+				   NPY_IN_ARRAY);
+      arm = PyArray_FROMANY(_arm, NPY_INT, 1, 1, NPY_IN_ARRAY);
+    }
+    if(!directions || !arm){
+      PyErr_SetString(PyExc_ValueError, "directions must be given with the "
+		      "1-D array arm of the direction set of each image");
+      goto cleanup;
+    }
+    nsettings = PyArray_SIZE(directions) / (3 * ndelgam);
+    if((PyArray_SIZE(directions) != (nsettings * 3 * ndelgam)) ||
+       (PyArray_SIZE(arm) != nimages)){
+      PyErr_SetString(PyExc_ValueError, "directions must have 3 values for "
+		      "each pixel, and arm one value for each image");
+      goto cleanup;
+    }
+    armp = (int *)PyArray_DATA(arm);
+    for(i=0;i<nimages;i++){
+      if((armp[i] < 0) || (armp[i] >= nsettings)){
+	PyErr_SetString(PyExc_ValueError, "arm is out of range of directions");
+	goto cleanup;
+      }
+    }
+    directionsp = (_float *)PyArray_DATA(directions);
+  }
+
   anglesp = (_float *)PyArray_DATA(angles);
-  qOutp = (_float *)PyArray_DATA(qOut);
+  qOutp = (char *)PyArray_DATA(qOut);
 
   stride = nimages / NTHREADS;
   for(t=0;t<NTHREADS;t++){
@@ -111,10 +163,14 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
     threadData[t].ccd = &ccd;
     threadData[t].anglesp = anglesp;
     threadData[t].qOutp = qOutp;
+    threadData[t].outCols = out_cols;
+    threadData[t].outType = out_type;
     threadData[t].ndelgam = ndelgam;
     threadData[t].lambda = lambda;
     threadData[t].mode = mode;
     threadData[t].imstart = stride * t;
+    threadData[t].directions = directionsp;
+    threadData[t].arm = armp;
     for(i=0;i<3;i++){
       for(j=0;j<3;j++){
 	threadData[t].UBI[j][i] = UBI[j][i];
@@ -134,7 +190,7 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
     processImageThread((void *) &threadData[t]);
 #endif
     anglesp += (6 * stride);
-    qOutp += (ndelgam * 4 * stride);
+    qOutp += ((size_t)ndelgam * stride * PyArray_STRIDE(qOut, 0));
   }
 
 #ifdef USE_THREADS
@@ -147,78 +203,203 @@ static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs){
 
   Py_XDECREF(ubinv);
   Py_XDECREF(angles);
+  Py_XDECREF(directions);
+  Py_XDECREF(arm);
   return Py_BuildValue("N", qOut);
 
  cleanup:
   Py_XDECREF(ubinv);
   Py_XDECREF(angles);
+  Py_XDECREF(directions);
+  Py_XDECREF(arm);
   Py_XDECREF(qOut);
   return NULL;
 }
 
 void *processImageThread(void* ptr){
   imageThreadData *data;
-  int i;
-  _float *delgam;
+  int i, direct;
+  _float *buf, *dirs, *q;
+  _float arm[2];
+  size_t image_bytes;
   data = (imageThreadData*) ptr;
-  delgam = (_float*)malloc(data->ndelgam * sizeof(_float) * 2);
-  if(!delgam){
+
+  // Q is computed as (Qx, Qy, Qz, -) rows of doubles, in the output if
+  // that is what it holds, or else image by image in q and then copied
+  direct = (data->outType == NPY_DOUBLE) && (data->outCols == 4);
+  image_bytes = (size_t)data->ndelgam * data->outCols *
+    ((data->outType == NPY_DOUBLE) ? sizeof(double) : sizeof(float));
+  buf = NULL;
+  q = NULL;
+  if(!data->directions){
+    buf = (_float*)malloc(data->ndelgam * sizeof(_float) * 3);
+  }
+  if(!direct){
+    q = (_float*)malloc(data->ndelgam * sizeof(_float) * 4);
+  }
+  if((!data->directions && !buf) || (!direct && !q)){
     fprintf(stderr, "MALLOC ERROR\n");
+    free(buf);
+    free(q);
 #ifdef USE_THREADS
     pthread_exit(NULL);
 #endif
+    return NULL;
   }
   
+  arm[0] = arm[1] = NAN;
   for(i=data->imstart;i<data->imend;i++){
     // For each image process
-    calcDeltaGamma(delgam, data->ccd, data->anglesp[0], data->anglesp[5]);
-    calcQTheta(delgam, data->anglesp[1], data->anglesp[4], data->qOutp, 
-	       data->ndelgam, data->lambda);
+    if(direct){
+      q = (_float *)data->qOutp;
+    }
+    dirs = imageDirections(data, data->anglesp, i, buf, arm);
+    calcQThetaFromDirections(dirs, data->anglesp[1], data->anglesp[4],
+			     q, data->ndelgam, data->lambda);
     if(data->mode > 1){
-      calcQPhiFromQTheta(data->qOutp, data->ndelgam, 
+      calcQPhiFromQTheta(q, data->ndelgam, 
 			 data->anglesp[2], data->anglesp[3]);
     }
     if(data->mode == 4){
-      calcHKLFromQPhi(data->qOutp, data->ndelgam, data->UBI);
+      calcHKLFromQPhi(q, data->ndelgam, data->UBI);
+    }
+    if(!direct){
+      copyQ(q, data->qOutp, data->ndelgam, data->outCols, data->outType);
     }
     data->anglesp+=6;
-    data->qOutp+=(data->ndelgam * 4); 
+    data->qOutp+=image_bytes;
+  }
+  free(buf);
+  if(!direct){
+    free(q);
   }
-  free(delgam);
 #ifdef USE_THREADS
   pthread_exit(NULL);
 #endif
+  return NULL;
 }
 
-int calcQTheta(_float* diffAngles, _float theta, _float mu, _float *qTheta, _int n, _float lambda){
+void copyQ(_float *q, char *out, int n, int cols, int type){
+  // Copy (Qx, Qy, Qz, -) rows of doubles to rows of cols values of type
+  int i;
+  double *d;
+  float *f;
+
+  if(type == NPY_DOUBLE){
+    d = (double *)out;
+    for(i=0;i<n;i++){
+      d[0] = q[0];
+      d[1] = q[1];
+      d[2] = q[2];
+      d += cols;
+      q += 4;
+    }
+  } else {
+    f = (float *)out;
+    for(i=0;i<n;i++){
+      f[0] = (float)q[0];
+      f[1] = (float)q[1];
+      f[2] = (float)q[2];
+      f += cols;
+      q += 4;
+    }
+  }
+}
+
+int imageTypeSupported(int type){
+  // Whether convertImage reads pixels of the numpy type
+  switch(type){
+  case NPY_DOUBLE: case NPY_FLOAT:
+  case NPY_BYTE: case NPY_UBYTE:
+  case NPY_SHORT: case NPY_USHORT:
+  case NPY_INT: case NPY_UINT:
+  case NPY_LONG: case NPY_ULONG:
+  case NPY_LONGLONG: case NPY_ULONGLONG:
+    return true;
+  }
+  return false;
+}
+
+#define CONVERT_PIXELS(ctype) \
+  for(i=0;i<n;i++){ \
+    out[i] = (double)((ctype *)in)[i]; \
+  } \
+  break;
+
+void convertImage(char *in, int type, double *out, int n){
+  // Copy the n pixels of an image of a numpy type to doubles
+  int i;
+
+  switch(type){
+  case NPY_DOUBLE: CONVERT_PIXELS(npy_double)
+  case NPY_FLOAT: CONVERT_PIXELS(npy_float)
+  case NPY_BYTE: CONVERT_PIXELS(npy_byte)
+  case NPY_UBYTE: CONVERT_PIXELS(npy_ubyte)
+  case NPY_SHORT: CONVERT_PIXELS(npy_short)
+  case NPY_USHORT: CONVERT_PIXELS(npy_ushort)
+  case NPY_INT: CONVERT_PIXELS(npy_int)
+  case NPY_UINT: CONVERT_PIXELS(npy_uint)
+  case NPY_LONG: CONVERT_PIXELS(npy_long)
+  case NPY_ULONG: CONVERT_PIXELS(npy_ulong)
+  case NPY_LONGLONG: CONVERT_PIXELS(npy_longlong)
+  case NPY_ULONGLONG: CONVERT_PIXELS(npy_ulonglong)
+  }
+}
+
+#undef CONVERT_PIXELS
+
+_float *imageDirections(imageThreadData *data, _float *anglesp, int image,
+			_float *buf, _float *arm){
+  // The direction vectors of the pixels of an image: the ones given to
+  // ccdToQ for its detector arm setting, or else the ones in buf, which
+  // are only computed again when the arm (delta, gamma) moves. arm holds
+  // the setting of buf, NaN to start with.
+  if(data->directions){
+    return data->directions + ((size_t)3 * data->ndelgam * data->arm[image]);
+  }
+  if(!((arm[0] == anglesp[0]) && (arm[1] == anglesp[5]))){
+    calcDirections(buf, data->ccd, anglesp[0], anglesp[5]);
+    arm[0] = anglesp[0];
+    arm[1] = anglesp[5];
+  }
+  return buf;
+}
+
+int calcQThetaFromDirections(_float *dirs, _float theta, _float mu,
+			     _float *qTheta, _int n, _float lambda){
   // Calculate Q in the Theta frame
-  // angles -> Six cicle detector angles [delta gamma]
+  // dirs   -> Direction vectors of the pixels (calcDirections)
   // theta  -> Theta value at this detector setting
   // mu     -> Mu value at this detector setting
   // qTheta -> Q Values
   // n      -> Number of values to convert
+  //
+  // With the pixel at (delta, gamma), this is
+  //   Qx = (-sin(gam) - sin(mu)) * kl
+  //   Qy = (cos(del - theta) * cos(gam) - cos(theta) * cos(mu)) * kl
+  //   Qz = (sin(del - theta) * cos(gam) + sin(theta) * cos(mu)) * kl
+  // with the angle differences expanded, so there is no trigonometry
+  // to do for each pixel
   _int i;
-  _float *angles;
+  _float *d;
   _float *qt;
   _float kl;
-  _float del, gam;
+  _float cth, sth, qx0, qy0, qz0;
 
-  angles = diffAngles;
+  d = dirs;
   qt = qTheta;
   kl = 2 * M_PI / lambda;
+  cth = cos(theta);
+  sth = sin(theta);
+  qx0 = sin(mu) * kl;
+  qy0 = cth * cos(mu) * kl;
+  qz0 = sth * cos(mu) * kl;
   for(i=0;i<n;i++){
-    del = *(angles++);
-    gam = *(angles++);
-    *qt = (-1.0 * sin(gam) * kl) - (sin(mu) * kl);
- 
-    qt++;
-    *qt = (cos(del - theta) * cos(gam) * kl) - (cos(theta) * cos(mu) * kl);
- 
-    qt++;
-    *qt = (sin(del - theta) * cos(gam) * kl) + (sin(theta) * cos(mu) * kl);
- 
-    qt++;
-    qt++;
+    qt[0] = (d[0] * kl) - qx0;
+    qt[1] = ((d[1] * cth + d[2] * sth) * kl) - qy0;
+    qt[2] = ((d[2] * cth - d[1] * sth) * kl) + qz0;
+    d += 3;
+    qt += 4;
   }
   
   return true;
@@ -271,32 +452,103 @@ int matmulti(_float *val, int n, _float mat[][3], int skip){
   return true;
 }
 
-int calcDeltaGamma(_float *delgam, CCD *ccd, _float delCen, _float gamCen){
-  // Calculate Delta Gamma Values for CCD
+int calcDirections(_float *dirs, CCD *ccd, _float delCen, _float gamCen){
+  // Calculate the direction vectors of the pixels of the CCD,
+  //   (-sin(gam), cos(del) * cos(gam), sin(del) * cos(gam))
+  // with (del, gam) the (delta, gamma) of each pixel. Delta only depends
+  // on the row and gamma on the column, so the trigonometry is done once
+  // for each row and column: the first row holds (-sin(gam), cos(gam))
+  // of the columns until it is filled in last.
   int i,j;
-  _float *delgamp;
+  _float *row;
   _float xPix, yPix;
+  _float del, sdel, cdel, cgam;
 
   xPix = ccd->xPixSize / ccd->dist;
   yPix = ccd->yPixSize / ccd->dist;
-  delgamp = delgam;
 
-  for(j=0;j<ccd->ySize;j++){
+  for(i=0;i<ccd->xSize;i++){
+    cgam = gamCen - atan( ((_float)i - ccd->xCen) * xPix);
+    dirs[3 * i] = -1.0 * sin(cgam);
+    dirs[3 * i + 1] = cos(cgam);
+  }
+  for(j=ccd->ySize - 1;j>=0;j--){
+    del = delCen - atan( ((_float)j - ccd->yCen) * yPix);
+    sdel = sin(del);
+    cdel = cos(del);
+    row = dirs + ((size_t)3 * j * ccd->xSize);
     for(i=0;i<ccd->xSize;i++){
-      *(delgamp++) = delCen - atan( ((_float)j - ccd->yCen) * yPix);
-      *(delgamp++) = gamCen - atan( ((_float)i - ccd->xCen) * xPix); 
+      cgam = dirs[3 * i + 1];
+      row[3 * i] = dirs[3 * i];
+      row[3 * i + 1] = cdel * cgam;
+      row[3 * i + 2] = sdel * cgam;
     }
   }
 
   return true;
 } 
 
+static PyObject* ccdDirections(PyObject *self, PyObject *args, PyObject *kwargs){
+  // The direction vectors of the pixels for each (delta, gamma) setting
+  // of the detector arm, to give to ccdToQ
+  static char *kwlist[] = { "ccd_size", "ccd_pixsize", "ccd_cen", "dist",
+			    "arms", NULL };
+  PyObject *_arms = NULL, *arms = NULL;
+  PyObject *dirOut = NULL;
+  CCD ccd;
+  npy_intp dims[3];
+  npy_intp i, nsettings;
+  _float *armsp, *dirp;
+
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "(ii)(dd)(dd)dO", kwlist,
+				  &ccd.xSize, &ccd.ySize,
+				  &ccd.xPixSize, &ccd.yPixSize,
+				  &ccd.xCen, &ccd.yCen,
+				  &ccd.dist,
+				  &_arms)){
+    return NULL;
+  }
+
+  arms = PyArray_FROMANY(_arms, NPY_DOUBLE, 2, 2, NPY_IN_ARRAY);
+  if(!arms || (PyArray_DIM(arms, 1) != 2)){
+    PyErr_SetString(PyExc_ValueError, "arms must be a Nx2 array of "
+		    "(delta, gamma) in radians");
+    goto cleanup;
+  }
+  nsettings = PyArray_DIM(arms, 0);
+
+  dims[0] = nsettings;
+  dims[1] = ccd.xSize * ccd.ySize;
+  dims[2] = 3;
+  dirOut = PyArray_SimpleNew(3, dims, NPY_DOUBLE);
+  if(!dirOut){
+    goto cleanup;
+  }
+
+  armsp = (_float *)PyArray_DATA(arms);
+  dirp = (_float *)PyArray_DATA(dirOut);
+  for(i=0;i<nsettings;i++){
+    calcDirections(dirp, &ccd, armsp[0], armsp[1]);
+    armsp += 2;
+    dirp += dims[1] * 3;
+  }
+
+  Py_XDECREF(arms);
+  return Py_BuildValue("N", dirOut);
+
+ cleanup:
+  Py_XDECREF(arms);
+  Py_XDECREF(dirOut);
+  return NULL;
+}
+
 static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
   PyObject *gridout = NULL, *Nout = NULL, *standarderror = NULL;
   PyObject *gridI = NULL;
   PyObject *_I;
   
-  static char *kwlist[] = { "data", "xrange", "yrange", "zrange", "norm", NULL };
+  static char *kwlist[] = { "data", "xrange", "yrange", "zrange", "norm",
+                            "nthreads", NULL };
   
   npy_intp data_size;
   npy_intp dims[3];
@@ -305,15 +557,17 @@ static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
   double grid_stop[3];
   int grid_nsteps[3];
   int norm_data = 0;
+  int nthreads = 0;
+  int retval;
   
   unsigned long n_outside;
   
-  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "O(ddd)(ddd)(iii)|i", kwlist,
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs, "O(ddd)(ddd)(iii)|ii", kwlist,
 				  &_I, 
 				  &grid_start[0], &grid_start[1], &grid_start[2],
 				  &grid_stop[0], &grid_stop[1], &grid_stop[2],
 				  &grid_nsteps[0], &grid_nsteps[1], &grid_nsteps[2],
-				  &norm_data)){
+				  &norm_data, &nthreads)){
     return NULL;
   }	
   
@@ -341,9 +595,18 @@ static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
     goto cleanup;
   }
   
-  n_outside = c_grid3d(PyArray_DATA(gridout), PyArray_DATA(Nout), 
-		       PyArray_DATA(standarderror), PyArray_DATA(gridI),
-		       grid_start, grid_stop, data_size, grid_nsteps, norm_data);
+  // The gridding only touches the arrays, so other python threads can
+  // run in the meantime
+  Py_BEGIN_ALLOW_THREADS
+  retval = c_grid3d(PyArray_DATA(gridout), PyArray_DATA(Nout), 
+		    PyArray_DATA(standarderror), PyArray_DATA(gridI),
+		    grid_start, grid_stop, data_size, grid_nsteps, norm_data,
+		    nthreads, &n_outside);
+  Py_END_ALLOW_THREADS
+  if(!retval){
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the grid");
+    goto cleanup;
+  }
   
   Py_XDECREF(gridI);
   return Py_BuildValue("NNNl", gridout, Nout, standarderror, n_outside); 
@@ -356,57 +619,255 @@ static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs){
   return NULL;
 }
 
-unsigned long c_grid3d(double *dout, unsigned long *nout, double *standarderror, double *data, 
-		       double *grid_start, double *grid_stop, int max_data, 
-		       int *n_grid, int norm_data){
-  int i;
-  unsigned long *nout_ptr;
-  double *dout_ptr;
-  double *data_ptr;
-  
-  double *Mk = NULL;
-  double *Qk = NULL;
+int c_grid3d(double *dout, unsigned long *nout, double *standarderror, double *data, 
+	     double *grid_start, double *grid_stop, int max_data, 
+	     int *n_grid, int norm_data, int nthreads,
+	     unsigned long *n_outside){
+  // Grid the (Qx, Qy, Qz, I) rows of data. The rows are split between
+  // nthreads threads, each with its own sums, counts and running means
+  // and variances (Welford), which are merged into the output at the end.
+  int i, t;
   int grid_size = 0;
+  int stride;
+  int retval = true;
+  double grid_len[3];
+  gridThreadData *threadData = NULL;
+  gridThreadData *a;
+#ifdef USE_THREADS
+  pthread_t *thread = NULL;
+  int *started = NULL;
+#endif
 
-  double pos_double[3];
-  double grid_len[3], grid_step[3];
-  int grid_pos[3];
-  int pos = 0;
-  unsigned long n_outside = 0;
-	
   // Some useful quantities
 
   grid_size = n_grid[0] * n_grid[1] * n_grid[2];
+  for(i = 0;i < 3; i++){
+    grid_len[i] = grid_stop[i] - grid_start[i];
+  }
 
-  // Allocate arrays for standard error calculation
-  
-  if(standarderror){
-    Mk = (double*)malloc(sizeof(double) * grid_size);
-    if(!Mk){
-      return n_outside;
+#ifdef USE_THREADS
+  if(nthreads < 1){
+    nthreads = NTHREADS;
+  }
+#else
+  nthreads = 1;
+#endif
+  // No more threads than rows
+  if(nthreads > max_data){
+    nthreads = max_data > 0 ? max_data : 1;
+  }
+
+  threadData = (gridThreadData*)calloc(nthreads, sizeof(gridThreadData));
+  if(!threadData){
+    return false;
+  }
+#ifdef USE_THREADS
+  thread = (pthread_t*)malloc(sizeof(pthread_t) * nthreads);
+  started = (int*)calloc(nthreads, sizeof(int));
+  if(!thread || !started){
+    retval = false;
+    goto cleanup;
+  }
+#endif
+
+  if(!gridThreadsAlloc(threadData, nthreads, dout, nout, grid_size,
+		       standarderror != NULL)){
+    retval = false;
+    goto cleanup;
+  }
+  stride = max_data / nthreads;
+  for(t = 0; t < nthreads; t++){
+    a = &threadData[t];
+    a->data = data + ((size_t)stride * t * 4);
+    a->n_data = (t == (nthreads - 1)) ? (max_data - stride * t) : stride;
+    a->grid_start = grid_start;
+    a->grid_len = grid_len;
+    a->n_grid = n_grid;
+  }
+
+#ifdef USE_THREADS
+  for(t = 1; t < nthreads; t++){
+    if(pthread_create(&thread[t], NULL, grid3dThread,
+		      (void*) &threadData[t])){
+      retval = false;
+      break;
     }
-    Qk = (double*)malloc(sizeof(double) * grid_size);
-    if(!Mk){
-      return n_outside;
+    started[t] = 1;
+  }
+  if(retval){
+    grid3dThread((void*) &threadData[0]);
+  }
+  for(t = 1; t < nthreads; t++){
+    if(started[t] && pthread_join(thread[t], NULL)){
+      fprintf(stderr, "ERROR : Cannot join thread %d", t);
+      retval = false;
     }
   }
+  if(!retval){
+    goto cleanup;
+  }
+#else
+  grid3dThread((void*) &threadData[0]);
+#endif
 
-  dout_ptr = dout;
-  nout_ptr = nout;
+  *n_outside = gridThreadsMerge(threadData, nthreads, grid_size);
+  gridFinish(dout, nout, standarderror, threadData[0].Qk, grid_size,
+	     norm_data);
+
+ cleanup:
+  gridThreadsFree(threadData, nthreads);
+  free(threadData);
+#ifdef USE_THREADS
+  free(thread);
+  free(started);
+#endif
 	
-  data_ptr = data;
-  for(i = 0;i < 3; i++){
-    grid_len[i] = grid_stop[i] - grid_start[i];
-    grid_step[i] = grid_len[i] / (n_grid[i]);
+  return retval;
+}
+
+int gridThreadsAlloc(gridThreadData *threadData, int nthreads, double *dout,
+		     unsigned long *nout, int grid_size, int stats){
+  // The first thread accumulates straight into the output, the others
+  // into buffers of their own
+  int t;
+  gridThreadData *a;
+
+  for(t = 0; t < nthreads; t++){
+    a = &threadData[t];
+    if(t == 0){
+      a->dout = dout;
+      a->nout = nout;
+    } else {
+      a->dout = (double*)calloc(grid_size, sizeof(double));
+      a->nout = (unsigned long*)calloc(grid_size, sizeof(unsigned long));
+      if(!a->dout || !a->nout){
+	return false;
+      }
+    }
+    // Allocate arrays for standard error calculation
+    if(stats){
+      a->Mk = (double*)malloc(sizeof(double) * grid_size);
+      a->Qk = (double*)malloc(sizeof(double) * grid_size);
+      if(!a->Mk || !a->Qk){
+	return false;
+      }
+    }
   }
-	
-  for(i = 0; i < max_data ; i++){
+  return true;
+}
+
+unsigned long gridThreadsMerge(gridThreadData *threadData, int nthreads,
+			       int grid_size){
+  // Merge the results of the other threads into the first, and return the
+  // total number of rows outside of the grid
+  int i, t;
+  double delta;
+  unsigned long n_a, n_b, n;
+  gridThreadData *a, *b;
+
+  a = &threadData[0];
+  for(t = 1; t < nthreads; t++){
+    b = &threadData[t];
+    for(i = 0; i < grid_size; i++){
+      if(b->nout[i] == 0){
+	continue;
+      }
+      n_a = a->nout[i];
+      n_b = b->nout[i];
+      n = n_a + n_b;
+      if(a->Mk){
+	if(n_a == 0){
+	  a->Mk[i] = b->Mk[i];
+	  a->Qk[i] = b->Qk[i];
+	} else {
+	  // Chan et al. pairwise update of the mean and variance
+	  delta = b->Mk[i] - a->Mk[i];
+	  a->Mk[i] = a->Mk[i] + (delta * n_b / n);
+	  a->Qk[i] = a->Qk[i] + b->Qk[i] + (delta * delta * n_a * n_b / n);
+	}
+      }
+      a->dout[i] = a->dout[i] + b->dout[i];
+      a->nout[i] = n;
+    }
+    a->n_outside += b->n_outside;
+  }
+  return a->n_outside;
+}
+
+void gridFinish(double *dout, unsigned long *nout, double *standarderror,
+		double *Qk, int grid_size, int norm_data){
+  int i;
+
+  // Calculate mean by dividing by the number of data points in each
+  // voxel
+
+  if(norm_data){
+    for(i = 0; i < grid_size; i++){
+      if(nout[i] > 0){
+	dout[i] = dout[i] / nout[i];
+      } else {
+	dout[i] = 0.0;
+      }
+    }
+  }
+
+  // Calculate the sterror
+  
+  if(standarderror){
+    for(i=0;i<grid_size;i++){
+      if(nout[i] > 1){
+	// standard deviation of the sample distribution
+	standarderror[i] = pow(Qk[i] / (nout[i] - 1), 0.5) / pow(nout[i], 0.5);
+      }
+    }
+  }
+}
+
+void gridThreadsFree(gridThreadData *threadData, int nthreads){
+  int t;
+  gridThreadData *a;
+
+  if(!threadData){
+    return;
+  }
+  for(t = 0; t < nthreads; t++){
+    a = &threadData[t];
+    if(t > 0){
+      free(a->dout);
+      free(a->nout);
+    }
+    free(a->Mk);
+    free(a->Qk);
+  }
+}
+
+void *grid3dThread(void *ptr){
+  // Grid the rows of one thread into its own buffers
+  gridThreadData *td;
+  int i;
+  double *data_ptr;
+  double *dout, *Mk, *Qk;
+  unsigned long *nout;
+  double pos_double[3];
+  int grid_pos[3];
+  int pos = 0;
+  int *n_grid;
+
+  td = (gridThreadData*) ptr;
+  dout = td->dout;
+  nout = td->nout;
+  Mk = td->Mk;
+  Qk = td->Qk;
+  n_grid = td->n_grid;
+  data_ptr = td->data;
+
+  for(i = 0; i < td->n_data ; i++){
     // Calculate the relative position in the grid. 
-    pos_double[0] = (*data_ptr - grid_start[0]) / grid_len[0];
+    pos_double[0] = (*data_ptr - td->grid_start[0]) / td->grid_len[0];
     data_ptr++;
-    pos_double[1] = (*data_ptr - grid_start[1]) / grid_len[1];
+    pos_double[1] = (*data_ptr - td->grid_start[1]) / td->grid_len[1];
     data_ptr++;
-    pos_double[2] = (*data_ptr - grid_start[2]) / grid_len[2];
+    pos_double[2] = (*data_ptr - td->grid_start[2]) / td->grid_len[2];
     if((pos_double[0] >= 0) && (pos_double[0] < 1) && 
        (pos_double[1] >= 0) && (pos_double[1] < 1) &&
        (pos_double[2] >= 0) && (pos_double[2] < 1)){
@@ -426,7 +887,7 @@ unsigned long c_grid3d(double *dout, unsigned long *nout, double *standarderror,
 
       // Calculate the standard deviation quantities
 
-      if(standarderror){
+      if(Mk){
 	if(nout[pos] == 1){
 	  Mk[pos] = *data_ptr;
 	  Qk[pos] = 0.0;
@@ -439,43 +900,370 @@ unsigned long c_grid3d(double *dout, unsigned long *nout, double *standarderror,
       // Increment pointer
       data_ptr++;
     } else {
-      n_outside++;
+      td->n_outside++;
       data_ptr+=2;
     }
   }
-  
-  // Calculate mean by dividing by the number of data points in each
-  // voxel
 
-  if(norm_data){
-    for(i = 0; i < grid_size; i++){
-      if(nout[i] > 0){
-	dout[i] = dout[i] / nout[i];
-      } else {
-	dout[i] = 0.0;
-      }
+  return NULL;
+}
+
+static PyObject* ccdToGrid(PyObject *self, PyObject *args, PyObject *kwargs){
+  // Convert the CCD images to Q and grid them in one pass, without
+  // storing the Q values of all of the pixels
+  static char *kwlist[] = { "angles", "mode", "ccd_size", "ccd_pixsize",
+			    "ccd_cen", "dist", "wavelength", "UBinv",
+			    "images", "grid_start", "grid_stop", "grid_nsteps",
+			    "mask",
+			    "nthreads", NULL };
+  PyObject *_angles = NULL, *_ubinv = NULL, *_images = NULL, *_mask = NULL;
+  PyObject *angles = NULL, *ubinv = NULL, *images = NULL, *mask = NULL;
+  PyObject *gridout = NULL, *Nout = NULL, *standarderror = NULL;
+  CCD ccd;
+  npy_intp dims[3];
+  npy_intp nimages, mask_size;
+  int i, ndelgam, mode;
+  int mask_stride = 0;
+  int nthreads = 0;
+  int retval;
+  _float lambda;
+  _float *ubinvp;
+  _float UBI[3][3];
+  double grid_start[3];
+  double grid_stop[3];
+  int grid_nsteps[3];
+  unsigned long n_outside;
+
+  if(!PyArg_ParseTupleAndKeywords(args, kwargs,
+				  "Oi(ii)(dd)(dd)ddOO(ddd)(ddd)(iii)|Oi",
+				  kwlist,
+				  &_angles,
+				  &mode,
+				  &ccd.xSize, &ccd.ySize,
+				  &ccd.xPixSize, &ccd.yPixSize,
+				  &ccd.xCen, &ccd.yCen,
+				  &ccd.dist,
+				  &lambda,
+				  &_ubinv,
+				  &_images,
+				  &grid_start[0], &grid_start[1], &grid_start[2],
+				  &grid_stop[0], &grid_stop[1], &grid_stop[2],
+				  &grid_nsteps[0], &grid_nsteps[1], &grid_nsteps[2],
+				  &_mask, &nthreads)){
+    return NULL;
+  }
+
+  angles = PyArray_FROMANY(_angles, NPY_DOUBLE, 2, 2, NPY_IN_ARRAY);
+  if(!angles){
+    PyErr_SetString(PyExc_ValueError, "angles must be a 2-D array of floats");
+    goto cleanup;
+  }
+
+  ubinv = PyArray_FROMANY(_ubinv, NPY_DOUBLE, 2, 2, NPY_IN_ARRAY);
+  if(!ubinv){
+    PyErr_SetString(PyExc_ValueError, "ubinv must be a 2-D array of floats");
+    goto cleanup;
+  }
+
+  ubinvp = (_float *)PyArray_DATA(ubinv);
+  for(i=0;i<3;i++){
+    UBI[i][0] = -1.0 * ubinvp[2];
+    UBI[i][1] = ubinvp[1];
+    UBI[i][2] = ubinvp[0];
+    ubinvp+=3;
+  }
+
+  nimages = PyArray_DIM(angles, 0);
+  ndelgam = ccd.xSize * ccd.ySize;
+
+  // The images keep their type, and are converted to doubles one image at
+  // a time, unless convertImage cannot read them
+  images = PyArray_FROM_OF(_images, NPY_IN_ARRAY | NPY_NOTSWAPPED);
+  if(images && !imageTypeSupported(PyArray_TYPE(images))){
+    Py_DECREF(images);
+    images = PyArray_FROMANY(_images, NPY_DOUBLE, 0, 0, NPY_IN_ARRAY);
+  }
+  if(!images){
+    goto cleanup;
+  }
+  if(PyArray_SIZE(images) != (nimages * ndelgam)){
+    PyErr_SetString(PyExc_ValueError, "images must have one value for each "
+		    "pixel of each image");
+    goto cleanup;
+  }
+
+  if(_mask && (_mask != Py_None)){
+    mask = PyArray_FROMANY(_mask, NPY_UBYTE, 0, 0, NPY_IN_ARRAY);
+    if(!mask){
+      goto cleanup;
+    }
+    // One mask for all of the images, or one for each image
+    mask_size = PyArray_SIZE(mask);
+    if(mask_size == (nimages * ndelgam)){
+      mask_stride = ndelgam;
+    } else if(mask_size != ndelgam){
+      PyErr_SetString(PyExc_ValueError, "mask must have one value for each "
+		      "pixel of the detector, or of each image");
+      goto cleanup;
     }
   }
 
-  // Calculate the sterror
-  
-  if(standarderror){
-    for(i=0;i<grid_size;i++){
-      if(nout[i] > 1){
-	// standard deviation of the sample distribution
-	standarderror[i] = pow(Qk[pos] / (nout[i] - 1), 0.5) / pow(nout[i], 0.5);
+  dims[0] = grid_nsteps[0];
+  dims[1] = grid_nsteps[1];
+  dims[2] = grid_nsteps[2];
+
+  gridout = PyArray_ZEROS(3, dims, NPY_DOUBLE, 0);
+  if(!gridout){
+    goto cleanup;
+  }
+  Nout = PyArray_ZEROS(3, dims, NPY_ULONG, 0);
+  if(!Nout){
+    goto cleanup;
+  }
+  standarderror = PyArray_ZEROS(3, dims, NPY_DOUBLE, 0);
+  if(!standarderror){
+    goto cleanup;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  retval = c_ccdToGrid(PyArray_DATA(gridout), PyArray_DATA(Nout),
+		       PyArray_DATA(standarderror), &ccd,
+		       (_float *)PyArray_DATA(angles), nimages, mode, lambda,
+		       UBI, (char *)PyArray_DATA(images), PyArray_TYPE(images),
+		       PyArray_ITEMSIZE(images),
+		       mask ? (unsigned char *)PyArray_DATA(mask) : NULL,
+		       mask_stride, grid_start, grid_stop, grid_nsteps,
+		       nthreads, &n_outside);
+  Py_END_ALLOW_THREADS
+  if(!retval){
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the grid");
+    goto cleanup;
+  }
+
+  Py_XDECREF(angles);
+  Py_XDECREF(ubinv);
+  Py_XDECREF(images);
+  Py_XDECREF(mask);
+  return Py_BuildValue("NNNl", gridout, Nout, standarderror, n_outside);
+
+ cleanup:
+  Py_XDECREF(angles);
+  Py_XDECREF(ubinv);
+  Py_XDECREF(images);
+  Py_XDECREF(mask);
+  Py_XDECREF(gridout);
+  Py_XDECREF(Nout);
+  Py_XDECREF(standarderror);
+  return NULL;
+}
+
+int c_ccdToGrid(double *dout, unsigned long *nout, double *standarderror,
+		CCD *ccd, _float *angles, int nimages, int mode,
+		_float lambda, _float UBI[][3], char *images, int image_type,
+		int image_size, unsigned char *mask, int mask_stride, double *grid_start,
+		double *grid_stop, int *n_grid, int nthreads,
+		unsigned long *n_outside){
+  // The images are split between nthreads threads. Each thread converts
+  // one image at a time to Q and grids it into a grid of its own, so the
+  // memory depends on the size of the grid and of an image, not on the
+  // number of images. The grids are merged at the end as in c_grid3d.
+  int i, j, t;
+  int grid_size, ndelgam, stride;
+  int retval = true;
+  double grid_len[3];
+  gridThreadData *gridData = NULL;
+  ccdGridThreadData *threadData = NULL;
+  ccdGridThreadData *a;
+#ifdef USE_THREADS
+  pthread_t *thread = NULL;
+  int *started = NULL;
+#endif
+
+  grid_size = n_grid[0] * n_grid[1] * n_grid[2];
+  ndelgam = ccd->xSize * ccd->ySize;
+  for(i = 0;i < 3; i++){
+    grid_len[i] = grid_stop[i] - grid_start[i];
+  }
+
+#ifdef USE_THREADS
+  if(nthreads < 1){
+    nthreads = NTHREADS;
+  }
+#else
+  nthreads = 1;
+#endif
+  // No more threads than images
+  if(nthreads > nimages){
+    nthreads = nimages > 0 ? nimages : 1;
+  }
+
+  gridData = (gridThreadData*)calloc(nthreads, sizeof(gridThreadData));
+  threadData = (ccdGridThreadData*)calloc(nthreads,
+					  sizeof(ccdGridThreadData));
+  if(!gridData || !threadData){
+    retval = false;
+    goto cleanup;
+  }
+#ifdef USE_THREADS
+  thread = (pthread_t*)malloc(sizeof(pthread_t) * nthreads);
+  started = (int*)calloc(nthreads, sizeof(int));
+  if(!thread || !started){
+    retval = false;
+    goto cleanup;
+  }
+#endif
+
+  if(!gridThreadsAlloc(gridData, nthreads, dout, nout, grid_size, true)){
+    retval = false;
+    goto cleanup;
+  }
+  stride = nimages / nthreads;
+  for(t = 0; t < nthreads; t++){
+    a = &threadData[t];
+    a->grid = &gridData[t];
+    a->grid->grid_start = grid_start;
+    a->grid->grid_len = grid_len;
+    a->grid->n_grid = n_grid;
+
+    a->image.ccd = ccd;
+    a->image.ndelgam = ndelgam;
+    a->image.lambda = lambda;
+    a->image.mode = mode;
+    a->image.imstart = stride * t;
+    a->image.imend = (t == (nthreads - 1)) ? nimages : stride * (t + 1);
+    a->image.anglesp = angles + ((size_t)6 * a->image.imstart);
+    for(i=0;i<3;i++){
+      for(j=0;j<3;j++){
+	a->image.UBI[j][i] = UBI[j][i];
       }
     }
+    a->intensity = images + ((size_t)ndelgam * a->image.imstart *
+			     image_size);
+    a->intensityType = image_type;
+    a->intensitySize = image_size;
+    a->mask = mask;
+    if(mask){
+      a->mask += (size_t)mask_stride * a->image.imstart;
+    }
+    a->mask_stride = mask_stride;
   }
 
-  if(Mk){
-    free(Mk);
+#ifdef USE_THREADS
+  for(t = 1; t < nthreads; t++){
+    if(pthread_create(&thread[t], NULL, ccdToGridThread,
+		      (void*) &threadData[t])){
+      retval = false;
+      break;
+    }
+    started[t] = 1;
   }
-  if(Qk){
-    free(Qk);
+  if(retval){
+    ccdToGridThread((void*) &threadData[0]);
   }
-	
-  return n_outside;
+  for(t = 1; t < nthreads; t++){
+    if(started[t] && pthread_join(thread[t], NULL)){
+      fprintf(stderr, "ERROR : Cannot join thread %d", t);
+      retval = false;
+    }
+  }
+#else
+  ccdToGridThread((void*) &threadData[0]);
+#endif
+  for(t = 0; t < nthreads; t++){
+    if(threadData[t].failed){
+      retval = false;
+    }
+  }
+  if(!retval){
+    goto cleanup;
+  }
+
+  *n_outside = gridThreadsMerge(gridData, nthreads, grid_size);
+  gridFinish(dout, nout, standarderror, gridData[0].Qk, grid_size, true);
+
+ cleanup:
+  gridThreadsFree(gridData, nthreads);
+  free(gridData);
+  free(threadData);
+#ifdef USE_THREADS
+  free(thread);
+  free(started);
+#endif
+
+  return retval;
+}
+
+void *ccdToGridThread(void *ptr){
+  // Convert the images of one thread to Q and grid them, an image at a
+  // time
+  ccdGridThreadData *td;
+  imageThreadData *im;
+  int i, j, n;
+  _float *buf, *dirs, *q;
+  _float *anglesp;
+  _float arm[2];
+  char *image;
+  double *intensity;
+  unsigned char *mask;
+
+  td = (ccdGridThreadData*) ptr;
+  im = &td->image;
+  buf = (_float*)malloc(im->ndelgam * sizeof(_float) * 3);
+  q = (_float*)malloc(im->ndelgam * sizeof(_float) * 4);
+  // The pixels of one image, as doubles
+  intensity = (double*)malloc(im->ndelgam * sizeof(double));
+  if(!buf || !q || !intensity){
+    td->failed = true;
+    free(buf);
+    free(q);
+    free(intensity);
+    return NULL;
+  }
+
+  anglesp = im->anglesp;
+  image = td->intensity;
+  mask = td->mask;
+  arm[0] = arm[1] = NAN;
+  for(i=im->imstart;i<im->imend;i++){
+    convertImage(image, td->intensityType, intensity, im->ndelgam);
+    dirs = imageDirections(im, anglesp, i, buf, arm);
+    calcQThetaFromDirections(dirs, anglesp[1], anglesp[4], q, im->ndelgam,
+			     im->lambda);
+    if(im->mode > 1){
+      calcQPhiFromQTheta(q, im->ndelgam, anglesp[2], anglesp[3]);
+    }
+    if(im->mode == 4){
+      calcHKLFromQPhi(q, im->ndelgam, im->UBI);
+    }
+
+    // Pack the pixels which are not masked into (Qx, Qy, Qz, I) rows, in
+    // place, and grid them
+    n = 0;
+    for(j=0;j<im->ndelgam;j++){
+      if(mask && !mask[j]){
+	continue;
+      }
+      q[4 * n] = q[4 * j];
+      q[4 * n + 1] = q[4 * j + 1];
+      q[4 * n + 2] = q[4 * j + 2];
+      q[4 * n + 3] = intensity[j];
+      n++;
+    }
+    td->grid->data = q;
+    td->grid->n_data = n;
+    grid3dThread((void*) td->grid);
+
+    anglesp += 6;
+    image += (size_t)im->ndelgam * td->intensitySize;
+    if(mask){
+      mask += td->mask_stride;
+    }
+  }
+
+  free(buf);
+  free(q);
+  free(intensity);
+  return NULL;
 }
 
 PyMODINIT_FUNC initctrans(void)  {
@@ -39,26 +39,67 @@ typedef struct {
 typedef struct {
   CCD *ccd;
   _float *anglesp;
-  _float *qOutp;
+  char *qOutp;         // First row of the output of the first image
+  int outCols;         // Values in each row of the output, 3 or 4
+  int outType;         // Type of the output, NPY_DOUBLE or NPY_FLOAT
   int ndelgam;
   _float lambda;
   int mode;
   int imstart;
   int imend;
   _float UBI[3][3];
+  _float *directions;  // Direction vectors for each detector arm setting
+  int *arm;            // Detector arm setting of each image
 } imageThreadData;
 
+typedef struct {
+  double *dout;            // Sum of the values in each voxel
+  unsigned long *nout;     // Number of values in each voxel
+  double *Mk;              // Running mean of each voxel
+  double *Qk;              // Running sum of squared deviations
+  double *data;            // First (Qx, Qy, Qz, I) row to grid
+  int n_data;              // Number of rows to grid
+  double *grid_start;
+  double *grid_len;
+  int *n_grid;
+  unsigned long n_outside; // Number of rows outside of the grid
+} gridThreadData;
+
+typedef struct {
+  imageThreadData image;   // The images of this thread
+  gridThreadData *grid;    // The grid of this thread
+  char *intensity;         // First pixel of the first image
+  int intensityType;       // Numpy type of the pixels
+  int intensitySize;       // Bytes in each pixel
+  unsigned char *mask;     // Pixels to grid (non-zero), or NULL for all
+  int mask_stride;         // Pixels between the masks of two images
+  int failed;              // Set if the thread could not allocate memory
+} ccdGridThreadData;
+
 void *processImageThread(void* ptr);
-int calcQTheta(_float* diffAngles, _float theta, _float mu, _float *qTheta, _int n, _float lambda);
+void *grid3dThread(void *ptr);
+void *ccdToGridThread(void *ptr);
+_float *imageDirections(imageThreadData *data, _float *anglesp, int image, _float *buf, _float *arm);
+int calcQThetaFromDirections(_float *dirs, _float theta, _float mu, _float *qTheta, _int n, _float lambda);
 int calcQPhiFromQTheta(_float *qTheta, _int n, _float chi, _float phi);
-int calcDeltaGamma(_float *delgam, CCD *ccd, _float delCen, _float gamCen);
+void copyQ(_float *q, char *out, int n, int cols, int type);
+int imageTypeSupported(int type);
+void convertImage(char *in, int type, double *out, int n);
+int calcDirections(_float *dirs, CCD *ccd, _float delCen, _float gamCen);
 int matmulti(_float *val, int n, _float mat[][3], int skip);
 int calcHKLFromQPhi(_float *qPhi, _int n, _float mat[][3]);
 
-unsigned long c_grid3d(double *dout, unsigned long *nout, double *sterr, double *data, double *grid_start, double *grid_stop, int max_data, int *n_grid, int norm_data);
+int c_grid3d(double *dout, unsigned long *nout, double *sterr, double *data, double *grid_start, double *grid_stop, int max_data, int *n_grid, int norm_data, int nthreads, unsigned long *n_outside);
+int c_ccdToGrid(double *dout, unsigned long *nout, double *sterr, CCD *ccd, _float *angles, int nimages, int mode, _float lambda, _float UBI[][3], char *images, int image_type, int image_size, unsigned char *mask, int mask_stride, double *grid_start, double *grid_stop, int *n_grid, int nthreads, unsigned long *n_outside);
+int gridThreadsAlloc(gridThreadData *threadData, int nthreads, double *dout, unsigned long *nout, int grid_size, int stats);
+unsigned long gridThreadsMerge(gridThreadData *threadData, int nthreads, int grid_size);
+void gridFinish(double *dout, unsigned long *nout, double *sterr, double *Qk, int grid_size, int norm_data);
+void gridThreadsFree(gridThreadData *threadData, int nthreads);
 
 static PyObject* gridder_3D(PyObject *self, PyObject *args, PyObject *kwargs);
 static PyObject* ccdToQ(PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject* ccdToGrid(PyObject *self, PyObject *args, PyObject *kwargs);
+static PyObject* ccdDirections(PyObject *self, PyObject *args, PyObject *kwargs);
 
 static char *_ctransDoc = \
 "Python functions to perform gridding (binning) of experimental data.\n\n";
@@ -68,6 +109,10 @@ static PyMethodDef _ctransMethods[] = {
    "Grid the numpy.array object into a regular grid"},
   {"ccdToQ", (PyCFunction)ccdToQ,  METH_VARARGS | METH_KEYWORDS, 
    "Convert CCD image coordinates into Q values"},
+  {"ccdToGrid", (PyCFunction)ccdToGrid,  METH_VARARGS | METH_KEYWORDS, 
+   "Convert CCD images into Q values and grid them into a regular grid"},
+  {"ccdDirections", (PyCFunction)ccdDirections,  METH_VARARGS | METH_KEYWORDS, 
+   "Direction vectors of the CCD pixels for settings of the detector arm"},
   {NULL, NULL, 0, NULL}     /* Sentinel - marks the end of this structure */
 };
 